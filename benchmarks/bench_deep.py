@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of path resolution in a deep directory tree, path based vs.
+inode based API.
+
+Mounts the same tree of nested directories with `deep_fs.py` (high-level
+API) and `deep_ll_fs.py` (low-level API), and times os.stat() calls on the
+file at the bottom. With the cache timeouts set to 0 the kernel looks up
+each path component anew for each call, which takes a handler call per
+component; with the default (1s) timeouts the lookups are mostly served
+from the kernel's cache.
+"""
+
+import argparse
+import os
+
+from common import benchdir, measure, mounted, report
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-n", "--count", type=int, default=2000,
+                    help="stat calls per round [default: %(default)s]")
+    ap.add_argument("-d", "--depth", type=int, default=16,
+                    help="number of nested directories [default: %(default)s]")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    args = ap.parse_args()
+
+    path = "/".join(["d"] * args.depth + ["file"])
+    uncached = "attr_timeout=0,entry_timeout=0"
+    configs = (
+        ("highlevel", "deep_fs.py", uncached),
+        ("lowlevel", "deep_ll_fs.py", uncached),
+        ("highlevel cached", "deep_fs.py", ""),
+        ("lowlevel cached", "deep_ll_fs.py", ""),
+    )
+
+    results = {}
+    for label, script, opts in configs:
+        opts = ",".join(o for o in ("depth=%d" % args.depth, opts) if o)
+        with mounted(benchdir / script, "-s", "-o", opts) as mp:
+            target = str(mp / path)
+
+            def stats(n):
+                for _ in range(n):
+                    os.stat(target)
+
+            os.stat(target)
+            results[label] = measure(stats, args.count)
+
+    report("deep stat (depth %d)" % args.depth, results, json_path=args.json)
+
+
+if __name__ == "__main__":
+    main()
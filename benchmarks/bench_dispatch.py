@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of the per-request overhead of the bindings.
+
+Mounts `null_fs.py`, whose handlers do next to nothing, and times stat,
+read and write syscalls, each of which makes a round trip to the
+respective handler (getattr, read, write).
+"""
+
+import argparse
+import os
+
+from common import benchdir, measure, mounted, report
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-n", "--count", type=int, default=20000,
+                    help="syscalls per round [default: %(default)s]")
+    ap.add_argument("-b", "--blocksize", type=int, default=4096,
+                    help="size of reads and writes [default: %(default)s]")
+    ap.add_argument("-p", "--path-cache", type=int, default=0, metavar="N",
+                    help="size of the path cache [default: %(default)s]")
+    ap.add_argument("-m", "--multithreaded", action="store_true",
+                    help="run the filesystem in multithreaded mode")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    args = ap.parse_args()
+
+    results = {}
+    mtopts = [] if args.multithreaded else ["-s"]
+    with mounted(benchdir / "null_fs.py", *mtopts, "-o",
+                 "direct_io,attr_timeout=0,path_cache_size=%d" %
+                 args.path_cache) as mp:
+        path = str(mp / "file")
+        bs = args.blocksize
+        data = bytes(bs)
+
+        def stats(n):
+            for _ in range(n):
+                os.stat(path)
+
+        fd = os.open(path, os.O_RDWR)
+        try:
+            def reads(n):
+                for _ in range(n):
+                    os.pread(fd, bs, 0)
+
+            def writes(n):
+                for _ in range(n):
+                    os.pwrite(fd, data, 0)
+
+            results["getattr"] = measure(stats, args.count)
+            results["read %d" % bs] = measure(reads, args.count)
+            results["write %d" % bs] = measure(writes, args.count)
+        finally:
+            os.close(fd)
+
+    report("dispatch" + (" (multithreaded)" if args.multithreaded else ""),
+           results, json_path=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of getattr result conversion.
+
+Mounts `getattr_fs.py` with attribute caching turned off, so that each
+os.stat() call makes a getattr round trip, and times stat calls for each
+form of getattr result. As the handler itself does nothing, the
+differences between the forms show the per-call cost of the conversion.
+"""
+
+import argparse
+import os
+
+from common import benchdir, measure, mounted, report
+
+KINDS = ("stat_result", "tuple", "Stat", "object")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-n", "--count", type=int, default=20000,
+                    help="stat calls per round [default: %(default)s]")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    ap.add_argument("kinds", nargs="*", default=KINDS,
+                    help="stat result forms to try [default: all]")
+    args = ap.parse_args()
+
+    results = {}
+    for kind in args.kinds:
+        with mounted(benchdir / "getattr_fs.py", "-s", "-o",
+                     "attr_timeout=0,kind=" + kind) as mp:
+            path = str(mp / "file")
+
+            def stats(n):
+                for _ in range(n):
+                    os.stat(path)
+
+            try:
+                os.stat(path)
+            except OSError:
+                # this form is not supported by the fuse module in use
+                results[kind] = None
+                continue
+            results[kind] = measure(stats, args.count)
+
+    report("getattr", results, json_path=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of serving requests which wait on a slow backend, with threads
+vs. coroutines.
+
+Mounts `latency_fs.py`, whose getattr takes a fixed time, and has a number
+of client threads call os.fstat() on the same file at once. With a sleeping
+handler the throughput is bound by the number of FUSE worker threads; with
+a coroutine handler (low-level API, replies sent when the coroutine is done)
+a single thread can keep all the client requests in flight.
+"""
+
+import argparse
+import os
+import threading
+
+from common import benchdir, measure, mounted, report
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-n", "--count", type=int, default=20,
+                    help="fstat calls per client thread and round "
+                         "[default: %(default)s]")
+    ap.add_argument("-t", "--threads", type=int, default=64,
+                    help="number of client threads [default: %(default)s]")
+    ap.add_argument("-d", "--delay", type=float, default=0.01,
+                    help="time getattr takes, in seconds "
+                         "[default: %(default)s]")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    args = ap.parse_args()
+
+    delay = "delay=%g" % args.delay
+    configs = (
+        ("sleep, single thread", ("-s", "-o", delay)),
+        ("sleep, multithreaded", ("-o", delay)),
+        ("async, single thread", ("-s", "-o", delay + ",wait=async")),
+        ("async, multithreaded", ("-o", delay + ",wait=async")),
+    )
+
+    results = {}
+    for label, opts in configs:
+        with mounted(benchdir / "latency_fs.py", *opts) as mp:
+            fd = os.open(mp / "file", os.O_RDONLY)
+
+            def client(n):
+                for _ in range(n):
+                    os.fstat(fd)
+
+            def fstats(n):
+                threads = [threading.Thread(target=client,
+                                            args=(n // args.threads,))
+                           for _ in range(args.threads)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+            try:
+                results[label] = measure(fstats, args.count * args.threads,
+                                         repeat=3)
+            finally:
+                os.close(fd)
+
+    report("fstat with %gs latency, %d clients" % (args.delay, args.threads),
+           results, json_path=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of sequential reads through the block cache.
+
+Mounts `slow_fs.py`, the reads of which take some time, and reads its
+file from start to end in chunks, with the block cache off and on. With
+the cache, the blocks after the one being read are fetched in advance, so
+a sequential reader waits less for the slow backend.
+"""
+
+import argparse
+import os
+
+from common import benchdir, measure, mounted, report
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-s", "--size", type=int, default=16 << 20,
+                    help="size of the file [default: %(default)s]")
+    ap.add_argument("-b", "--blocksize", type=int, default=128 << 10,
+                    help="size of reads [default: %(default)s]")
+    ap.add_argument("-d", "--delay", type=float, default=0.001,
+                    help="time a read of the fs takes [default: %(default)s]")
+    ap.add_argument("-m", "--memory", type=int, default=8 << 20,
+                    help="memory of the block cache [default: %(default)s]")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    args = ap.parse_args()
+
+    results = {}
+    bs = args.blocksize
+    count = args.size // bs
+    for label, memory in (("no cache", 0), ("block cache", args.memory)):
+        with mounted(benchdir / "slow_fs.py", "-s", "-o",
+                     "direct_io,size=%d,delay=%g,block_cache_memory=%d" %
+                     (args.size, args.delay, memory)) as mp:
+            path = str(mp / "file")
+
+            def reads(n):
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    for i in range(n):
+                        os.pread(fd, bs, i * bs)
+                finally:
+                    os.close(fd)
+
+            results["read %d, %s" % (bs, label)] = measure(reads, count)
+
+    report("sequential read", results, json_path=args.json)
+
+
+if __name__ == "__main__":
+    main()
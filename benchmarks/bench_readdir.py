@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmark of readdir result conversion.
+
+Mounts `readdir_fs.py` and times listing its root directory, for each
+form of directory entry, both when the entries come in a list and when
+they are yielded by a generator. The entries are prepared in advance, so
+the numbers show the cost of handing them over to FUSE.
+"""
+
+import argparse
+import os
+
+from common import benchdir, measure, mounted, report
+
+KINDS = ("Direntry", "tuple", "str")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-e", "--entries", type=int, default=100000,
+                    help="directory size [default: %(default)s]")
+    ap.add_argument("-n", "--count", type=int, default=5,
+                    help="listings per round [default: %(default)s]")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    ap.add_argument("kinds", nargs="*", default=KINDS,
+                    help="entry forms to try [default: all]")
+    args = ap.parse_args()
+
+    results = {}
+    for kind in args.kinds:
+        for gen in (False, True):
+            name = kind + (" (generator)" if gen else " (list)")
+            opts = "kind=%s,entries=%d" % (kind, args.entries)
+            if gen:
+                opts += ",gen"
+            with mounted(benchdir / "readdir_fs.py", "-s", "-o",
+                         opts) as mp:
+                def listdirs(n):
+                    for _ in range(n):
+                        os.listdir(mp)
+
+                try:
+                    if len(os.listdir(mp)) != args.entries:
+                        raise OSError
+                except OSError:
+                    # this form is not supported by the fuse module in use
+                    results[name] = None
+                    continue
+                results[name] = measure(listdirs, args.count)
+
+    report("readdir (%d entries)" % args.entries, results,
+           json_path=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the settings of the multithreaded loop.
+
+Mounts `latency_fs.py` with getattr either keeping the CPU busy (holding
+the GIL) or sleeping, and has a number of client threads call os.fstat()
+on the same file at once, with the loop left as it is, limited to a few
+threads, and GIL-aware. Along with the time per call, the most threads
+the filesystem process had is given: with the CPU-bound getattr, threads
+beyond the first can only wait for the GIL, while the sleeping one needs
+one for each client to keep up.
+"""
+
+import argparse
+import os
+import pathlib
+import threading
+import time
+
+from common import benchdir, measure, mounted, report
+
+
+def fs_threads(mountpoint):
+    """The number of threads of the process serving `mountpoint`."""
+
+    for p in pathlib.Path("/proc").glob("[0-9]*"):
+        try:
+            if str(mountpoint).encode() in \
+               (p / "cmdline").read_bytes().split(b"\0"):
+                return len(os.listdir(p / "task"))
+        except OSError:
+            pass
+    return 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-n", "--count", type=int, default=50,
+                    help="fstat calls per client thread and round "
+                         "[default: %(default)s]")
+    ap.add_argument("-t", "--threads", type=int, default=16,
+                    help="number of client threads [default: %(default)s]")
+    ap.add_argument("-d", "--delay", type=float, default=0.0005,
+                    help="time getattr takes, in seconds "
+                         "[default: %(default)s]")
+    ap.add_argument("-m", "--max-threads", type=int, default=4,
+                    help="threads of the limited loop [default: %(default)s]")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    args = ap.parse_args()
+
+    configs = (
+        ("default", ""),
+        ("max_threads=%d" % args.max_threads,
+         ",max_threads=%d" % args.max_threads),
+        ("gil_aware", ",gil_aware"),
+    )
+
+    results = {}
+    peaks = {}
+    for wait in ("spin", "sleep"):
+        for name, opts in configs:
+            label = "%s, %s" % (wait, name)
+            opts = "delay=%g,wait=%s%s" % (args.delay, wait, opts)
+            with mounted(benchdir / "latency_fs.py", "-o", opts) as mp:
+                fd = os.open(mp / "file", os.O_RDONLY)
+                peak = 0
+
+                def client(n):
+                    for _ in range(n):
+                        os.fstat(fd)
+
+                def fstats(n):
+                    nonlocal peak
+                    threads = [threading.Thread(target=client,
+                                                args=(n // args.threads,))
+                               for _ in range(args.threads)]
+                    for t in threads:
+                        t.start()
+                    while any(t.is_alive() for t in threads):
+                        peak = max(peak, fs_threads(mp))
+                        time.sleep(.005)
+                    for t in threads:
+                        t.join()
+
+                try:
+                    results[label] = measure(fstats,
+                                             args.count * args.threads,
+                                             repeat=3)
+                    peaks[label] = peak
+                finally:
+                    os.close(fd)
+
+    report("fstat taking %gs, %d clients" % (args.delay, args.threads),
+           results, json_path=args.json)
+    print("most threads of the filesystem")
+    for label, n in peaks.items():
+        print("%-24s %10d" % (label, n))
+
+
+if __name__ == "__main__":
+    main()
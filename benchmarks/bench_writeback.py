@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of small sequential writes through the write buffer.
+
+Mounts `slow_fs.py`, the writes of which take some time, and appends to its
+file in small chunks, with the write buffer off and on. With the buffer,
+the chunks reach the slow backend in a few large writes instead of one
+write each.
+"""
+
+import argparse
+import os
+
+from common import benchdir, measure, mounted, report
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-n", "--count", type=int, default=2000,
+                    help="writes per round [default: %(default)s]")
+    ap.add_argument("-b", "--blocksize", type=int, default=4096,
+                    help="size of writes [default: %(default)s]")
+    ap.add_argument("-d", "--delay", type=float, default=0.001,
+                    help="time a write of the fs takes [default: %(default)s]")
+    ap.add_argument("-w", "--write-buffer-size", type=int, default=1 << 20,
+                    help="extent size of the write buffer [default: %(default)s]")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    args = ap.parse_args()
+
+    results = {}
+    bs = args.blocksize
+    data = bytes(bs)
+    for label, size in (("no buffer", 0),
+                        ("write buffer", args.write_buffer_size)):
+        with mounted(benchdir / "slow_fs.py", "-s", "-o",
+                     "direct_io,delay=%g,write_buffer_size=%d" %
+                     (args.delay, size)) as mp:
+            path = str(mp / "file")
+
+            def writes(n):
+                fd = os.open(path, os.O_WRONLY)
+                try:
+                    for i in range(n):
+                        os.pwrite(fd, data, i * bs)
+                finally:
+                    os.close(fd)
+
+            results["write %d, %s" % (bs, label)] = measure(writes,
+                                                            args.count)
+
+    report("sequential write", results, json_path=args.json)
+
+
+if __name__ == "__main__":
+    main()
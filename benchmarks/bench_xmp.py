@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the per-request overhead with a file class.
+
+Mounts `example/xmp.py` over a temporary directory and times stat, read and
+write syscalls on a file in it. Unlike `null_fs.py`, xmp serves its I/O with
+the methods of a file class (`XmpFile`), so the dispatch to the file
+objects is part of what's measured, along with the actual syscalls xmp
+makes on the underlying file.
+"""
+
+import argparse
+import os
+import tempfile
+
+from common import exampledir, measure, mounted, report
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("-n", "--count", type=int, default=20000,
+                    help="syscalls per round [default: %(default)s]")
+    ap.add_argument("-b", "--blocksize", type=int, default=4096,
+                    help="size of reads and writes [default: %(default)s]")
+    ap.add_argument("-a", "--attr-cache-ttl", type=float, default=0,
+                    metavar="SECS",
+                    help="attribute cache TTL of xmp [default: %(default)s]")
+    ap.add_argument("-m", "--multithreaded", action="store_true",
+                    help="run the filesystem in multithreaded mode")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    args = ap.parse_args()
+
+    results = {}
+    mtopts = [] if args.multithreaded else ["-s"]
+    with tempfile.TemporaryDirectory() as root, \
+         mounted(exampledir / "xmp.py", *mtopts, "-o",
+                 "root=%s,direct_io,attr_timeout=0,attr_cache_ttl=%g" %
+                 (root, args.attr_cache_ttl)) as mp:
+        bs = args.blocksize
+        data = bytes(bs)
+        with open(os.path.join(root, "file"), "wb") as f:
+            f.write(data)
+        path = str(mp / "file")
+
+        def stats(n):
+            for _ in range(n):
+                os.stat(path)
+
+        fd = os.open(path, os.O_RDWR)
+        try:
+            def reads(n):
+                for _ in range(n):
+                    os.pread(fd, bs, 0)
+
+            def writes(n):
+                for _ in range(n):
+                    os.pwrite(fd, data, 0)
+
+            results["getattr"] = measure(stats, args.count)
+            results["read %d" % bs] = measure(reads, args.count)
+            results["write %d" % bs] = measure(writes, args.count)
+        finally:
+            os.close(fd)
+
+    report("xmp" + (" (multithreaded)" if args.multithreaded else "") +
+           (" (attr cache)" if args.attr_cache_ttl else ""),
+           results, json_path=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Helpers shared by the benchmark scripts.
+
+The benchmarks mount real filesystems, so they need FUSE to be usable
+(ie. /dev/fuse and fusermount), and the fuse module to be importable, just
+like for the test suite.
+"""
+
+import contextlib
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+topdir = pathlib.Path(__file__).parent.parent
+benchdir = topdir / "benchmarks"
+exampledir = topdir / "example"
+
+
+@contextlib.contextmanager
+def mounted(script, *args):
+    """
+    Mount the filesystem implemented by `script` (run in the foreground with
+    the extra command line arguments `args`) on a temporary directory and
+    yield the path of the mountpoint. Unmount when done.
+    """
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        st_dev = os.stat(tmpdir).st_dev
+        proc = subprocess.Popen([sys.executable, str(script), tmpdir, "-f"] +
+                                list(args), stdin=subprocess.DEVNULL)
+        try:
+            deadline = time.time() + 5
+            while True:
+                try:
+                    if os.stat(tmpdir).st_dev != st_dev:
+                        break
+                except OSError:
+                    # mounted, but the fs is not happy with the request
+                    break
+                if time.time() > deadline or proc.poll() is not None:
+                    raise RuntimeError("%s did not mount" % script)
+                time.sleep(.01)
+
+            yield pathlib.Path(tmpdir)
+        finally:
+            subprocess.call(["fusermount", "-u", "-q", "-z", tmpdir])
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+
+def measure(fn, count, repeat=5):
+    """
+    Call `fn(count)` `repeat` times and return the best time per iteration
+    in nanoseconds.
+    """
+
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter_ns()
+        fn(count)
+        t = (time.perf_counter_ns() - t0) / count
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def environment():
+    """
+    Return a dict describing where the benchmark runs, so that results from
+    different runs can be told apart.
+    """
+
+    env = {"python": sys.version.split()[0],
+           "implementation": sys.implementation.name,
+           "kernel": os.uname().release,
+           "machine": os.uname().machine,
+           "cpus": os.cpu_count()}
+    try:
+        import fuse
+        env["fuse_python"] = fuse.__version__
+    except ImportError:
+        pass
+    try:
+        env["git_revision"] = subprocess.run(
+            ["git", "-C", str(topdir), "rev-parse", "HEAD"],
+            capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return env
+
+
+def report(name, results, fmt="%-24s %10.0f ns/op", json_path=None):
+    """
+    Print a `{label: ns_per_op}` dict in a human readable form, and dump it
+    (along with some info about the environment) as JSON to `json_path` if
+    that's given.
+    """
+
+    print(name)
+    for label, ns in results.items():
+        if ns is None:
+            print("%-24s %10s" % (label, "n/a"))
+        else:
+            print(fmt % (label, ns))
+
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump({"benchmark": name,
+                       "python": sys.version.split()[0],
+                       "results": results}, f, indent=2)
+            f.write("\n")
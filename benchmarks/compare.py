@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+"""
+Compare two sets of benchmark results.
+
+Takes two JSON files written by the benchmarks (with -j), the baseline
+and the new results, and prints the results both have, along with the
+change in time per operation. Changes beyond the threshold are marked;
+with --fail, the exit status is 1 if any of them is a slowdown.
+"""
+
+import argparse
+import json
+import sys
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    ap.add_argument("old", help="results of the baseline")
+    ap.add_argument("new", help="results to compare to the baseline")
+    ap.add_argument("-t", "--threshold", type=float, default=5,
+                    metavar="PERCENT",
+                    help="changes to mark [default: %(default)s]")
+    ap.add_argument("--fail", action="store_true",
+                    help="exit with 1 if something got slower by more "
+                    "than the threshold")
+    args = ap.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    for key in ("python", "git_revision", "kernel"):
+        a = old.get("environment", old).get(key)
+        b = new.get("environment", new).get(key)
+        if a != b:
+            print("%s: %s -> %s" % (key, a, b))
+
+    slower = 0
+    width = max([len(k) for k in new["results"]] + [10])
+    print("%-*s %12s %12s %8s" % (width, "", "old ns/op", "new ns/op",
+                                  "change"))
+    for label, b in new["results"].items():
+        a = old["results"].get(label)
+        if a is None or b is None:
+            continue
+        change = (b - a) / a * 100
+        mark = ""
+        if abs(change) > args.threshold:
+            mark = " slower" if change > 0 else " faster"
+            slower += change > 0
+        print("%-*s %12.0f %12.0f %+7.1f%%%s" % (width, label, a, b, change,
+                                                 mark))
+
+    if args.fail and slower:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
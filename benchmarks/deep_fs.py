@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+A chain of nested directories, each called ``d`` (as many as the ``depth``
+mount option says), with an empty ``file`` at the bottom, implemented with
+the path based API. Cf. `deep_ll_fs.py`.
+"""
+
+import os
+import stat
+import sys
+from errno import ENOENT
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "example"))
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import Fuse
+
+fuse.fuse_python_api = (0, 2)
+
+
+class DeepFS(Fuse):
+
+    def getattr(self, path):
+        names = path.split("/")[1:] if path != "/" else []
+        depth = int(self.depth)
+        for i, name in enumerate(names):
+            if i < depth and name == "d":
+                continue
+            if i == depth and name == "file" and i == len(names) - 1:
+                return self.filestat
+            return -ENOENT
+        return self.dirstat
+
+
+def main():
+    server = DeepFS(dash_s_do="setsingle")
+    server.depth = 16
+    server.parser.add_option(mountopt="depth", metavar="N",
+                             help="number of nested directories")
+    server.parse(values=server, errex=1)
+    server.dirstat = os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 2, 0, 0,
+                                     0, 0, 0, 0))
+    server.filestat = os.stat_result((stat.S_IFREG | 0o644, 0, 0, 1, 0, 0,
+                                      0, 0, 0, 0))
+    server.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+The tree of `deep_fs.py` implemented with the low-level (inode based) API.
+Directory inodes are numbered from 1 (the root) by depth, the file comes
+after the deepest directory.
+"""
+
+import os
+import stat
+import sys
+from errno import ENOENT
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "example"))
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import LowLevelFuse
+
+fuse.fuse_python_api = (0, 2)
+
+
+class DeepLLFS(LowLevelFuse):
+
+    def lookup(self, parent, name):
+        depth = self.ndirs
+        if parent <= depth and name == "d":
+            return fuse.Entry(ino=parent + 1,
+                              attr=self.stat(parent + 1))
+        if parent == depth + 1 and name == "file":
+            return fuse.Entry(ino=parent + 1, attr=self.filestat)
+        return -ENOENT
+
+    def stat(self, ino):
+        return self.dirstat if ino <= self.ndirs + 1 else self.filestat
+
+    def getattr(self, ino):
+        return self.stat(ino)
+
+
+def main():
+    server = DeepLLFS(dash_s_do="setsingle")
+    server.depth = 16
+    server.parser.add_option(mountopt="depth", metavar="N",
+                             help="number of nested directories")
+    server.parser.add_option(mountopt="attr_timeout", metavar="SECS",
+                             help="attribute cache timeout")
+    server.parser.add_option(mountopt="entry_timeout", metavar="SECS",
+                             help="name lookup cache timeout")
+    server.parse(values=server, errex=1)
+    server.ndirs = int(server.depth)
+    server.dirstat = os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 2, 0, 0,
+                                     0, 0, 0, 0))
+    server.filestat = os.stat_result((stat.S_IFREG | 0o644, 0, 0, 1, 0, 0,
+                                      0, 0, 0, 0))
+    server.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+A filesystem with a single file whose getattr returns the same stat data in
+the form selected by the ``kind`` mount option: ``stat_result`` (an
+os.stat_result), ``tuple``, ``Stat`` (a fuse.Stat) or ``object`` (an object
+of an ad-hoc class with stat attributes).
+"""
+
+import os
+import stat
+import sys
+from errno import ENOENT
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "example"))
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import Fuse
+
+fuse.fuse_python_api = (0, 2)
+
+
+class Attrs(object):
+    pass
+
+
+def make_stat(kind, mode, nlink, size):
+    fields = (mode, 0, 0, nlink, os.getuid(), os.getgid(), size, 0, 0, 0)
+    if kind == "stat_result":
+        return os.stat_result(fields)
+    if kind == "tuple":
+        return fields
+    if kind == "Stat":
+        st = fuse.Stat()
+    elif kind == "object":
+        st = Attrs()
+    else:
+        raise ValueError("unknown stat kind " + repr(kind))
+    for name, val in zip(("st_mode", "st_ino", "st_dev", "st_nlink", "st_uid",
+                          "st_gid", "st_size", "st_atime", "st_mtime",
+                          "st_ctime"), fields):
+        setattr(st, name, val)
+    return st
+
+
+class GetattrFS(Fuse):
+
+    def getattr(self, path):
+        if path == "/":
+            return self.dirstat
+        if path == "/file":
+            return self.filestat
+        return -ENOENT
+
+    def readdir(self, path, offset):
+        for name in (".", "..", "file"):
+            yield fuse.Direntry(name)
+
+
+def main():
+    server = GetattrFS(dash_s_do="setsingle")
+    server.kind = "stat_result"
+    server.parser.add_option(mountopt="kind", metavar="KIND",
+                             help="form of the getattr result")
+    server.parse(values=server, errex=1)
+    server.dirstat = make_stat(server.kind, stat.S_IFDIR | 0o755, 2, 0)
+    server.filestat = make_stat(server.kind, stat.S_IFREG | 0o644, 1, 4096)
+    server.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+A low-level filesystem with a single file, the attributes of which take
+`delay` seconds to get, standing in for a backend with some latency.
+With `wait=async` getattr is a coroutine, with `wait=spin` it keeps the
+CPU (and the GIL) busy, otherwise it sleeps in the worker thread. The
+settings of the multithreaded loop can be given as mount options.
+"""
+
+import asyncio
+import os
+import stat
+import sys
+import time
+from errno import ENOENT
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "example"))
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import LowLevelFuse
+
+fuse.fuse_python_api = (0, 2)
+
+FILE_INO = 2
+
+
+class LatencyFS(LowLevelFuse):
+
+    def lookup(self, parent, name):
+        if parent == 1 and name == "file":
+            return fuse.Entry(ino=FILE_INO, attr=self.stat(FILE_INO))
+        return -ENOENT
+
+    def stat(self, ino):
+        return self.dirstat if ino == 1 else self.filestat
+
+    def getattr(self, ino):
+        time.sleep(self.delay)
+        return self.stat(ino)
+
+    def open(self, ino, flags):
+        pass
+
+
+class SpinLatencyFS(LatencyFS):
+
+    def getattr(self, ino):
+        deadline = time.perf_counter() + self.delay
+        while time.perf_counter() < deadline:
+            pass
+        return self.stat(ino)
+
+
+class AsyncLatencyFS(LatencyFS):
+
+    async def getattr(self, ino):
+        await asyncio.sleep(self.delay)
+        return self.stat(ino)
+
+
+def main():
+    server = LatencyFS(dash_s_do="setsingle")
+    server.delay = 0.01
+    server.parser.add_option(mountopt="delay", metavar="SECS",
+                             help="time getattr takes")
+    server.wait = "sleep"
+    server.parser.add_option(mountopt="wait", metavar="sleep|async|spin",
+                             help="how getattr waits")
+    for opt in "max_threads", "max_idle_threads", "stack_size":
+        server.parser.add_option(mountopt=opt, metavar="N",
+                                 help="cf. Fuse.%s" % opt)
+    server.parser.add_option(mountopt="gil_aware", action="store_true",
+                             help="cf. Fuse.gil_aware")
+    server.parse(values=server, errex=1)
+    if server.wait == "async":
+        server.__class__ = AsyncLatencyFS
+    elif server.wait == "spin":
+        server.__class__ = SpinLatencyFS
+    server.delay = float(server.delay)
+    server.attr_timeout = server.entry_timeout = 0
+    server.dirstat = os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 2, 0, 0,
+                                     0, 0, 0, 0))
+    server.filestat = os.stat_result((stat.S_IFREG | 0o644, FILE_INO, 0, 1,
+                                      0, 0, 0, 0, 0, 0))
+    if server.wait == "async":
+        asyncio.run(server.main_async())
+    else:
+        server.main()
+
+
+if __name__ == "__main__":
+    main()
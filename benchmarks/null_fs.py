@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+A filesystem with a single file, ``/file``, whose handlers do as little as
+possible: getattr returns a prebuilt stat result, read returns a slice of a
+prebuilt buffer and write just reports success. Mounted with ``-o
+direct_io,attr_timeout=0``, each stat, read and write syscall on the file
+turns into a call of the respective handler, so timing them shows the
+per-request overhead of the bindings. The ``path_cache_size`` mount option
+is passed on to the bindings.
+"""
+
+import os
+import stat
+import sys
+from errno import ENOENT
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "example"))
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import Fuse
+
+fuse.fuse_python_api = (0, 2)
+
+SIZE = 1 << 20
+
+
+class NullFS(Fuse):
+
+    dirstat = os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 2,
+                              0, 0, 0, 0, 0, 0))
+    filestat = os.stat_result((stat.S_IFREG | 0o666, 0, 0, 1,
+                               0, 0, SIZE, 0, 0, 0))
+    data = bytes(SIZE)
+
+    def getattr(self, path):
+        if path == "/":
+            return self.dirstat
+        if path == "/file":
+            return self.filestat
+        return -ENOENT
+
+    def readdir(self, path, offset):
+        return [".", "..", "file"]
+
+    def open(self, path, flags):
+        if path != "/file":
+            return -ENOENT
+
+    def read(self, path, size, offset):
+        return self.data[offset:offset + size]
+
+    def write(self, path, buf, offset):
+        return len(buf)
+
+    def truncate(self, path, size):
+        pass
+
+
+def main():
+    server = NullFS(dash_s_do="setsingle")
+    server.parser.add_option(mountopt="path_cache_size", metavar="N",
+                             help="size of the path cache")
+    server.parse(values=server, errex=1)
+    server.main()
+
+
+if __name__ == "__main__":
+    main()
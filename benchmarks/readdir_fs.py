@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""
+A filesystem with a single directory of ``entries`` files (mount option,
+default 100000), whose readdir returns the entries in the form selected by
+the ``kind`` mount option: ``Direntry`` (fuse.Direntry objects), ``tuple``
+((name, ino, type, offset) tuples) or ``str`` (bare names). With the
+``gen`` mount option the entries are yielded by a generator, otherwise
+returned as a list.
+"""
+
+import os
+import stat
+import sys
+from errno import ENOENT
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "example"))
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import Fuse
+
+fuse.fuse_python_api = (0, 2)
+
+
+def make_entries(kind, names):
+    if kind == "Direntry":
+        return [fuse.Direntry(name) for name in names]
+    if kind == "tuple":
+        return [(name, 0, 0, 0) for name in names]
+    if kind == "str":
+        return list(names)
+    raise ValueError("unknown entry kind " + repr(kind))
+
+
+class ReaddirFS(Fuse):
+
+    def getattr(self, path):
+        if path == "/":
+            return os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 2,
+                                   0, 0, 0, 0, 0, 0))
+        return -ENOENT
+
+    def readdir(self, path, offset):
+        if self.gen:
+            return (e for e in self.dirents)
+        return self.dirents
+
+
+def main():
+    server = ReaddirFS(dash_s_do="setsingle")
+    server.kind = "Direntry"
+    server.entries = "100000"
+    server.gen = False
+    server.parser.add_option(mountopt="kind", metavar="KIND",
+                             help="form of the readdir entries")
+    server.parser.add_option(mountopt="entries", metavar="N",
+                             help="number of directory entries")
+    server.parser.add_option(mountopt="gen", action="store_true",
+                             help="yield entries from a generator")
+    server.parse(values=server, errex=1)
+    names = [".", ".."] + ["file%d" % i for i in range(int(server.entries))]
+    server.dirents = make_entries(server.kind, names)
+    server.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+A filesystem with a single file of `size` bytes, the reads and writes of
+which take `delay` seconds (plus a millionth of that per byte), standing
+in for a backend with some latency, like a remote object store. The I/O is
+done by a file class, so the block cache and the write buffer can be put
+in front of it with the `block_cache_memory` and `write_buffer_size` mount
+options. Written data is thrown away.
+"""
+
+import os
+import stat
+import sys
+import time
+from errno import ENOENT
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "example"))
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import Fuse
+
+fuse.fuse_python_api = (0, 2)
+
+
+class SlowFile(object):
+
+    size = 0
+    delay = 0
+
+    def __init__(self, path, flags, *mode):
+        pass
+
+    def read(self, size, offset):
+        size = max(0, min(size, self.size - offset))
+        time.sleep(self.delay * (1 + size / 1e6))
+        return bytes(size)
+
+    def write(self, buf, offset):
+        time.sleep(self.delay * (1 + len(buf) / 1e6))
+        return len(buf)
+
+
+class SlowFS(Fuse):
+
+    file_class = SlowFile
+
+    def getattr(self, path):
+        if path == "/":
+            return self.dirstat
+        if path == "/file":
+            return self.filestat
+        return -ENOENT
+
+    def readdir(self, path, offset):
+        for name in (".", "..", "file"):
+            yield fuse.Direntry(name)
+
+def main():
+    server = SlowFS(dash_s_do="setsingle")
+    server.size = 16 << 20
+    server.parser.add_option(mountopt="size", metavar="BYTES",
+                             help="size of the file")
+    server.delay = 0.001
+    server.parser.add_option(mountopt="delay", metavar="SECS",
+                             help="time a read takes")
+    server.parser.add_option(mountopt="block_cache_memory", metavar="BYTES",
+                             help="memory for the block cache")
+    server.parser.add_option(mountopt="write_buffer_size", metavar="BYTES",
+                             help="extent size for the write buffer")
+    server.parse(values=server, errex=1)
+    SlowFile.size = server.size = int(server.size)
+    SlowFile.delay = float(server.delay)
+    server.dirstat = os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 2, 0, 0,
+                                     0, 0, 0, 0))
+    server.filestat = os.stat_result((stat.S_IFREG | 0o644, 0, 0, 1, 0, 0,
+                                      server.size, 0, 0, 0))
+    server.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite over the example filesystems.
+
+Mounts `example/xmp.py` (over a temporary directory) and `example/memfs.py`,
+each single-threaded (-s) and multithreaded, and runs a set of workloads on
+them from one or more client threads:
+
+  stat          stat(2) of a file
+  readdir       listing of a directory with many entries
+  create        creation and removal of an empty file
+  seq-read      sequential reads at several block sizes
+  seq-write     sequential writes at several block sizes
+  rand-read     reads at random (block aligned) offsets
+  rand-write    writes at random (block aligned) offsets
+
+The filesystems are mounted with direct_io and no kernel caching of
+attributes and entries, so that each syscall turns into requests for
+python-fuse. Results are given in nanoseconds per operation: with several
+client threads, that's the wall time of a round divided by the operations
+all threads did, ie. the inverse of the throughput. Random offsets are
+drawn with a fixed seed.
+
+Settings of the filesystems, like those of the multithreaded loop, can be
+given with -o, as mount options. The results can be saved as JSON with -j,
+and two such files compared with `compare.py`.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+
+from common import environment, exampledir, measure, mounted
+
+filesystems = ("xmp", "memfs")
+modes = ("single", "multi")
+workloads = ("stat", "readdir", "create",
+             "seq-read", "seq-write", "rand-read", "rand-write")
+
+
+def size_arg(s):
+    """Parse a size like 4096, 64K or 1M."""
+    mult = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}.get(s[-1:].upper())
+    return int(s[:-1]) * mult if mult else int(s)
+
+
+def size_label(n):
+    for unit, shift in (("M", 20), ("K", 10)):
+        if n >= 1 << shift and not n % (1 << shift):
+            return "%d%s" % (n >> shift, unit)
+    return str(n)
+
+
+def list_arg(conv=str, choices=None):
+    def parse(s):
+        items = [conv(x) for x in s.split(",") if x]
+        if choices:
+            for x in items:
+                if x not in choices:
+                    raise argparse.ArgumentTypeError(
+                        "%r is not one of %s" % (x, ", ".join(choices)))
+        return items
+    return parse
+
+
+def in_threads(threads, fn):
+    """
+    Return a function which, given a count, runs `fn(i, count // threads)`
+    in `threads` threads at once, `i` being the index of the thread.
+    """
+
+    if threads == 1:
+        return lambda n: fn(0, n)
+
+    def run(n):
+        barrier = threading.Barrier(threads + 1)
+        errors = []
+
+        def target(i):
+            barrier.wait()
+            try:
+                fn(i, n // threads)
+            except BaseException as e:
+                errors.append(e)
+
+        ts = [threading.Thread(target=target, args=(i,))
+              for i in range(threads)]
+        for t in ts:
+            t.start()
+        barrier.wait()
+        for t in ts:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    return run
+
+
+class Workloads(object):
+    """The workloads, run on the filesystem mounted at `mp`."""
+
+    def __init__(self, mp, args, threads):
+        self.mp = mp
+        self.args = args
+        self.threads = threads
+        self.rnd = random.Random(args.seed)
+
+    def path(self, *names):
+        return os.path.join(self.mp, *names)
+
+    def stat(self):
+        paths = [self.path("stat%d" % i) for i in range(self.threads)]
+        for p in paths:
+            open(p, "wb").close()
+
+        def stats(i, n):
+            p = paths[i]
+            for _ in range(n):
+                os.stat(p)
+
+        return {"stat": in_threads(self.threads, stats)}, self.args.count
+
+    def readdir(self):
+        d = self.path("big")
+        os.mkdir(d)
+        for i in range(self.args.dir_size):
+            os.close(os.open(os.path.join(d, "entry%06d" % i),
+                             os.O_CREAT | os.O_WRONLY, 0o644))
+
+        def listings(i, n):
+            for _ in range(n):
+                if len(os.listdir(d)) != self.args.dir_size:
+                    raise RuntimeError("short listing of %s" % d)
+
+        return ({"readdir %d" % self.args.dir_size:
+                 in_threads(self.threads, listings)},
+                self.args.readdir_count)
+
+    def create(self):
+        def creates(i, n):
+            p = self.path("new%d" % i)
+            for _ in range(n):
+                os.close(os.open(p, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                                 0o644))
+                os.unlink(p)
+
+        return {"create+unlink": in_threads(self.threads, creates)}, \
+            self.args.count // 2
+
+    def _io(self, kind):
+        args = self.args
+        size = args.file_size
+        paths = [self.path("data%d" % i) for i in range(self.threads)]
+        chunk = os.urandom(1 << 20)
+        for p in paths:
+            if not os.path.exists(p):
+                with open(p, "wb", buffering=0) as f:
+                    for off in range(0, size, len(chunk)):
+                        f.write(chunk[:size - off])
+
+        fns = {}
+        for bs in args.block_sizes:
+            nblocks = size // bs
+            if not nblocks:
+                continue
+            if kind.startswith("seq"):
+                offsets = [i * bs for i in range(nblocks)]
+            else:
+                offsets = [self.rnd.randrange(nblocks) * bs
+                           for _ in range(max(nblocks, 1024))]
+            data = chunk[:bs] if bs <= len(chunk) else bytes(bs)
+            write = kind.endswith("write")
+
+            def io(i, n, offsets=offsets, bs=bs, data=data, write=write):
+                fd = os.open(paths[i], os.O_RDWR)
+                try:
+                    offs = itertools.islice(itertools.cycle(offsets), n)
+                    if write:
+                        for off in offs:
+                            os.pwrite(fd, data, off)
+                    else:
+                        for off in offs:
+                            os.pread(fd, bs, off)
+                finally:
+                    os.close(fd)
+
+            # the same amount of data moved with each block size
+            n = max(args.io_bytes // bs, 1) * self.threads
+            fns["%s %s" % (kind, size_label(bs))] = (
+                in_threads(self.threads, io), n)
+        return fns
+
+    def run(self, name):
+        """
+        Run the workload `name`, returning a `{label: (ns_per_op, bytes)}`
+        dict, `bytes` being the amount of data an operation moves (or 0).
+        """
+
+        if name in ("seq-read", "seq-write", "rand-read", "rand-write"):
+            return {label: (measure(fn, n, self.args.repeat),
+                            size_arg(label.split()[1]))
+                    for label, (fn, n) in self._io(name).items()}
+
+        fns, n = getattr(self, name.replace("-", "_"))()
+        return {label: (measure(fn, n * self.threads, self.args.repeat), 0)
+                for label, fn in fns.items()}
+
+
+def mount(fs, mode, root, options=None):
+    opts = "direct_io,attr_timeout=0,entry_timeout=0,negative_timeout=0"
+    if fs == "xmp":
+        opts += ",root=%s" % root
+    if options:
+        opts += "," + options
+    args = ["-o", opts]
+    if mode == "single":
+        args.insert(0, "-s")
+    return mounted(exampledir / ("%s.py" % fs), *args)
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n")[0],
+        epilog="workloads: " + ", ".join(workloads))
+    ap.add_argument("-f", "--fs", type=list_arg(choices=filesystems),
+                    default=list(filesystems), metavar="FS,...",
+                    help="filesystems to run [default: %s]" %
+                    ",".join(filesystems))
+    ap.add_argument("-m", "--mode", type=list_arg(choices=modes),
+                    default=list(modes), metavar="MODE,...",
+                    help="modes of the filesystems (%s) [default: all]" %
+                    ",".join(modes))
+    ap.add_argument("-w", "--workload", type=list_arg(choices=workloads),
+                    default=list(workloads), metavar="WORKLOAD,...",
+                    help="workloads to run [default: all]")
+    ap.add_argument("-t", "--threads", type=list_arg(int), default=[1, 4],
+                    metavar="N,...",
+                    help="numbers of client threads [default: 1,4]")
+    ap.add_argument("-b", "--block-sizes", type=list_arg(size_arg),
+                    default=[4 << 10, 64 << 10, 1 << 20], metavar="SIZE,...",
+                    help="block sizes of the I/O workloads "
+                    "[default: 4K,64K,1M]")
+    ap.add_argument("-n", "--count", type=int, default=5000,
+                    help="metadata operations per thread and round "
+                    "[default: %(default)s]")
+    ap.add_argument("--dir-size", type=int, default=5000,
+                    help="entries of the directory listed "
+                    "[default: %(default)s]")
+    ap.add_argument("--readdir-count", type=int, default=10,
+                    help="listings per thread and round "
+                    "[default: %(default)s]")
+    ap.add_argument("--file-size", type=size_arg, default=16 << 20,
+                    help="size of the files of the I/O workloads "
+                    "[default: 16M]")
+    ap.add_argument("--io-bytes", type=size_arg, default=32 << 20,
+                    help="data moved per thread and round in the I/O "
+                    "workloads [default: 32M]")
+    ap.add_argument("-r", "--repeat", type=int, default=3,
+                    help="rounds of each workload, the best of which "
+                    "counts [default: %(default)s]")
+    ap.add_argument("-s", "--seed", type=int, default=0,
+                    help="seed of the random offsets [default: %(default)s]")
+    ap.add_argument("-o", "--options", metavar="OPT,...",
+                    help="more mount options of the filesystems, like "
+                    "max_threads=4,gil_aware")
+    ap.add_argument("-j", "--json", metavar="FILE",
+                    help="write results to FILE as JSON")
+    args = ap.parse_args()
+
+    results = {}
+    throughput = {}
+    for fs, mode in itertools.product(args.fs, args.mode):
+        for threads in args.threads:
+            # a fresh mount for each run, so that the runs don't see
+            # the files of the others
+            with tempfile.TemporaryDirectory() as root, \
+                 mount(fs, mode, root, args.options) as mp:
+                w = Workloads(str(mp), args, threads)
+                for name in args.workload:
+                    for label, (ns, nbytes) in w.run(name).items():
+                        key = "%s/%s/%dt %s" % (fs, mode, threads, label)
+                        results[key] = ns
+                        if nbytes:
+                            throughput[key] = nbytes / ns * 1e9 / (1 << 20)
+                        print("%-40s %12.0f ns/op" % (key, ns) +
+                              ("  %8.1f MiB/s" % throughput[key]
+                               if nbytes else ""), flush=True)
+
+    if args.json:
+        params = {k: getattr(args, k)
+                  for k in ("count", "dir_size", "readdir_count",
+                            "file_size", "io_bytes", "repeat", "seed",
+                            "options")}
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": "suite",
+                       "python": sys.version.split()[0],
+                       "results": results,
+                       "mib_per_s": throughput,
+                       "parameters": params,
+                       "environment": environment()}, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
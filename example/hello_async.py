@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+# The low-level hello example with coroutine methods, run on an asyncio
+# event loop. Each request waits `delay` seconds (standing in for some
+# network round trip or the like), but as the replies are sent when the
+# coroutines are done, requests don't wait for each other, even if the
+# filesystem is single-threaded.
+
+import os, stat, errno
+import asyncio
+# pull in some spaghetti to make this stuff work without fuse-py being installed
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import LowLevelFuse
+
+
+if not hasattr(fuse, '__version__'):
+    raise RuntimeError("your fuse-py doesn't know of fuse.__version__, probably it's too old.")
+
+fuse.fuse_python_api = (0, 2)
+
+fuse.feature_assert('lowlevel')
+
+ROOT_INO = 1
+HELLO_INO = 2
+hello_name = 'hello'
+hello_str = b'Hello World!\n'
+
+
+def hello_stat(ino):
+    st = fuse.Stat(st_ino=ino)
+    if ino == ROOT_INO:
+        st.st_mode = stat.S_IFDIR | 0o755
+        st.st_nlink = 2
+    elif ino == HELLO_INO:
+        st.st_mode = stat.S_IFREG | 0o444
+        st.st_nlink = 1
+        st.st_size = len(hello_str)
+    else:
+        return None
+    return st
+
+
+class HelloAsync(LowLevelFuse):
+
+    def __init__(self, *args, **kw):
+        LowLevelFuse.__init__(self, *args, **kw)
+        self.delay = 0.1
+        # don't let the kernel spare us the requests
+        self.attr_timeout = self.entry_timeout = 0
+
+    async def lookup(self, parent, name):
+        await asyncio.sleep(self.delay)
+        if parent != ROOT_INO or name != hello_name:
+            raise OSError(errno.ENOENT, name)
+        return fuse.Entry(ino=HELLO_INO, attr=hello_stat(HELLO_INO))
+
+    async def getattr(self, ino):
+        await asyncio.sleep(self.delay)
+        st = hello_stat(ino)
+        if not st:
+            return -errno.ENOENT
+        return st
+
+    def readdir(self, ino, offset):
+        if ino != ROOT_INO:
+            return -errno.ENOTDIR
+        entries = [('.', ROOT_INO, stat.S_IFDIR, 0),
+                   ('..', ROOT_INO, stat.S_IFDIR, 0),
+                   (hello_name, HELLO_INO, stat.S_IFREG, 0)]
+        return entries[offset:]
+
+    def open(self, ino, flags):
+        if ino != HELLO_INO:
+            return -errno.EISDIR
+        accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+        if (flags & accmode) != os.O_RDONLY:
+            return -errno.EACCES
+
+    async def read(self, ino, size, offset):
+        await asyncio.sleep(self.delay)
+        return hello_str[offset:offset+size]
+
+
+def main():
+    usage="""
+Userspace hello example (low-level API, asyncio)
+
+""" + LowLevelFuse.fusage
+    server = HelloAsync(version="%prog " + fuse.__version__,
+                        usage=usage,
+                        dash_s_do='setsingle')
+
+    server.parser.add_option(mountopt="delay", metavar="SECONDS",
+                             type="float", default=server.delay,
+                             help="time each request takes [default: %default]")
+    server.parse(values=server, errex=1)
+    asyncio.run(server.main_async())
+
+if __name__ == '__main__':
+    main()
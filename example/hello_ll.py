@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+# The hello example done with the low-level (inode based) API,
+# cf. hello_ll.c of libfuse.
+
+import os, stat, errno
+# pull in some spaghetti to make this stuff work without fuse-py being installed
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import LowLevelFuse
+
+
+if not hasattr(fuse, '__version__'):
+    raise RuntimeError("your fuse-py doesn't know of fuse.__version__, probably it's too old.")
+
+fuse.fuse_python_api = (0, 2)
+
+fuse.feature_assert('lowlevel')
+
+ROOT_INO = 1
+HELLO_INO = 2
+hello_name = 'hello'
+hello_str = b'Hello World!\n'
+
+
+def hello_stat(ino):
+    st = fuse.Stat(st_ino=ino)
+    if ino == ROOT_INO:
+        st.st_mode = stat.S_IFDIR | 0o755
+        st.st_nlink = 2
+    elif ino == HELLO_INO:
+        st.st_mode = stat.S_IFREG | 0o444
+        st.st_nlink = 1
+        st.st_size = len(hello_str)
+    else:
+        return None
+    return st
+
+
+class HelloLL(LowLevelFuse):
+
+    def lookup(self, parent, name):
+        if parent != ROOT_INO or name != hello_name:
+            return -errno.ENOENT
+        return fuse.Entry(ino=HELLO_INO, attr=hello_stat(HELLO_INO))
+
+    def getattr(self, ino):
+        st = hello_stat(ino)
+        if not st:
+            return -errno.ENOENT
+        return st
+
+    def readdir(self, ino, offset):
+        if ino != ROOT_INO:
+            return -errno.ENOTDIR
+        entries = [('.', ROOT_INO, stat.S_IFDIR, 0),
+                   ('..', ROOT_INO, stat.S_IFDIR, 0),
+                   (hello_name, HELLO_INO, stat.S_IFREG, 0)]
+        return entries[offset:]
+
+    def open(self, ino, flags):
+        if ino != HELLO_INO:
+            return -errno.EISDIR
+        accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+        if (flags & accmode) != os.O_RDONLY:
+            return -errno.EACCES
+
+    def read(self, ino, size, offset):
+        return hello_str[offset:offset+size]
+
+
+def main():
+    usage="""
+Userspace hello example (low-level API)
+
+""" + LowLevelFuse.fusage
+    server = HelloLL(version="%prog " + fuse.__version__,
+                     usage=usage,
+                     dash_s_do='setsingle')
+
+    server.parse(errex=1)
+    server.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+# A filesystem kept in memory: directories, regular files and symlinks,
+# gone when unmounted. As it does no I/O of its own, it's also a fair
+# subject for measuring the overhead of python-fuse itself (cf. the
+# benchmarks directory).
+
+import os, stat, errno, time
+from threading import Lock
+# pull in some spaghetti to make this stuff work without fuse-py being installed
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import Fuse
+
+
+if not hasattr(fuse, '__version__'):
+    raise RuntimeError("your fuse-py doesn't know of fuse.__version__, probably it's too old.")
+
+fuse.fuse_python_api = (0, 2)
+
+
+class Node(object):
+
+    def __init__(self, mode, uid, gid):
+        now = time.time()
+        self.st = fuse.Stat(st_mode=mode, st_nlink=1, st_uid=uid,
+                            st_gid=gid, st_size=0, st_atime=now,
+                            st_mtime=now, st_ctime=now)
+        if stat.S_ISDIR(mode):
+            self.st.st_nlink = 2
+            self.children = {}
+        else:
+            self.data = bytearray()
+
+    def touch(self):
+        self.st.st_mtime = self.st.st_ctime = time.time()
+
+
+class MemFS(Fuse):
+
+    def __init__(self, *args, **kw):
+        Fuse.__init__(self, *args, **kw)
+        self.root = Node(stat.S_IFDIR | 0o755, os.getuid(), os.getgid())
+        # for the multithreaded mode, held by the methods which change
+        # something that takes more than one step
+        self.mutex = Lock()
+
+    def lookup(self, path):
+        node = self.root
+        for name in path.split('/')[1:]:
+            if not name:
+                continue
+            try:
+                node = node.children[name]
+            except (KeyError, AttributeError):
+                raise OSError(errno.ENOENT, path)
+        return node
+
+    def parent(self, path):
+        head, name = path.rsplit('/', 1)
+        parent = self.lookup(head)
+        if not stat.S_ISDIR(parent.st.st_mode):
+            raise OSError(errno.ENOTDIR, head)
+        return parent, name
+
+    def add(self, path, mode):
+        ctx = self.GetContext()
+        with self.mutex:
+            parent, name = self.parent(path)
+            if name in parent.children:
+                raise OSError(errno.EEXIST, path)
+            node = parent.children[name] = Node(mode, ctx['uid'], ctx['gid'])
+            if stat.S_ISDIR(mode):
+                parent.st.st_nlink += 1
+            parent.touch()
+        return node
+
+    def getattr(self, path):
+        return self.lookup(path).st
+
+    def readdir(self, path, offset):
+        node = self.lookup(path)
+        yield fuse.Direntry('.')
+        yield fuse.Direntry('..')
+        for name in list(node.children):
+            yield fuse.Direntry(name)
+
+    def mknod(self, path, mode, dev):
+        if not stat.S_ISREG(mode):
+            return -errno.EPERM
+        self.add(path, mode)
+
+    def create(self, path, flags, mode):
+        self.add(path, stat.S_IFREG | (mode & 0o7777))
+
+    def mkdir(self, path, mode):
+        self.add(path, stat.S_IFDIR | (mode & 0o7777))
+
+    def symlink(self, target, path):
+        self.add(path, stat.S_IFLNK | 0o777).data[:] = os.fsencode(target)
+
+    def readlink(self, path):
+        return os.fsdecode(bytes(self.lookup(path).data))
+
+    def unlink(self, path):
+        with self.mutex:
+            parent, name = self.parent(path)
+            node = self.lookup(path)
+            if stat.S_ISDIR(node.st.st_mode):
+                return -errno.EISDIR
+            del parent.children[name]
+            parent.touch()
+
+    def rmdir(self, path):
+        with self.mutex:
+            parent, name = self.parent(path)
+            node = self.lookup(path)
+            if not stat.S_ISDIR(node.st.st_mode):
+                return -errno.ENOTDIR
+            if node.children:
+                return -errno.ENOTEMPTY
+            del parent.children[name]
+            parent.st.st_nlink -= 1
+            parent.touch()
+
+    def rename(self, path, path1):
+        with self.mutex:
+            parent, name = self.parent(path)
+            parent1, name1 = self.parent(path1)
+            node = self.lookup(path)
+            old = parent1.children.get(name1)
+            isdir = stat.S_ISDIR(node.st.st_mode)
+            if old is not None:
+                if stat.S_ISDIR(old.st.st_mode) != isdir:
+                    return -(errno.EISDIR if not isdir else errno.ENOTDIR)
+                if isdir and old.children:
+                    return -errno.ENOTEMPTY
+            if isdir and (path1 + '/').startswith(path + '/'):
+                return -errno.EINVAL
+            del parent.children[name]
+            parent1.children[name1] = node
+            if isdir and parent is not parent1:
+                parent.st.st_nlink -= 1
+                if old is None:
+                    parent1.st.st_nlink += 1
+            parent.touch()
+            parent1.touch()
+
+    def chmod(self, path, mode):
+        node = self.lookup(path)
+        node.st.st_mode = stat.S_IFMT(node.st.st_mode) | (mode & 0o7777)
+        node.st.st_ctime = time.time()
+
+    def chown(self, path, uid, gid):
+        node = self.lookup(path)
+        if uid != -1:
+            node.st.st_uid = uid
+        if gid != -1:
+            node.st.st_gid = gid
+        node.st.st_ctime = time.time()
+
+    def utimens(self, path, ts_acc, ts_mod):
+        node = self.lookup(path)
+        node.st.st_atime = ts_acc.tv_sec + ts_acc.tv_nsec * 1e-9
+        node.st.st_mtime = ts_mod.tv_sec + ts_mod.tv_nsec * 1e-9
+
+    def truncate(self, path, size):
+        with self.mutex:
+            node = self.lookup(path)
+            if size < len(node.data):
+                del node.data[size:]
+            else:
+                node.data.extend(bytes(size - len(node.data)))
+            node.st.st_size = size
+            node.touch()
+
+    def open(self, path, flags):
+        self.lookup(path)
+
+    def read(self, path, size, offset):
+        data = self.lookup(path).data
+        return bytes(data[offset:offset + size])
+
+    def write(self, path, buf, offset):
+        with self.mutex:
+            node = self.lookup(path)
+            data = node.data
+            if offset > len(data):
+                data.extend(bytes(offset - len(data)))
+            data[offset:offset + len(buf)] = buf
+            node.st.st_size = len(data)
+            node.touch()
+        return len(buf)
+
+    def statfs(self):
+        return fuse.StatVfs(f_bsize=4096, f_frsize=4096, f_namemax=255)
+
+
+def main():
+    usage="""
+Userspace filesystem in memory
+
+""" + Fuse.fusage
+    server = MemFS(version="%prog " + fuse.__version__,
+                   usage=usage,
+                   dash_s_do='setsingle')
+
+    server.parser.add_option(mountopt="max_threads", metavar="N", default=0,
+                             help="serve with N threads at most (0: no limit) [default: %default]")
+    server.parser.add_option(mountopt="max_idle_threads", metavar="N",
+                             default=10,
+                             help="keep N idle threads at most [default: %default]")
+    server.parser.add_option(mountopt="stack_size", metavar="BYTES", default=0,
+                             help="stack size of the threads (0: default) [default: %default]")
+    server.parser.add_option(mountopt="gil_aware", action="store_true",
+                             help="don't start threads just to wait for the GIL")
+    server.parse(values=server, errex=1)
+    server.main()
+
+if __name__ == '__main__':
+    main()
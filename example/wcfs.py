@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+# Shows the tree under some directory, read-only, along with a NAME.wc
+# file next to each regular file NAME, which holds its line, word and
+# byte counts, like wc(1). Counting is done by a function decorated with
+# fuse.offload: with the `interpreters` option (Python 3.12 and later),
+# it runs in sub-interpreters, each with its own GIL, or with the
+# `processes` option, in worker processes, so that counting big files
+# doesn't hold up the other requests.
+
+import os, stat, errno
+# pull in some spaghetti to make this stuff work without fuse-py being installed
+try:
+    import _find_fuse_parts
+except ImportError:
+    pass
+import fuse
+from fuse import Fuse
+
+
+if not hasattr(fuse, '__version__'):
+    raise RuntimeError("your fuse-py doesn't know of fuse.__version__, probably it's too old.")
+
+fuse.fuse_python_api = (0, 2)
+
+SUFFIX = '.wc'
+
+
+@fuse.offload
+def wc(path):
+    lines = words = size = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            lines += line.endswith(b'\n')
+            words += len(line.split())
+            size += len(line)
+    return b'%d %d %d\n' % (lines, words, size)
+
+
+class WcFS(Fuse):
+
+    def __init__(self, *args, **kw):
+        Fuse.__init__(self, *args, **kw)
+        self.root = '/'
+
+    def fsinit(self):
+        os.chdir(self.root)
+
+    def counted(self, path):
+        """The file of which path is the .wc file, if it is one."""
+        if path.endswith(SUFFIX) and os.path.isfile('.' + path[:-len(SUFFIX)]):
+            return '.' + path[:-len(SUFFIX)]
+
+    def getattr(self, path):
+        real = self.counted(path)
+        if not real:
+            return os.lstat('.' + path)
+        st = os.stat(real)
+        return fuse.Stat(st_mode=stat.S_IFREG | 0o444, st_nlink=1,
+                         st_size=len(wc(real)), st_atime=st.st_atime,
+                         st_mtime=st.st_mtime, st_ctime=st.st_ctime)
+
+    def readlink(self, path):
+        return os.readlink('.' + path)
+
+    def readdir(self, path, offset):
+        yield fuse.Direntry('.')
+        yield fuse.Direntry('..')
+        for e in os.scandir('.' + path):
+            yield fuse.Direntry(e.name)
+            if e.is_file(follow_symlinks=False):
+                yield fuse.Direntry(e.name + SUFFIX)
+
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return -errno.EROFS
+
+    def read(self, path, size, offset):
+        real = self.counted(path)
+        if real:
+            return wc(real)[offset:offset + size]
+        with open('.' + path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+
+def main():
+    usage="""
+Show the tree under some directory, with the wc(1) counts of the files
+
+""" + Fuse.fusage
+    server = WcFS(version="%prog " + fuse.__version__,
+                  usage=usage,
+                  dash_s_do='setsingle')
+
+    server.parser.add_option(mountopt="root", metavar="PATH", default='/',
+                             help="show the tree under PATH [default: %default]")
+    server.parser.add_option(mountopt="interpreters", metavar="N", default=0,
+                             help="count in N sub-interpreters [default: %default]")
+    server.parser.add_option(mountopt="processes", metavar="N", default=0,
+                             help="count in N processes [default: %default]")
+    server.parse(values=server, errex=1)
+    server.root = os.path.abspath(server.root)
+
+    server.main()
+
+if __name__ == '__main__':
+    main()
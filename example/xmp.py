@@ -10,10 +10,13 @@
 from __future__ import print_function
 
 import os, sys
+import json
+import signal
 from errno import *
 from stat import *
 import fcntl
-from threading import Lock
+import ctypes
+from threading import Lock, Thread
 # pull in some spaghetti to make this stuff work without fuse-py being installed
 try:
     import _find_fuse_parts
@@ -30,6 +33,14 @@ fuse.fuse_python_api = (0, 2)
 
 fuse.feature_assert('stateful_files', 'has_init')
 
+# os has posix_fallocate() only, which can't punch holes and such
+try:
+    libc_fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    libc_fallocate.argtypes = (ctypes.c_int, ctypes.c_int,
+                               ctypes.c_longlong, ctypes.c_longlong)
+except (OSError, AttributeError):
+    libc_fallocate = None
+
 
 def flag2mode(flags):
     md = {os.O_RDONLY: 'rb', os.O_WRONLY: 'wb', os.O_RDWR: 'wb+'}
@@ -51,6 +62,9 @@ class Xmp(Fuse):
         #import thread
         #thread.start_new_thread(self.mythread, ())
         self.root = '/'
+        self.stats_file = None
+        self.trace_file = None
+        self.buf_io = None
 
 #    def mythread(self):
 #
@@ -70,8 +84,7 @@ class Xmp(Fuse):
         return os.readlink("." + path)
 
     def readdir(self, path, offset):
-        for e in os.listdir("." + path):
-            yield fuse.Direntry(e)
+        return os.listdir("." + path)
 
     def unlink(self, path):
         os.unlink("." + path)
@@ -162,10 +175,36 @@ class Xmp(Fuse):
 
     def fsinit(self):
         os.chdir(self.root)
+        if self.trace_file:
+            Thread(target=self.trace_on_signal, daemon=True).start()
+
+    def fsdestroy(self):
+        if self.stats_file:
+            with open(self.stats_file, 'w') as f:
+                json.dump(self.GetStats(), f, indent=1)
+        if self.trace_file:
+            self.DumpTrace(self.trace_file)
+
+    def trace_on_signal(self):
+        # SIGUSR2 is blocked (cf. main), so we can wait for it here
+        while True:
+            signal.sigwait({signal.SIGUSR2})
+            self.DumpTrace(self.trace_file)
 
     class XmpFile(object):
 
+        # os.pwrite() is happy with a memoryview, no need for a bytes copy
+        write_memoryview = True
+
+        # Set with writeback_cache, when the kernel reads files opened
+        # write-only (to fill the pages written to) and sees to O_APPEND.
+        writeback = False
+
         def __init__(self, path, flags, *mode):
+            if self.writeback:
+                if flags & os.O_ACCMODE == os.O_WRONLY:
+                    flags = flags & ~os.O_ACCMODE | os.O_RDWR
+                flags &= ~os.O_APPEND
             self.file = os.fdopen(os.open("." + path, flags, *mode),
                                   flag2mode(flags))
             self.fd = self.file.fileno()
@@ -185,6 +224,21 @@ class Xmp(Fuse):
             else:
                 return os.pread(self.fd, length, offset)
 
+        def readinto(self, buf, offset):
+            # Lets the data land directly in the buffer FUSE has set up
+            # for the reply, sparing a temporary bytes object.
+            if self.iolock or not hasattr(os, 'preadv'):
+                if self.iolock:
+                    self.iolock.acquire()
+                try:
+                    self.file.seek(offset)
+                    return self.file.readinto(buf)
+                finally:
+                    if self.iolock:
+                        self.iolock.release()
+            else:
+                return os.preadv(self.fd, [buf], offset)
+
         def write(self, buf, offset):
             if self.iolock:
                 self.iolock.acquire()
@@ -197,6 +251,33 @@ class Xmp(Fuse):
             else:
                 return os.pwrite(self.fd, buf, offset)
 
+        # If the FUSE lib knows of them (API 29 and up), read_buf and
+        # write_buf take precedence over the above data passing methods.
+        # With the buf_io option, they are put in place (cf. main): we just
+        # point FUSE at our file descriptor and let it move the data on
+        # its own (by splicing, if the kernel can do that), so the data
+        # does not pass through Python at all. (With buf_io=bytes,
+        # read_buf returns the data instead, as it may.)
+
+        def _read_buf_fd(self, size, offset):
+            return (self.fd, offset, size)
+
+        def _read_buf_bytes(self, size, offset):
+            return os.pread(self.fd, size, offset)
+
+        def _write_buf_fd(self, size, offset):
+            return (self.fd, offset)
+
+        # With copy_file_range (libfuse 3.4 and up), copying between files
+        # (as cp does) is left to the underlying filesystem, which may
+        # even share the blocks, instead of the data coming up here
+        # through read and going back through write.
+        if hasattr(os, 'copy_file_range'):
+            def copy_file_range(self, offset_in, path_out, fh_out,
+                                offset_out, length, flags):
+                return os.copy_file_range(self.fd, fh_out.fd, length,
+                                          offset_in, offset_out)
+
         def release(self, flags):
             self.file.close()
 
@@ -222,6 +303,20 @@ class Xmp(Fuse):
         def ftruncate(self, len):
             self.file.truncate(len)
 
+        def fallocate(self, mode, offset, length):
+            if libc_fallocate:
+                if libc_fallocate(self.fd, mode, offset, length) < 0:
+                    return -ctypes.get_errno()
+            elif mode == 0:
+                os.posix_fallocate(self.fd, offset, length)
+            else:
+                return -EOPNOTSUPP
+
+        def lseek(self, offset, whence):
+            # SEEK_DATA or SEEK_HOLE (with libfuse 3.8 and up), so that
+            # holes of sparse files needn't be read to be found
+            return os.lseek(self.fd, offset, whence)
+
         def lock(self, cmd, owner, **kw):
             # The code here is much rather just a demonstration of the locking
             # API than something which actually was seen to be useful.
@@ -266,6 +361,12 @@ class Xmp(Fuse):
     def main(self, *a, **kw):
 
         self.file_class = self.XmpFile
+        self.XmpFile.writeback = bool(self.writeback_cache) and \
+                                 fuse.APIVersion() >= fuse.feature_needs('writeback_cache')
+        if self.buf_io:
+            self.file_class = type('XmpBufFile', (self.XmpFile,), {
+                'read_buf': getattr(self.XmpFile, '_read_buf_' + self.buf_io),
+                'write_buf': self.XmpFile._write_buf_fd})
 
         return Fuse.main(self, *a, **kw)
 
@@ -283,7 +384,52 @@ Userspace nullfs-alike: mirror the filesystem tree from some point on.
 
     server.parser.add_option(mountopt="root", metavar="PATH", default='/',
                              help="mirror filesystem from under PATH [default: %default]")
+    server.parser.add_option(mountopt="path_cache_size", metavar="N",
+                             default=1024,
+                             help="cache the objects of N recently used paths [default: %default]")
+    server.parser.add_option(mountopt="attr_cache_ttl", metavar="SECS",
+                             default=0,
+                             help="cache attributes for SECS seconds [default: %default]")
+    server.parser.add_option(mountopt="block_cache_memory", metavar="BYTES",
+                             default=0,
+                             help="cache up to BYTES of file data, with read-ahead [default: %default]")
+    server.parser.add_option(mountopt="write_buffer_size", metavar="BYTES",
+                             default=0,
+                             help="collect adjacent writes of up to BYTES [default: %default]")
+    server.parser.add_option(mountopt="write_buffer_age", metavar="SECS",
+                             default=1,
+                             help="hold back writes for at most SECS seconds [default: %default]")
+    server.parser.add_option(mountopt="stats_file", metavar="PATH",
+                             help="write op statistics to PATH on unmount")
+    server.parser.add_option(mountopt="trace_size", metavar="N", default=0,
+                             help="trace the last N requests [default: %default]")
+    server.parser.add_option(mountopt="trace_file", metavar="PATH",
+                             help="write the trace to PATH on SIGUSR2 and on unmount")
+    server.parser.add_option(mountopt="max_threads", metavar="N", default=0,
+                             help="serve with N threads at most (0: no limit) [default: %default]")
+    server.parser.add_option(mountopt="max_idle_threads", metavar="N",
+                             default=10,
+                             help="keep N idle threads at most [default: %default]")
+    server.parser.add_option(mountopt="stack_size", metavar="BYTES", default=0,
+                             help="stack size of the threads (0: default) [default: %default]")
+    server.parser.add_option(mountopt="gil_aware", action="store_true",
+                             help="don't start threads just to wait for the GIL")
+    server.parser.add_option(mountopt="clone_fd", action="store_true",
+                             help="read requests through a /dev/fuse fd per thread (libfuse 3)")
+    server.parser.add_option(mountopt="writeback_cache", action="store_true",
+                             help="let the kernel cache writes (libfuse 3)")
+    server.parser.add_option(mountopt="readdirplus", action="store_true",
+                             help="send attributes along with directory entries (libfuse 3)")
+    server.parser.add_option(mountopt="buf_io", metavar="fd|bytes",
+                             choices=("fd", "bytes"),
+                             help="pass data with read_buf and write_buf, as fd ranges "
+                                  "or (for reads) bytes, instead of readinto and write")
     server.parse(values=server, errex=1)
+    if server.stats_file:
+        server.stats_file = os.path.abspath(server.stats_file)
+    if server.trace_file:
+        server.trace_file = os.path.abspath(server.trace_file)
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR2})
 
     try:
         if server.fuse_args.mount_expected():
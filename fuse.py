@@ -19,12 +19,31 @@ except:
 
 import sys
 import os
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import functools
+import json
+import pickle
+import queue
+import threading
+import time
 from errno import *
 from os import environ
 import re
 from fuseparts import __version__
 from fuseparts._fuse import main, FuseGetContext, FuseInvalidate, FuseNotifyPoll
+from fuseparts._fuse import FusePathCacheStats, FuseAttrCacheStats
+from fuseparts._fuse import FuseGetStats, FuseResetStats, FuseGetTrace
+from fuseparts._fuse import FuseSlotTake
+from fuseparts._fuse import lowlevel_main, FuseInvalidateInode, FuseInvalidateEntry
+from fuseparts._fuse import FUSE_SET_ATTR_MODE, FUSE_SET_ATTR_UID, \
+     FUSE_SET_ATTR_GID, FUSE_SET_ATTR_SIZE, FUSE_SET_ATTR_ATIME, \
+     FUSE_SET_ATTR_MTIME, FUSE_SET_ATTR_ATIME_NOW, FUSE_SET_ATTR_MTIME_NOW
 from fuseparts._fuse import FuseError, FuseAPIVersion
+from fuseparts._fuse import Stat as _Stat
+from fuseparts._fuse import FileMethod
 from fuseparts.subbedopts import SubOptsHive, SubbedOptFormatter
 from fuseparts.subbedopts import SubbedOptIndentedFormatter, SubbedOptParse
 from fuseparts.subbedopts import SUPPRESS_HELP, OptParseError
@@ -351,6 +370,11 @@ class FuseOptParse(SubbedOptParse):
 
 
 class ErrnoWrapper(object):
+    """
+    Turns OSError raised by func into an errno return value. The handlers
+    passed to the C module don't need this anymore (it does the same on
+    its own), it's kept for code which makes use of it.
+    """
 
     def __init__(self, func):
         self.func = func
@@ -364,6 +388,842 @@ class ErrnoWrapper(object):
             return -detail
 
 
+# The context of the request served by the current coroutine, cf.
+# `AsyncWrapper` and `Fuse.GetContext`.
+_request_context = contextvars.ContextVar('fuse_request_context')
+
+class AsyncWrapper(object):
+    """
+    Wraps a filesystem method which may be a coroutine function. The
+    coroutines are run on `loop`, and the result is either waited for
+    (that's what the high-level API can do), or the
+    `concurrent.futures.Future` of it is returned, which the low-level
+    API can reply to when it's done, without keeping a thread waiting.
+
+    Within the coroutine, `Fuse.GetContext` gives the context of the
+    request, and OSError is turned into an errno return value just like
+    by `ErrnoWrapper`.
+    """
+
+    def __init__(self, func, loop, wait=True):
+        self.func = func
+        self.loop = loop
+        self.wait = wait
+
+    def __call__(self, *args, **kw):
+        res = self.func(*args, **kw)
+        if not asyncio.iscoroutine(res):
+            return res
+
+        fut = asyncio.run_coroutine_threadsafe(
+                  self._run(res, FuseGetContext(None)), self.loop)
+        if self.wait:
+            return fut.result()
+        return fut
+
+    async def _run(self, coro, context):
+        _request_context.set(context)
+        try:
+            return await coro
+        except (IOError, OSError) as detail:
+            if hasattr(detail, "errno"): detail = detail.errno
+            return -detail
+
+
+class _SyncLookup(object):
+    """
+    `lookup` as called for readdirplus in event loop mode: should it give
+    a coroutine after all, that's closed without being run, and the entry
+    goes without attributes.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        res = self.func(*args)
+        if asyncio.iscoroutine(res):
+            res.close()
+            return None
+        return res
+
+
+class BlockCache(object):
+    """
+    Cache of file data in blocks of `block_size` bytes, for file classes
+    whose `read` is expensive. At most `memory` bytes are kept, least
+    recently used blocks going first.
+
+    Blocks are read by the `read` method of the file objects. When a file
+    object is read sequentially, the next `readahead` blocks are read in
+    advance by a pool of `threads` threads (so `read` has to cope with
+    being called from several threads at once, as in multithreaded mode).
+
+    Blocks belong to the file object which read them, and are dropped when
+    it's released, unless it has a true `keep_cache` attribute: then they
+    are shared with other such file objects of the same path, and stay
+    around. Writes, truncation, renaming and unlinking through the
+    filesystem drop the blocks of the paths concerned.
+    """
+
+    def __init__(self, memory, block_size=128 << 10, readahead=4,
+                 threads=2, loop=None):
+        self.memory = memory
+        self.block_size = block_size
+        self.readahead = readahead
+        self.loop = loop
+        self.pool = None
+        if readahead > 0 and threads > 0:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                          max_workers=threads,
+                          thread_name_prefix='fuse-readahead')
+        self.lock = threading.Lock()
+        # (key, index) -> block, least recently used first, where key is
+        # (path, None) for shared blocks, (path, id(fh)) for others
+        self.blocks = collections.OrderedDict()
+        self.used = 0
+        self.paths = {}         # path -> set of (key, index) in blocks
+        self.gens = {}          # path -> count of invalidations
+        self.pending = {}       # (key, index) -> Future of read-ahead
+        self.streams = {}       # id(fh) -> [end of last read, Futures]
+        self.stats = dict.fromkeys(('hits', 'misses', 'readahead',
+                                    'evictions', 'invalidations'), 0)
+
+    def getstats(self):
+        with self.lock:
+            stats = dict(self.stats, size=len(self.blocks), memory=self.used)
+        return stats
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+
+    # The following ones are to be called with the lock held.
+
+    def _put(self, ck, block, gen):
+        path = ck[0][0]
+        # it might have been read before a change
+        if self.gens.get(path, 0) != gen:
+            return
+        # the file object is gone
+        if ck[0][1] is not None and ck[0][1] not in self.streams:
+            return
+        self._drop((ck,))
+        self.blocks[ck] = block
+        self.used += len(block)
+        self.paths.setdefault(path, set()).add(ck)
+        while self.used > self.memory:
+            self._drop((next(iter(self.blocks)),))
+            self.stats['evictions'] += 1
+
+    def _drop(self, cks):
+        for ck in list(cks):
+            block = self.blocks.pop(ck, None)
+            if block is None:
+                continue
+            self.used -= len(block)
+            s = self.paths[ck[0][0]]
+            s.discard(ck)
+            if not s:
+                del self.paths[ck[0][0]]
+
+    def _invalidate(self, path):
+        self.gens[path] = self.gens.get(path, 0) + 1
+        self._drop(self.paths.get(path, ()))
+        self.stats['invalidations'] += 1
+
+    # Reading.
+
+    def _fetch(self, fh, index):
+        res = fh.read(self.block_size, index * self.block_size)
+        if self.loop and asyncio.iscoroutine(res):
+            res = asyncio.run_coroutine_threadsafe(res, self.loop).result()
+        if isinstance(res, (int, bytes)):
+            return res
+        return bytes(res)
+
+    def _prefetch(self, ck, fh, gen):
+        try:
+            block = self._fetch(fh, ck[1])
+        except Exception:
+            block = None
+        with self.lock:
+            del self.pending[ck]
+            if isinstance(block, bytes):
+                self._put(ck, block, gen)
+                self.stats['readahead'] += 1
+
+    def _block(self, ck, fh):
+        while True:
+            with self.lock:
+                block = self.blocks.get(ck)
+                if block is not None:
+                    self.blocks.move_to_end(ck)
+                    self.stats['hits'] += 1
+                    return block
+                fut = self.pending.get(ck)
+                if not fut:
+                    self.stats['misses'] += 1
+                    gen = self.gens.get(ck[0][0], 0)
+                    break
+            # it's on its way
+            concurrent.futures.wait((fut,))
+
+        block = self._fetch(fh, ck[1])
+        if isinstance(block, bytes):
+            with self.lock:
+                self._put(ck, block, gen)
+        return block
+
+    def _read_ahead(self, key, fh, stream, end):
+        first = end // self.block_size
+        gen = self.gens.get(key[0], 0)
+        for index in range(first, first + self.readahead):
+            ck = (key, index)
+            if ck in self.blocks or ck in self.pending:
+                continue
+            fut = self.pool.submit(self._prefetch, ck, fh, gen)
+            self.pending[ck] = fut
+            stream[1].add(fut)
+            fut.add_done_callback(stream[1].discard)
+
+    # The handlers.
+
+    def read(self, path, size, offset, fh):
+        bs = self.block_size
+        if getattr(fh, 'keep_cache', False):
+            key = (path, None)
+        else:
+            key = (path, id(fh))
+        with self.lock:
+            stream = self.streams.setdefault(id(fh), [0, set()])
+
+        chunks = []
+        for index in range(offset // bs, (offset + size - 1) // bs + 1):
+            block = self._block((key, index), fh)
+            if isinstance(block, int):
+                return block
+            chunks.append(block)
+            if len(block) < bs:
+                break
+
+        with self.lock:
+            # a read where the previous one ended is taken as sequential
+            if stream[0] == offset and self.pool:
+                self._read_ahead(key, fh, stream, offset + size)
+            stream[0] = offset + size
+
+        start = offset % bs
+        if len(chunks) == 1:
+            return chunks[0][start:start + size]
+        return b''.join(chunks)[start:start + size]
+
+    def release(self, path, fh):
+        with self.lock:
+            stream = self.streams.pop(id(fh), None)
+        if not stream:
+            return
+        # the file object is to be closed, don't let read-ahead use it
+        concurrent.futures.wait(list(stream[1]))
+        with self.lock:
+            self._drop([ck for ck in self.paths.get(path, ())
+                        if ck[0][1] == id(fh)])
+
+    def invalidate(self, path, tree=False):
+        with self.lock:
+            self._invalidate(path)
+            if tree:
+                prefix = path.rstrip('/') + '/'
+                for p in [p for p in self.paths if p.startswith(prefix)]:
+                    self._invalidate(p)
+
+    def install(self, d):
+        """Hook into the handlers `d` of `Fuse.main`."""
+
+        # these would take precedence over read
+        d.pop('readinto', None)
+        d.pop('read_buf', None)
+        d['read'] = self.read
+
+        def invalidating(fun, npaths=1, tree=False):
+            def wrap(*a, **kw):
+                try:
+                    return fun(*a, **kw)
+                finally:
+                    for path in a[:npaths]:
+                        self.invalidate(path, tree)
+            return wrap
+
+        for a in ('write', 'write_buf', 'truncate', 'ftruncate', 'unlink',
+                  'fallocate'):
+            if a in d:
+                d[a] = invalidating(d[a])
+        if 'rename' in d:
+            d['rename'] = invalidating(d['rename'], 2, True)
+
+        copy = d.get('copy_file_range')
+        if copy:
+            def wrap(path, offset, path_out, *a):
+                try:
+                    return copy(path, offset, path_out, *a)
+                finally:
+                    self.invalidate(path_out)
+            d['copy_file_range'] = wrap
+
+        open_ = d.get('open')
+        if open_:
+            def wrap(path, flags, *a):
+                if flags & os.O_TRUNC:
+                    self.invalidate(path)
+                return open_(path, flags, *a)
+            d['open'] = wrap
+
+        release = d.get('release')
+        def wrap(path, flags, *fh):
+            if fh:
+                self.release(path, fh[0])
+            if release:
+                return release(path, flags, *fh)
+        d['release'] = wrap
+
+
+class WriteBuffer(object):
+    """
+    Buffer for the writes to file objects, which collects adjacent (or
+    overlapping) writes into extents and passes them on to the `write`
+    handler in one go.
+
+    An extent is written out when it reaches `size` bytes, when a write
+    elsewhere in the file comes, when the file is flushed, fsync'd,
+    truncated or released, when it's read (or getattr'd), or when it's
+    been dirty for `age` seconds (if `age` is not 0). If the extents of
+    all file objects take more than `memory` bytes, the oldest ones are
+    written out.
+
+    An error from writing out an extent is reported by the next `flush`
+    or `fsync` of the file object.
+    """
+
+    class _File(object):
+
+        def __init__(self, path, fh):
+            self.path = path
+            self.fh = fh
+            self.lock = threading.Lock()
+            self.data = None
+            self.offset = 0
+            self.since = 0
+            self.error = 0
+
+    def __init__(self, size, memory=16 << 20, age=0):
+        self.size = size
+        self.memory = memory
+        self.age = age
+        self.write = None
+        self.lock = threading.Condition()
+        self.files = {}         # id(fh) -> _File
+        self.dirty = 0
+        self.closed = False
+        self.flusher = None
+        self.stats = dict.fromkeys(('writes', 'flushes', 'bytes', 'errors'),
+                                   0)
+
+    def getstats(self):
+        with self.lock:
+            stats = dict(self.stats, dirty=self.dirty)
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        if self.flusher:
+            self.flusher.join()
+        self._flush_old(time.monotonic())
+
+    def _flush(self, f):
+        """Write out the extent of `f`, with `f.lock` held."""
+
+        data, offset = f.data, f.offset
+        if data is None:
+            return
+        f.data = None
+        with self.lock:
+            self.dirty -= len(data)
+            self.stats['flushes'] += 1
+            self.stats['bytes'] += len(data)
+
+        view = memoryview(data)
+        while view:
+            try:
+                res = self.write(f.path, bytes(view), offset, f.fh)
+                if res < 0:
+                    raise OSError(-res, os.strerror(-res))
+                if res == 0:
+                    raise OSError(EIO, os.strerror(EIO))
+            except OSError as e:
+                f.error = e.errno or EIO
+                with self.lock:
+                    self.stats['errors'] += 1
+                return
+            view = view[res:]
+            offset += res
+
+    def _flush_old(self, deadline):
+        with self.lock:
+            old = [f for f in self.files.values()
+                   if f.data is not None and f.since <= deadline]
+        old.sort(key=lambda f: f.since)
+        for f in old:
+            with f.lock:
+                if f.since <= deadline:
+                    self._flush(f)
+            if deadline == float('inf') and self.dirty <= self.memory:
+                break
+
+    def _flusher(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                self.lock.wait(self.age / 4)
+            self._flush_old(time.monotonic() - self.age)
+
+    def sync(self, path, offset=0, size=None, tree=False):
+        """Write out the extents of `path` overlapping the given range."""
+
+        if not self.dirty:
+            return
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            files = [f for f in self.files.values() if f.data is not None and
+                     (f.path == path or tree and f.path.startswith(prefix))]
+        for f in files:
+            with f.lock:
+                if f.data is not None and (size is None or
+                     offset < f.offset + len(f.data) and
+                     f.offset < offset + size):
+                    self._flush(f)
+
+    # The handlers.
+
+    def write_buffered(self, path, buf, offset, fh):
+        with self.lock:
+            f = self.files.get(id(fh))
+            if not f:
+                f = self.files[id(fh)] = self._File(path, fh)
+                if self.age and not self.flusher:
+                    self.flusher = threading.Thread(target=self._flusher,
+                                                    name='fuse-writeback',
+                                                    daemon=True)
+                    self.flusher.start()
+            self.stats['writes'] += 1
+
+        n = len(buf)
+        with f.lock:
+            if f.data is not None and \
+               f.offset <= offset <= f.offset + len(f.data):
+                grown = len(f.data)
+                start = offset - f.offset
+                f.data[start:start + n] = buf
+                grown = len(f.data) - grown
+            else:
+                self._flush(f)
+                if n >= self.size:
+                    return self.write(path, buf, offset, fh)
+                f.data = bytearray(buf)
+                f.offset = offset
+                f.since = time.monotonic()
+                grown = n
+            with self.lock:
+                self.dirty += grown
+            if len(f.data) >= self.size:
+                self._flush(f)
+
+        if self.dirty > self.memory:
+            self._flush_old(float('inf'))
+        return n
+
+    def flush(self, fh):
+        """Write out the extent of `fh`; return the pending error, if any."""
+
+        f = self.files.get(id(fh))
+        if not f:
+            return 0
+        with f.lock:
+            self._flush(f)
+            error, f.error = f.error, 0
+        return error
+
+    def release(self, fh):
+        self.flush(fh)
+        with self.lock:
+            self.files.pop(id(fh), None)
+
+    def install(self, d):
+        """Hook into the handlers `d` of `Fuse.main`."""
+
+        # writes pass through the buffer, not beside it
+        d.pop('write_buf', None)
+        self.write = d['write']
+        d['write'] = self.write_buffered
+
+        def syncing(fun, npaths=1, tree=False, rng=None):
+            def wrap(*a, **kw):
+                for path in a[:npaths]:
+                    if rng:
+                        self.sync(path, *rng(*a))
+                    else:
+                        self.sync(path, tree=tree)
+                return fun(*a, **kw)
+            return wrap
+
+        for a, rng in (('read', lambda p, size, off, *fh: (off, size)),
+                       ('read_buf', lambda p, size, off, *fh: (off, size)),
+                       ('readinto', lambda p, buf, off, *fh: (off, len(buf))),
+                       ('fallocate',
+                        lambda p, mode, off, length, *fh: (off, length))):
+            if a in d:
+                d[a] = syncing(d[a], rng=rng)
+        for a in ('getattr', 'fgetattr', 'truncate', 'ftruncate', 'open',
+                  'lseek'):
+            if a in d:
+                d[a] = syncing(d[a])
+        if 'rename' in d:
+            d['rename'] = syncing(d['rename'], 2, True)
+
+        copy = d.get('copy_file_range')
+        if copy:
+            def wrap(path, offset, path_out, fh_out, offset_out, length, *a):
+                self.sync(path, offset, length)
+                self.sync(path_out, offset_out, length)
+                return copy(path, offset, path_out, fh_out, offset_out,
+                            length, *a)
+            d['copy_file_range'] = wrap
+
+        def flushing(name):
+            fun = d.get(name)
+            def wrap(*a):
+                error = a[-1:] and self.flush(a[-1]) or 0
+                res = fun(*a) if fun else 0
+                return -error if error else res
+            d[name] = wrap
+
+        flushing('flush')
+        flushing('fsync')
+
+        release = d.get('release')
+        def wrap(path, flags, *fh):
+            if fh:
+                self.release(fh[0])
+            if release:
+                return release(path, flags, *fh)
+        d['release'] = wrap
+
+
+# set by a running InterpreterPool or ProcessPool, cf. offload
+_offload_pool = None
+
+def offload(func):
+    """
+    Decorator for functions of your filesystem module which do CPU-bound
+    work, like compressing or hashing data. If the filesystem has an
+    `InterpreterPool` (cf. `Fuse.interpreters`) or a `ProcessPool` (cf.
+    `Fuse.processes`) running, a call is run in one of its
+    sub-interpreters, each of which has its own GIL, or processes, so the
+    worker thread making the call doesn't keep the others waiting for the
+    GIL. Otherwise, the function is simply called.
+
+    The function is looked up in its module by its qualified name, so it
+    has to be at the top level of the module (or be a static method of a
+    class there). Its arguments and result (or exception) are pickled.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        pool = _offload_pool
+        if pool is None:
+            return func(*args, **kw)
+        return pool.call(wrapper, *args, **kw)
+
+    return wrapper
+
+
+class InterpreterPool(object):
+    """
+    Pool of `size` sub-interpreters with their own GIL (Python 3.12 and
+    later), to run functions in, on other cores than the main
+    interpreter. A call is routed to a free interpreter, waiting for one
+    if all of them are busy; the GIL of the main interpreter is released
+    while the function runs.
+
+    Each interpreter imports the modules named in `modules` when started,
+    and the module of any function it's asked to call; ``__main__`` stands
+    for the script run (which is executed under another name, so that it
+    doesn't start a filesystem). Interpreters share no objects: arguments
+    and results are pickled, and handed over through the slots of the C
+    module. State which the functions need to share with each other (or
+    with the main interpreter) has to be shared explicitly, in shared
+    memory, files and such.
+
+    `start` and `close` are to be called by the same thread: Python 3.12
+    hangs destroying an interpreter in which the threading module was
+    imported by another thread.
+    """
+
+    _setup = """if 1:
+        def _fuse_pool_setup(init):
+            import importlib, pickle, runpy, sys
+            from fuseparts._fuse import FuseSlotPut
+
+            slot, path, main_file, preload = pickle.loads(init)
+            sys.path[:] = path
+            modules = {}
+
+            def namespace(name):
+                if name not in modules:
+                    if name == '__main__':
+                        modules[name] = runpy.run_path(
+                            main_file, run_name='__fuse_pool__')
+                    else:
+                        modules[name] = vars(importlib.import_module(name))
+                return modules[name]
+
+            def call(data):
+                try:
+                    module, qualname, args, kw = pickle.loads(data)
+                    names = qualname.split('.')
+                    func = namespace(module)[names[0]]
+                    for name in names[1:]:
+                        func = getattr(func, name)
+                    res = (True, func(*args, **kw))
+                except BaseException as e:
+                    res = (False, e)
+                try:
+                    data = pickle.dumps(res, pickle.HIGHEST_PROTOCOL)
+                except Exception as e:
+                    if res[0]:
+                        e = TypeError("can't pickle the result of %s: %s" %
+                                      (qualname, e))
+                    else:
+                        e = RuntimeError("%s: %s" % (type(res[1]).__name__,
+                                                     res[1]))
+                    data = pickle.dumps((False, e))
+                FuseSlotPut(slot, data)
+
+            for name in preload:
+                namespace(name)
+            return call
+
+        _fuse_pool_call = _fuse_pool_setup(_fuse_pool_init)
+        del _fuse_pool_setup
+    """
+
+    def __init__(self, size, modules=()):
+        if sys.version_info < (3, 12):
+            raise FuseError("sub-interpreters with their own GIL need "
+                            "Python 3.12 or later")
+        if not 0 < size <= 256:
+            raise ValueError("an interpreter pool can have 1 to 256 "
+                             "interpreters")
+        try:
+            import _interpreters as interpreters
+        except ImportError:
+            import _xxsubinterpreters as interpreters
+        self.interpreters = interpreters
+        self.size = size
+        self.modules = list(modules)
+        self.ids = []
+        self.free = None
+
+    def _run(self, iid, script, shared):
+        if not hasattr(self.interpreters, 'exec'):
+            # 3.12, raises an exception if the script fails
+            return self.interpreters.run_string(iid, script, shared)
+        err = self.interpreters.exec(iid, script, shared)
+        if err is not None:
+            raise RuntimeError(err.formatted)
+
+    def start(self):
+        global _offload_pool
+
+        main = sys.modules.get('__main__')
+        main_file = getattr(main, '__file__', None)
+        if main_file:
+            main_file = os.path.abspath(main_file)
+
+        self.free = queue.SimpleQueue()
+        try:
+            for slot in range(self.size):
+                iid = self.interpreters.create()
+                self.ids.append(iid)
+                init = pickle.dumps((slot, sys.path, main_file, self.modules))
+                self._run(iid, self._setup, {'_fuse_pool_init': init})
+                self.free.put(slot)
+        except BaseException:
+            self.close()
+            raise
+        _offload_pool = self
+
+    def call(self, func, *args, **kw):
+        """Call `func` (cf. `offload`) in a free interpreter."""
+
+        args = tuple(bytes(a) if isinstance(a, memoryview) else a
+                     for a in args)
+        data = pickle.dumps((func.__module__, func.__qualname__, args, kw),
+                            pickle.HIGHEST_PROTOCOL)
+        slot = self.free.get()
+        try:
+            self._run(self.ids[slot], '_fuse_pool_call(_fuse_pool_args)',
+                      {'_fuse_pool_args': data})
+            ok, res = pickle.loads(FuseSlotTake(slot))
+        finally:
+            self.free.put(slot)
+        if not ok:
+            raise res
+        return res
+
+    def close(self):
+        global _offload_pool
+
+        if _offload_pool is self:
+            _offload_pool = None
+        while self.ids:
+            self.interpreters.destroy(self.ids.pop())
+
+
+# bytes at offset:offset + size in the shared memory of a ProcessPool call
+_Shared = collections.namedtuple('_Shared', 'offset size')
+
+# the shared memory blocks attached in a ProcessPool worker, by name
+_process_memory = {}
+
+def _process_call(name, func, args, kw):
+    """Call `func` in a `ProcessPool` worker, with the memory `name`."""
+
+    from multiprocessing import shared_memory
+
+    shm = _process_memory.get(name)
+    if shm is None:
+        shm = _process_memory[name] = shared_memory.SharedMemory(name)
+    buf = shm.buf
+    args = [bytes(buf[a.offset:a.offset + a.size]) if type(a) is _Shared
+            else a for a in args]
+    res = func(*args, **kw)
+    if isinstance(res, (bytes, bytearray)) and len(res) <= shm.size:
+        buf[:len(res)] = res
+        return _Shared(0, len(res))
+    return res
+
+
+class ProcessPool(object):
+    """
+    Pool of `size` worker processes (in a
+    `concurrent.futures.ProcessPoolExecutor`) to run functions in, on
+    other cores than the filesystem, with no GIL in common. A call waits
+    for the result with the GIL released.
+
+    Each call in flight (at most `size` of them, more calls wait for
+    one to finish) has a block of `buffer_size` bytes of shared memory,
+    through which bytes-like arguments and a bytes result are handed
+    over: the caller copies the arguments into the block and the worker
+    copies them out as bytes, and the result the other way round, instead
+    of pickling them and sending them through a pipe. What doesn't fit
+    in the block, and any other argument, result or exception, is pickled.
+
+    The processes are started on the first call (so after the FUSE
+    library has daemonized, which they wouldn't survive), by spawning
+    new interpreters, as forking a process with FUSE threads is unsafe.
+    They import the modules of the functions they're asked to call; the
+    script run is imported as ``__mp_main__``, so it doesn't start a
+    filesystem (as long as it checks for ``__name__ == '__main__'``).
+    """
+
+    def __init__(self, size, buffer_size=1 << 20):
+        # multiprocessing resolves the script of the workers against the
+        # directory it was imported in, so that's to be done before the
+        # FUSE library daemonizes, which changes to /
+        import multiprocessing.shared_memory
+
+        if size <= 0:
+            raise ValueError("a process pool needs at least one process")
+        self.size = size
+        self.buffer_size = buffer_size
+        self.context = multiprocessing.get_context('spawn')
+        self.lock = threading.Lock()
+        self.executor = None
+        self.memory = []
+        self.free = None
+
+    def start(self):
+        global _offload_pool
+
+        _offload_pool = self
+
+    def _start(self):
+        from multiprocessing import shared_memory
+
+        with self.lock:
+            if self.executor:
+                return
+            free = queue.SimpleQueue()
+            try:
+                for i in range(self.size):
+                    shm = shared_memory.SharedMemory(create=True,
+                                                     size=self.buffer_size)
+                    self.memory.append(shm)
+                    free.put(shm)
+            except BaseException:
+                self._release()
+                raise
+            self.free = free
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.size, mp_context=self.context)
+
+    def _release(self):
+        while self.memory:
+            shm = self.memory.pop()
+            shm.close()
+            shm.unlink()
+
+    def call(self, func, *args, **kw):
+        """Call `func` (cf. `offload`) in a worker process."""
+
+        if self.executor is None:
+            self._start()
+        shm = self.free.get()
+        try:
+            buf, off, shared = shm.buf, 0, []
+            for a in args:
+                if isinstance(a, (bytes, bytearray, memoryview)):
+                    m = memoryview(a)
+                    if m.c_contiguous and off + m.nbytes <= len(buf):
+                        buf[off:off + m.nbytes] = m.cast('B')
+                        a = _Shared(off, m.nbytes)
+                        off += m.nbytes
+                    elif isinstance(a, memoryview):
+                        a = a.tobytes()
+                shared.append(a)
+            res = self.executor.submit(_process_call, shm.name, func,
+                                       shared, kw).result()
+            if type(res) is _Shared:
+                res = bytes(buf[res.offset:res.offset + res.size])
+        finally:
+            self.free.put(shm)
+        return res
+
+    def close(self):
+        global _offload_pool
+
+        if _offload_pool is self:
+            _offload_pool = None
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown()
+                self.executor = None
+            self._release()
+
+
 ########### Custom objects for transmitting system structures to FUSE
 
 class FuseStruct(object):
@@ -373,10 +1233,13 @@ class FuseStruct(object):
              setattr(self, k, kw[k])
 
 
-class Stat(FuseStruct):
+class Stat(_Stat, FuseStruct):
     """
     Auxiliary class which can be filled up stat attributes.
     The attributes are undefined by default.
+
+    The stat attributes are kept in fixed slots, which lets the C code
+    pick them up faster than from an arbitrary object.
     """
 
     def __init__(self, **kw):
@@ -393,6 +1256,23 @@ class Stat(FuseStruct):
 
         FuseStruct.__init__(self, **kw)
 
+    # the slots are not seen by the default pickle/copy machinery
+
+    _slots = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid',
+              'st_size', 'st_atime', 'st_mtime', 'st_ctime', 'st_rdev',
+              'st_blksize', 'st_blocks')
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for k in self._slots:
+            if hasattr(self, k):
+                state[k] = getattr(self, k)
+        return state
+
+    def __setstate__(self, state):
+        for k in state:
+            setattr(self, k, state[k])
+
 
 class StatVfs(FuseStruct):
     """
@@ -439,6 +1319,10 @@ class Direntry(FuseStruct):
     Note that Python's standard directory reading interface is
     stateless and provides only names, so the above optional
     attributes doesn't make sense in that context.
+
+    readdir can also return bare names or (name, ino, type, offset)
+    tuples instead of Direntry instances, which is cheaper for big
+    directories.
     """
 
     def __init__(self, name, **kw):
@@ -451,6 +1335,40 @@ class Direntry(FuseStruct):
         FuseStruct.__init__(self, **kw)
 
 
+class Entry(FuseStruct):
+    """
+    Auxiliary class for carrying the result of a lookup (and of other
+    entry creating methods) in `LowLevelFuse`. Attributes:
+
+    ino
+        The inode number of the entry. 0 means a negative entry, ie.
+        the name does not exist (which is then cached by the kernel
+        for `entry_timeout`).
+
+    generation
+        Inode generation number, defaults to 0.
+
+    attr
+        The attributes of the inode (a stat object, as returned by
+        getattr). If its st_ino is 0, `ino` is used.
+
+    attr_timeout, entry_timeout
+        How long (in seconds) the kernel may cache the attributes and
+        the name lookup. None (the default) stands for the value of the
+        attributes of the same name of the `LowLevelFuse` instance.
+    """
+
+    def __init__(self, **kw):
+
+        self.ino           = 0
+        self.generation    = 0
+        self.attr          = None
+        self.attr_timeout  = None
+        self.entry_timeout = None
+
+        FuseStruct.__init__(self, **kw)
+
+
 class Flock(FuseStruct):
     """
     Class for representing flock structures (cf. fcntl(3)).
@@ -552,8 +1470,18 @@ def feature_needs(*feas):
             'has_lock':       26,
             'has_utimens':    26,
             'has_bmap':       26,
+            'has_readinto':   22,
+            'has_read_buf':   29,
+            'has_write_buf':  29,
             'has_init':       23,
             'has_destroy':    23,
+            'lowlevel':       26,
+            'clone_fd':       300,
+            'writeback_cache': 300,
+            'readdirplus':    300,
+            'has_fallocate':  29,
+            'has_copy_file_range': 304,
+            'has_lseek':      308,
             '*':              r'!re:^\*$'}
 
     if not feas:
@@ -645,10 +1573,107 @@ class Fuse(object):
               'statfs', 'fsync', 'create', 'opendir', 'releasedir', 'fsyncdir',
               'flush', 'fgetattr', 'ftruncate', 'getxattr', 'listxattr',
               'setxattr', 'removexattr', 'access', 'lock', 'utimens', 'bmap',
-              'fsinit', 'fsdestroy', 'ioctl', 'poll']
+              'fsinit', 'fsdestroy', 'ioctl', 'poll', 'readinto',
+              'read_buf', 'write_buf', 'copy_file_range', 'fallocate',
+              'lseek']
 
     fusage = "%prog [mountpoint] [options]"
 
+    # If true, `write` gets a read-only memoryview of the data instead of a
+    # bytes object. The view is only valid for the duration of the call.
+    # A `file_class` can override this with its own `write_memoryview`
+    # attribute.
+    write_memoryview = False
+
+    # Number of path objects to keep in the path cache (0 disables it).
+    # While a path is cached, requests to it get the same str object.
+    path_cache_size = 0
+
+    # Seconds to keep getattr and fgetattr results for (0 disables it), in
+    # a cache which takes at most `attr_cache_memory` bytes, least recently
+    # used entries going first. Cached attributes are served without
+    # calling `getattr`. Entries are dropped when an operation (write,
+    # truncate, chmod, rename, unlink...) changes the file, so only changes
+    # made in other ways can go unnoticed, until the entry expires, or
+    # `Invalidate` is called.
+    attr_cache_ttl = 0
+    attr_cache_memory = 4 << 20
+
+    # Bytes of file data to keep in a `BlockCache` (0 disables it), read
+    # in blocks of `block_cache_blocksize` bytes by the `read` method of
+    # `file_class`, with `block_cache_readahead` blocks read in advance by
+    # `block_cache_threads` threads when a file is read sequentially.
+    block_cache_memory = 0
+    block_cache_blocksize = 128 << 10
+    block_cache_readahead = 4
+    block_cache_threads = 2
+    block_cache = None
+
+    # Bytes of adjacent writes to a `file_class` object to collect in a
+    # `WriteBuffer` before passing them on to `write` in one go (0 disables
+    # it). At most `write_buffer_memory` bytes are held back, for at most
+    # `write_buffer_age` seconds.
+    write_buffer_size = 0
+    write_buffer_memory = 16 << 20
+    write_buffer_age = 1.0
+    write_buffer = None
+
+    # Number of sub-interpreters in an `InterpreterPool` to run the
+    # functions decorated with `offload` in (0 disables it).
+    interpreters = 0
+    interpreter_pool = None
+
+    # Number of worker processes in a `ProcessPool` to run the functions
+    # decorated with `offload` in, if `interpreters` is not set (0 disables
+    # it). Bytes arguments and results of up to `process_buffer_size` bytes
+    # in all are passed through shared memory.
+    processes = 0
+    process_buffer_size = 1 << 20
+    process_pool = None
+
+    # Number of requests to keep in the trace buffer (0 disables it), cf.
+    # `DumpTrace`.
+    trace_size = 0
+
+    # Settings of the multithreaded loop, which starts a worker thread
+    # whenever a request comes in and no worker is left idle. It starts
+    # at most `max_threads` of them (0 for no limit), keeps at most
+    # `max_idle_threads` idle ones (-1 keeps all), and gives them stacks
+    # of `stack_size` bytes (0 for the default). If `gil_aware` is set,
+    # no worker is started while enough others are waiting for the GIL
+    # to keep the cores busy: one, or with free-threaded builds, as many
+    # as there are CPUs.
+    max_threads = 0
+    max_idle_threads = 10
+    stack_size = 0
+    gil_aware = False
+
+    # Features of libfuse 3 (cf. `feature_assert`). With `clone_fd`, each
+    # worker thread reads requests from a /dev/fuse fd of its own; that
+    # takes the loop of libfuse, of the settings above only
+    # `max_idle_threads` applies then. With `writeback_cache`, the
+    # kernel caches writes, and sends them on in bigger chunks (files
+    # opened write-only can then get read too). With `readdirplus`, the
+    # attributes of the entries are sent along with a directory listing,
+    # sparing the kernel a lookup for each; libfuse gets them through
+    # `getattr` (`lookup` in the low-level API, except for coroutines),
+    # which then gets called for every entry listed.
+    clone_fd = False
+    writeback_cache = False
+    readdirplus = False
+
+    # An asyncio event loop to run the filesystem methods on which are
+    # coroutine functions (or return awaitables otherwise). This is set by
+    # `main_async`; if you set it yourself, it has to be run by some other
+    # thread than the one calling `main`.
+    event_loop = None
+
+    # If you define a `worker_init` method, it gets called (without
+    # arguments) once in each thread serving requests, before its first
+    # request. In multithreaded mode, a worker thread keeps its Python thread
+    # state for its whole lifetime, so thread local data set up here (or in
+    # any handler) persists between requests.
+
     def __init__(self, *args, **kw):
         """
         Not much happens here apart from initializing the `parser` attribute.
@@ -740,6 +1765,25 @@ class Fuse(object):
             if hasattr(self, t):
                 getattr(self.methproxy, 'set_' + t)(getattr(self,t))
 
+        fc = self.methproxy.file_class
+        if fc and hasattr(fc, 'write') and hasattr(fc, 'write_memoryview'):
+            d['write_memoryview'] = fc.write_memoryview and 1 or 0
+        else:
+            d['write_memoryview'] = self.write_memoryview and 1 or 0
+        d['path_cache_size'] = int(self.path_cache_size)
+        d['attr_cache_ttl'] = float(self.attr_cache_ttl)
+        d['attr_cache_memory'] = int(self.attr_cache_memory)
+        d['trace_size'] = int(self.trace_size)
+        d['max_threads'] = int(self.max_threads)
+        d['max_idle_threads'] = int(self.max_idle_threads)
+        d['stack_size'] = int(self.stack_size)
+        d['gil_aware'] = self.gil_aware and 1 or 0
+        d['clone_fd'] = self.clone_fd and 1 or 0
+        d['writeback_cache'] = self.writeback_cache and 1 or 0
+        d['readdirplus'] = self.readdirplus and 1 or 0
+        if hasattr(self, 'worker_init'):
+            d['worker_init'] = self.worker_init
+
         for a in self._attrs:
             b = a
             if get_compat_0_1() and a in self.compatmap:
@@ -748,13 +1792,61 @@ class Fuse(object):
                 c = ''
                 if get_compat_0_1() and hasattr(self, a + '_compat_0_1'):
                     c = '_compat_0_1'
-                d[a] = ErrnoWrapper(self.lowwrap(a + c))
+                d[a] = self.lowwrap(a + c)
+
+        if int(self.block_cache_memory) > 0 and fc and hasattr(fc, 'read'):
+            self.block_cache = BlockCache(int(self.block_cache_memory),
+                                          int(self.block_cache_blocksize),
+                                          int(self.block_cache_readahead),
+                                          int(self.block_cache_threads),
+                                          self.event_loop)
+            self.block_cache.install(d)
+        if int(self.write_buffer_size) > 0 and fc and hasattr(fc, 'write'):
+            self.write_buffer = WriteBuffer(int(self.write_buffer_size),
+                                            int(self.write_buffer_memory),
+                                            float(self.write_buffer_age))
+            self.write_buffer.install(d)
+        if int(self.interpreters) > 0:
+            self.interpreter_pool = InterpreterPool(int(self.interpreters),
+                                                    [type(self).__module__])
+        elif int(self.processes) > 0:
+            self.process_pool = ProcessPool(int(self.processes),
+                                            int(self.process_buffer_size))
 
         try:
+            if self.interpreter_pool:
+                self.interpreter_pool.start()
+            if self.process_pool:
+                self.process_pool.start()
             main(**d)
         except FuseError:
             if args or self.fuse_args.mount_expected():
                 raise
+        finally:
+            if self.process_pool:
+                self.process_pool.close()
+            if self.interpreter_pool:
+                self.interpreter_pool.close()
+            if self.write_buffer:
+                self.write_buffer.close()
+            if self.block_cache:
+                self.block_cache.close()
+
+    async def main_async(self, args=None):
+        """
+        Enter filesystem service loop from a coroutine. The service loop
+        is run in an executor thread, and the filesystem methods can be
+        coroutine functions, which are run on the running event loop, so
+        many requests can wait on I/O at the same time without a thread for
+        each. We stay in the foreground, as forking away from the event
+        loop would leave it behind.
+        """
+
+        self.event_loop = asyncio.get_running_loop()
+        if not args:
+            self.fuse_args.setmod('foreground')
+
+        return await self.event_loop.run_in_executor(None, self.main, args)
 
     def lowwrap(self, fname):
         """
@@ -769,6 +1861,8 @@ class Fuse(object):
         if it's an instance of FuseFileInfo.
         """
         fun = getattr(self, fname)
+        if self.event_loop:
+            fun = AsyncWrapper(fun, self.event_loop)
 
         if fname in ('open', 'create'):
             def wrap(*a, **kw):
@@ -788,14 +1882,80 @@ class Fuse(object):
         return wrap
 
     def GetContext(self):
+        context = _request_context.get(None)
+        if context is not None:
+            return context
         return FuseGetContext(self)
 
     def Invalidate(self, path):
+        if self.block_cache:
+            self.block_cache.invalidate(path)
         return FuseInvalidate(self, path)
 
     def NotifyPoll(self, pollhandle):
         return FuseNotifyPoll(pollhandle)
 
+    def PathCacheStats(self):
+        return FusePathCacheStats()
+
+    def AttrCacheStats(self):
+        return FuseAttrCacheStats()
+
+    def GetStats(self):
+        return FuseGetStats()
+
+    def ResetStats(self):
+        return FuseResetStats()
+
+    def GetTrace(self):
+        return FuseGetTrace()
+
+    def DumpTrace(self, path):
+        """
+        Write the requests in the trace buffer to `path` in the Chrome trace
+        event format (as understood by chrome://tracing and Perfetto), with
+        a slice for each request on the track of the thread serving it,
+        and within that, one for the time spent waiting for the GIL.
+        """
+
+        pid = os.getpid()
+        events = []
+        for n, (op, start, gil, end, res, fspath, ino, fh, uid, cpid, tid,
+                deferred) in enumerate(FuseGetTrace()):
+            args = {'result': res, 'uid': uid, 'pid': cpid,
+                    'gil_wait_us': (gil - start) / 1000}
+            if fspath is None:
+                args['ino'] = ino
+            else:
+                args['path'] = fspath
+            if fh:
+                args['fh'] = '0x%x' % fh
+            ev = {'name': op, 'cat': 'fuse', 'pid': pid, 'tid': tid,
+                  'ts': start / 1000}
+            if deferred:
+                # the thread went on meanwhile, so this is an async slice
+                events.append(dict(ev, ph='b', id=n, args=args))
+                events.append(dict(ev, ph='e', id=n, ts=end / 1000))
+            else:
+                events.append(dict(ev, ph='X', dur=(end - start) / 1000,
+                                   args=args))
+            if gil > start:
+                events.append(dict(ev, name='GIL wait', cat='gil', ph='X',
+                                   dur=(gil - start) / 1000))
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ns'}, f)
+
+    def BlockCacheStats(self):
+        if not self.block_cache:
+            return {}
+        return self.block_cache.getstats()
+
+    def WriteBufferStats(self):
+        if not self.write_buffer:
+            return {}
+        return self.write_buffer.getstats()
+
     def fuseoptref(cls):
         """
         Find out which options are recognized by the library.
@@ -849,13 +2009,8 @@ class Fuse(object):
 
         def __init__(self):
 
-            class mpx(object):
-               def __init__(self, name):
-                   self.name = name
-               def __call__(self, *a, **kw):
-                   return getattr(a[-1], self.name)(*(a[1:-1]), **kw)
-
-            self.proxyclass = mpx
+            # calls the method of the filehandle (the last argument)
+            self.proxyclass = FileMethod
             self.mdic = {}
             self.file_class = None
             self.dir_class = None
@@ -882,7 +2037,9 @@ class Fuse(object):
 
     Methproxy._add_class_type('file', ('open', 'create'),
                               ('read', 'write', 'fsync', 'release', 'flush',
-                               'fgetattr', 'ftruncate', 'lock'))
+                               'fgetattr', 'ftruncate', 'lock', 'readinto',
+                               'read_buf', 'write_buf', 'copy_file_range',
+                               'fallocate', 'lseek'))
     Methproxy._add_class_type('dir', ('opendir',),
                               ('readdir', 'fsyncdir', 'releasedir'))
 
@@ -998,3 +2155,132 @@ class Fuse(object):
 
 
     compatmap = {'readdir': 'getdir'}
+
+
+class LowLevelFuse(Fuse):
+    """
+    Python interface to the low-level (inode based) FUSE API.
+
+    Usage is the same as of `Fuse`, but the filesystem methods get inode
+    numbers instead of paths. The kernel does the path walking, with the
+    help of `lookup` (which maps a name in a directory to an `Entry`),
+    and caches the results: entries for `entry_timeout`, attributes for
+    `attr_timeout` seconds. The root directory has inode number 1.
+
+    Methods, with fh being the object returned by open, opendir or
+    create (only passed if it's not None):
+
+    - lookup(parent, name), mknod(parent, name, mode, rdev),
+      mkdir(parent, name, mode), symlink(target, parent, name),
+      link(ino, newparent, newname): return an `Entry`
+    - forget(ino, nlookup): the kernel dropped nlookup references to
+      the inode (which it got through returned entries)
+    - getattr(ino, [fh]): returns a stat object, or a (stat, attr_timeout)
+      pair
+    - setattr(ino, attr, to_set, [fh]): change the attributes selected
+      by the to_set bitmask (FUSE_SET_ATTR_* constants) to the values
+      in attr; returns the new attributes as getattr does
+    - readlink(ino), unlink(parent, name), rmdir(parent, name),
+      rename(parent, name, newparent, newname)
+    - open(ino, flags), opendir(ino): return a file handle object (or
+      None); create(parent, name, mode, flags) returns an `Entry`, or an
+      (`Entry`, file handle) pair
+    - read(ino, size, offset, [fh]), write(ino, buf, offset, [fh]),
+      flush(ino, [fh]), fsync(ino, datasync, [fh]),
+      release(ino, flags, [fh])
+    - readdir(ino, offset, [fh]): returns directory entries as in
+      `Fuse`, which should start at the one after `offset`; entries
+      without their own offset count from `offset` + 1
+    - releasedir(ino, [fh]), fsyncdir(ino, datasync, [fh])
+    - statfs(), access(ino, mask), getxattr(ino, name, size),
+      listxattr(ino, size), setxattr(ino, name, value, flags) (value is
+      bytes), removexattr(ino, name)
+    - fsinit(), fsdestroy()
+
+    With an `event_loop` (eg. when started by `main_async`), methods can
+    be coroutine functions. Their requests are replied to when the
+    coroutine is done, so the worker threads don't wait for them.
+
+    There are no file classes and no compat mode here.
+    """
+
+    _attrs = ['lookup', 'forget', 'getattr', 'setattr', 'readlink',
+              'mknod', 'mkdir', 'unlink', 'rmdir', 'symlink', 'rename',
+              'link', 'open', 'read', 'write', 'flush', 'release', 'fsync',
+              'opendir', 'readdir', 'releasedir', 'fsyncdir', 'statfs',
+              'setxattr', 'getxattr', 'listxattr', 'removexattr', 'access',
+              'create', 'fsinit', 'fsdestroy']
+
+    # Default cache timeouts (in seconds), for results which don't
+    # specify their own.
+    attr_timeout = 1.0
+    entry_timeout = 1.0
+
+    def main(self, args=None):
+        """Enter filesystem service loop."""
+
+        d = {'multithreaded': self.multithreaded and 1 or 0}
+        d['fuse_args'] = args or self.fuse_args.assemble()
+        d['write_memoryview'] = self.write_memoryview and 1 or 0
+        d['attr_timeout'] = float(self.attr_timeout)
+        d['entry_timeout'] = float(self.entry_timeout)
+        d['trace_size'] = int(self.trace_size)
+        d['max_threads'] = int(self.max_threads)
+        d['max_idle_threads'] = int(self.max_idle_threads)
+        d['stack_size'] = int(self.stack_size)
+        d['gil_aware'] = self.gil_aware and 1 or 0
+        d['clone_fd'] = self.clone_fd and 1 or 0
+        d['writeback_cache'] = self.writeback_cache and 1 or 0
+        d['readdirplus'] = self.readdirplus and 1 or 0
+        if hasattr(self, 'worker_init'):
+            d['worker_init'] = self.worker_init
+
+        if self.event_loop:
+            d['future_type'] = concurrent.futures.Future
+            # the view would be gone by the time the coroutine gets to it
+            if asyncio.iscoroutinefunction(getattr(self, 'write', None)):
+                d['write_memoryview'] = 0
+            # readdirplus can't wait for the lookups to be done, nor have
+            # them go on behind its back
+            lookup = getattr(self, 'lookup', None)
+            if asyncio.iscoroutinefunction(lookup):
+                d['readdirplus'] = 0
+            elif lookup:
+                d['readdirplus_lookup'] = _SyncLookup(lookup)
+
+        for a in self._attrs:
+            if hasattr(self, a):
+                fun = getattr(self, a)
+                if self.event_loop:
+                    # these can't be replied to later
+                    fun = AsyncWrapper(fun, self.event_loop,
+                                       a in ('fsinit', 'fsdestroy'))
+                d[a] = fun
+
+        if int(self.interpreters) > 0:
+            self.interpreter_pool = InterpreterPool(int(self.interpreters),
+                                                    [type(self).__module__])
+        elif int(self.processes) > 0:
+            self.process_pool = ProcessPool(int(self.processes),
+                                            int(self.process_buffer_size))
+
+        try:
+            if self.interpreter_pool:
+                self.interpreter_pool.start()
+            if self.process_pool:
+                self.process_pool.start()
+            lowlevel_main(**d)
+        except FuseError:
+            if args or self.fuse_args.mount_expected():
+                raise
+        finally:
+            if self.process_pool:
+                self.process_pool.close()
+            if self.interpreter_pool:
+                self.interpreter_pool.close()
+
+    def InvalidateInode(self, ino, off=0, len=0):
+        return FuseInvalidateInode(ino, off, len)
+
+    def InvalidateEntry(self, parent, name):
+        return FuseInvalidateEntry(parent, name)
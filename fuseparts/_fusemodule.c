@@ -27,8 +27,18 @@
 
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
+#include <structmember.h>
 #include <fuse.h>
+#if FUSE_VERSION >= 26
+#include <fuse_lowlevel.h>
+#endif
+#include <pthread.h>
+#include <semaphore.h>
+#include <signal.h>
+#include <limits.h>
 #include <sys/ioctl.h>
+#include <sys/syscall.h>
+#include <unistd.h>
 #ifndef _UAPI_ASM_GENERIC_IOCTL_H
 /* Essential IOCTL definitions from Linux /include/uapi/asm-generic/ioctl.h
    to fix compilation errors on FreeBSD
@@ -77,6 +87,16 @@
 #define FUSE_VERSION FUSE_MAKE_VERSION(FUSE_MAJOR_VERSION, FUSE_MINOR_VERSION)
 #endif
 
+/* FUSE_VERSION doesn't compare across libfuse 2 and 3, this does */
+#define FUSE_AT_LEAST(maj, min)						\
+	(FUSE_MAJOR_VERSION > (maj) ||					\
+	 (FUSE_MAJOR_VERSION == (maj) && FUSE_MINOR_VERSION >= (min)))
+
+/* fallocate came with 2.9.1, which only pkg-config can tell (cf. setup.py) */
+#if FUSE_AT_LEAST(3, 0) || defined(FUSE_HAS_FALLOCATE)
+#define HAVE_FALLOCATE_OP
+#endif
+
 
 
 #if PY_MAJOR_VERSION >= 3
@@ -123,28 +143,209 @@
     #define PATH_AS_STR_END
 #endif
 
-static PyObject *getattr_cb=NULL, *readlink_cb=NULL, *readdir_cb=NULL,
-  *mknod_cb=NULL, *mkdir_cb=NULL, *unlink_cb=NULL, *rmdir_cb=NULL,
-  *symlink_cb=NULL, *rename_cb=NULL, *link_cb=NULL, *chmod_cb=NULL,
-  *chown_cb=NULL, *truncate_cb=NULL, *utime_cb=NULL,
-  *open_cb=NULL, *read_cb=NULL, *write_cb=NULL, *release_cb=NULL,
-  *statfs_cb=NULL, *fsync_cb=NULL, *create_cb=NULL, *opendir_cb=NULL,
-  *releasedir_cb=NULL, *fsyncdir_cb=NULL, *flush_cb=NULL, *ftruncate_cb=NULL,
-  *fgetattr_cb=NULL, *getxattr_cb=NULL, *listxattr_cb=NULL, *setxattr_cb=NULL,
-  *removexattr_cb=NULL, *access_cb=NULL, *lock_cb = NULL, *utimens_cb = NULL,
-  *bmap_cb = NULL, *fsinit_cb=NULL, *fsdestroy_cb = NULL, *ioctl_cb = NULL,
-  *poll_cb = NULL;
+#define FUSE_CALLBACKS(X)						\
+	X(getattr) X(readlink) X(readdir) X(mknod) X(mkdir) X(unlink)	\
+	X(rmdir) X(symlink) X(rename) X(link) X(chmod) X(chown)		\
+	X(truncate) X(utime) X(open) X(read) X(write) X(release)	\
+	X(statfs) X(fsync) X(create) X(opendir) X(releasedir)		\
+	X(fsyncdir) X(flush) X(ftruncate) X(fgetattr) X(getxattr)	\
+	X(listxattr) X(setxattr) X(removexattr) X(access) X(lock)	\
+	X(utimens) X(bmap) X(fsinit) X(fsdestroy) X(ioctl) X(poll)	\
+	X(readinto) X(read_buf) X(write_buf) X(worker_init) X(lookup)	\
+	X(forget) X(setattr) X(copy_file_range) X(fallocate) X(lseek)	\
+	X(readdirplus_lookup)
+
+/*
+ * The callbacks of the filesystem being served. They're set by main()
+ * (only one of which can run at a time, cf. serving_begin()) before any
+ * worker thread is started, and cleared after the workers are gone, so
+ * the workers can read them without locking.
+ */
+#define CB_DECLARE(name) static PyObject *name ## _cb = NULL;
 
+FUSE_CALLBACKS(CB_DECLARE)
 
-static PyObject *Py_FuseError;
 static PyInterpreterState *interp;
 
+/*
+ * The module can be imported by sub-interpreters too (cf.
+ * fuse.InterpreterPool), each of which gets its own module object, with
+ * its own FuseError and types.
+ */
+typedef struct {
+	PyObject *error;
+	PyObject *stat_type;
+	PyObject *filemethod_type;
+} fuse_state;
+
+#define FUSE_STATE(mod)	((fuse_state *)PyModule_GetState(mod))
+#define FUSE_ERROR(mod)	(FUSE_STATE(mod)->error)
+
+/*
+ * In free-threaded builds, the handlers run in parallel, so the state
+ * which is otherwise guarded by the GIL (the stats, the trace, the path
+ * cache) gets a lock of its own. PyMutex detaches the thread state while
+ * waiting, so it's safe to take with the thread state attached.
+ */
+#ifdef Py_GIL_DISABLED
+typedef PyMutex ft_mutex_t;
+#define FT_LOCK(m)	PyMutex_Lock(&(m))
+#define FT_UNLOCK(m)	PyMutex_Unlock(&(m))
+#else
+typedef char ft_mutex_t;	/* unused */
+#define FT_LOCK(m)	((void)0)
+#define FT_UNLOCK(m)	((void)0)
+#endif
+
+/*
+ * Settings of the multithreaded loop (cf. loop_configure()). The
+ * defaults are what the loop of libfuse does.
+ */
+static struct {
+	int max_threads;	/* workers at most, 0 for no limit */
+	int max_idle;		/* idle workers to keep, -1 for all */
+	size_t stack_size;	/* of the workers, 0 for the default */
+	int gil_aware;		/* no new workers to queue on the GIL */
+	int clone_fd;		/* libfuse 3: a /dev/fuse fd per worker */
+} loop_conf = { 0, 10, 0, 0, 0 };
+
+/*
+ * What to ask of the kernel when the connection is set up (cf.
+ * fsinit_func()). These need libfuse 3.
+ */
+static struct {
+	int writeback_cache;	/* cache writes in the page cache */
+	int readdirplus;	/* return the attributes with the entries */
+} conn_conf;
+
+#if defined(WITH_THREAD) && PY_MAJOR_VERSION >= 3 && FUSE_VERSION >= 29
+/* we run our own multithreaded loop, cf. loop_session() */
+#define PYFUSE_SESSION_LOOP
+
+/* workers of the loop waiting to take the GIL for a request */
+static int gil_waiting = 0;
+
+static void loop_gil_taken(void);
+#endif
+
 #ifdef WITH_THREAD
 
 #if PY_MAJOR_VERSION >= 3
+/*
+ * In the multithreaded loop, we give each worker thread a Python thread
+ * state for its whole lifetime (instead of having PyGILState_Ensure()
+ * create and destroy one for each request). Apart from the spared
+ * cost, this keeps thread local data of the fs in place between
+ * requests. The thread state is torn down when the worker exits.
+ */
+
+struct pyfuse_worker {
+	PyThreadState *tstate;
+};
+
+static pthread_key_t worker_key;
+static pthread_once_t worker_key_once = PTHREAD_ONCE_INIT;
+static int worker_key_ok = 0;
+static int workers_persistent = 0;	/* multithreaded loop running */
+
+static void
+worker_destroy(void *p)
+{
+	struct pyfuse_worker *w = p;
+
+	/*
+	 * This runs on thread exit, when the gilstate TSS of Python can be
+	 * already cleared, so don't use PyGILState_Release().
+	 */
+	PyEval_RestoreThread(w->tstate);
+	PyThreadState_Clear(w->tstate);
+	PyThreadState_DeleteCurrent();
+	free(w);
+}
+
+/*
+ * Take the GIL with stmt, counted in gil_waiting meanwhile if the loop
+ * is GIL-aware.
+ */
+#ifdef PYFUSE_SESSION_LOOP
+#define GIL_WAIT(stmt)							\
+	do {								\
+		if (loop_conf.gil_aware) {				\
+			__atomic_add_fetch(&gil_waiting, 1,		\
+			                   __ATOMIC_RELAXED);		\
+			stmt;						\
+			loop_gil_taken();				\
+		} else							\
+			stmt;						\
+	} while (0)
+#else
+#define GIL_WAIT(stmt)	stmt
+#endif
+
+/*
+ * Acquire the GIL for serving a request. Returns true if the thread
+ * state of the worker is used, false if we fell back to
+ * PyGILState_Ensure() (outside of the multithreaded loop, or for a
+ * thread which already has a thread state).
+ */
+static int
+worker_enter(PyGILState_STATE *gstate)
+{
+	struct pyfuse_worker *w;
+	PyObject *v;
+
+	if (!workers_persistent)
+		goto fallback;
+
+	if ((w = pthread_getspecific(worker_key))) {
+		GIL_WAIT(PyEval_RestoreThread(w->tstate));
+		return 1;
+	}
+
+	if (PyGILState_GetThisThreadState() || !(w = malloc(sizeof(*w))))
+		goto fallback;
+	if (pthread_setspecific(worker_key, w)) {
+		free(w);
+		goto fallback;
+	}
+	/* a new thread state, which is bound to this thread for gilstate */
+	GIL_WAIT(PyGILState_Ensure());
+	w->tstate = PyThreadState_Get();
+
+	if (worker_init_cb) {
+		v = PyObject_CallObject(worker_init_cb, NULL);
+		if (v)
+			Py_DECREF(v);
+		else
+			PyErr_Print();
+	}
+
+	return 1;
+
+fallback:
+	*gstate = PyGILState_Ensure();
+	return 0;
+}
+
+static void
+worker_key_create(void)
+{
+	if (pthread_key_create(&worker_key, worker_destroy) == 0)
+		worker_key_ok = 1;
+}
+
+static __inline void
+worker_leave(int persistent, PyGILState_STATE gstate)
+{
+	if (persistent)
+		PyEval_SaveThread();
+	else
+		PyGILState_Release(gstate);
+}
+
 #define PYLOCK() \
   PyGILState_STATE gstate; \
-  gstate = PyGILState_Ensure();
+  int persistent = worker_enter(&gstate);
 #else
 #define PYLOCK()                                                \
   PyThreadState *_state = NULL;					\
@@ -156,7 +357,7 @@ static PyInterpreterState *interp;
 #endif
 
 #if PY_MAJOR_VERSION >= 3
-#define PYUNLOCK() PyGILState_Release(gstate);
+#define PYUNLOCK() worker_leave(persistent, gstate);
 #else
 #define PYUNLOCK()                                              \
   if (interp) {                                                 \
@@ -172,11 +373,209 @@ static PyInterpreterState *interp;
 #define PYUNLOCK()
 #endif /* WITH_THREAD */
 
-#define PROLOGUE(pyval)		\
+/*
+ * Per-op statistics: calls, errors by errno, bytes moved, a latency
+ * histogram, time spent waiting for the GIL and requests in flight.
+ *
+ * An op is timed from when it's got from FUSE (before we wait for the
+ * GIL) to when the handler's result is dealt with, or in the low-level
+ * API, to when it's replied to (which is later than that for requests
+ * deferred to an event loop). The counters are updated with the GIL
+ * held (in free-threaded builds, with stats_lock held), so that's all
+ * the locking they need, except for the in flight counts, which are
+ * updated before taking the GIL.
+ */
+
+#define FUSE_OPS(X)							\
+	X(getattr) X(readlink) X(readdir) X(mknod) X(mkdir) X(unlink)	\
+	X(rmdir) X(symlink) X(rename) X(link) X(chmod) X(chown)		\
+	X(truncate) X(utime) X(open) X(read) X(write) X(release)	\
+	X(statfs) X(fsync) X(create) X(opendir) X(releasedir)		\
+	X(fsyncdir) X(flush) X(fgetattr) X(ftruncate) X(getxattr)	\
+	X(listxattr) X(setxattr) X(removexattr) X(access) X(lock)	\
+	X(utimens) X(bmap) X(ioctl) X(lookup) X(setattr) X(readdirplus)	\
+	X(copy_file_range) X(fallocate) X(lseek)
+
+#define OP_ENUM(name) OP_##name,
+#define OP_NAME(name) #name,
+
+enum { FUSE_OPS(OP_ENUM) OP_COUNT };
+
+static const char *op_names[OP_COUNT] = { FUSE_OPS(OP_NAME) };
+
+/* bucket i counts latencies below 2**(i + OP_HIST_SHIFT) ns */
+#define OP_HIST_SHIFT	10
+#define OP_HIST_BUCKETS	32
+/* errno values from this one up are counted together */
+#define OP_ERRNOS	134
+
+struct op_stats {
+	unsigned long long calls, errors, bytes, time_ns, gil_ns;
+	unsigned long long hist[OP_HIST_BUCKETS];
+	unsigned long long errnos[OP_ERRNOS];
+	int in_flight;
+};
+
+static struct op_stats op_stats[OP_COUNT];
+
+#ifdef Py_GIL_DISABLED
+/* for the stats and the trace */
+static PyMutex stats_lock;
+#endif
+
+static __inline unsigned long long
+monotonic_ns(void)
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+
+	return ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+static __inline unsigned long long
+op_begin(int op)
+{
+	__atomic_add_fetch(&op_stats[op].in_flight, 1, __ATOMIC_RELAXED);
+
+	return monotonic_ns();
+}
+
+/*
+ * Record the end of an op with result ret (a negative errno on failure,
+ * or for reads and writes, the bytes moved, if not given in bytes).
+ * t0 and t1 are the times of starting and of getting the GIL. To be
+ * called with the GIL (or stats_lock) held. Returns the time of the end.
+ */
+static unsigned long long
+op_end(int op, unsigned long long t0, unsigned long long t1, long ret,
+       long long bytes)
+{
+	struct op_stats *st = &op_stats[op];
+	unsigned long long t2 = monotonic_ns(), t = t2 - t0;
+	int b = 0;
+
+	while (b < OP_HIST_BUCKETS - 1 && t >> (b + OP_HIST_SHIFT))
+		b++;
+
+	st->calls++;
+	st->time_ns += t;
+	st->gil_ns += t1 - t0;
+	st->hist[b]++;
+	if (ret < 0) {
+		st->errors++;
+		st->errnos[-ret < OP_ERRNOS ? -ret : OP_ERRNOS - 1]++;
+	} else if (op == OP_read || op == OP_write)
+		st->bytes += bytes ? bytes : ret;
+	__atomic_sub_fetch(&st->in_flight, 1, __ATOMIC_RELAXED);
+
+	return t2;
+}
+
+/*
+ * The request trace: a ring buffer of the last trace.size requests (if
+ * it's not 0), recorded along with the stats, so with the GIL (or
+ * stats_lock) held.
+ */
+
+#define TRACE_PATH_MAX	128
+
+struct trace_event {
+	unsigned long long t0, t1, t2;	/* start, GIL got, end */
+	unsigned long long ino;		/* low-level API */
+	uintptr_t fh;
+	long long ret;			/* an offset, for lseek */
+	int op, tid, deferred;
+	unsigned int uid;
+	int pid;
+	char path[TRACE_PATH_MAX];	/* high-level API, maybe truncated */
+};
+
+static struct {
+	struct trace_event *events;
+	size_t size;
+	unsigned long long count;	/* of the events recorded */
+} trace;
+
+/* the filehandle passed to the handler last by this thread */
+static __thread PyObject *req_fh = NULL;
+
+static __thread int thread_tid = 0;
+
+static __inline int
+current_tid(void)
+{
+	if (!thread_tid)
+		thread_tid = syscall(SYS_gettid);
+
+	return thread_tid;
+}
+
+static int
+trace_init(Py_ssize_t size)
+{
+	struct trace_event *events = NULL;
+
+	if (size > 0 && !(events = calloc(size, sizeof(*events)))) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	FT_LOCK(stats_lock);
+	free(trace.events);
+	trace.events = events;
+	trace.size = events ? size : 0;
+	trace.count = 0;
+	FT_UNLOCK(stats_lock);
+
+	return 0;
+}
+
+static struct trace_event *
+trace_add(int op, unsigned long long t0, unsigned long long t1,
+          unsigned long long t2, long long ret)
+{
+	struct trace_event *ev = &trace.events[trace.count++ % trace.size];
+
+	ev->op = op;
+	ev->t0 = t0;
+	ev->t1 = t1;
+	ev->t2 = t2;
+	ev->ret = ret;
+
+	return ev;
+}
+
+/* with the GIL (or stats_lock) held, while serving the request */
+static void
+trace_add_hl(int op, unsigned long long t0, unsigned long long t1,
+             unsigned long long t2, long long ret, const char *path)
+{
+	struct fuse_context *ctx = fuse_get_context();
+	struct trace_event *ev = trace_add(op, t0, t1, t2, ret);
+	size_t len = path ? strlen(path) : 0;
+
+	if (len >= TRACE_PATH_MAX)
+		len = TRACE_PATH_MAX - 1;
+	memcpy(ev->path, path, len);
+	ev->path[len] = '\0';
+	ev->ino = 0;
+	ev->fh = (uintptr_t)req_fh;
+	ev->uid = ctx ? ctx->uid : 0;
+	ev->pid = ctx ? ctx->pid : 0;
+	ev->tid = current_tid();
+	ev->deferred = 0;
+}
+
+#define PROLOGUE(op, pyval)	\
 int ret = -EINVAL;		\
 PyObject *v;			\
+const int _op = op;		\
+long long _bytes = 0;		\
+unsigned long long _t0 = op_begin(_op), _t1, _t2; \
 				\
 PYLOCK();			\
+_t1 = monotonic_ns();		\
+req_fh = NULL;			\
 				\
 v = pyval;			\
 				\
@@ -197,7 +596,26 @@ if (PyInt_Check(v)) {		\
 OUT_DECREF:			\
 	Py_DECREF(v);		\
 OUT:				\
+	FT_LOCK(stats_lock);	\
+	_t2 = op_end(_op, _t0, _t1, ret, _bytes); \
+	if (trace.events)	\
+		trace_add_hl(_op, _t0, _t1, _t2, _bytes ? _bytes : ret, path); \
+	FT_UNLOCK(stats_lock);	\
+	PYUNLOCK();		\
+	return ret;
+
+/* for ops which change things: do inval (cf. the attribute cache) at the end */
+#define EPILOGUE_INVALIDATE(inval)	\
+OUT_DECREF:			\
+	Py_DECREF(v);		\
+OUT:				\
+	FT_LOCK(stats_lock);	\
+	_t2 = op_end(_op, _t0, _t1, ret, _bytes); \
+	if (trace.events)	\
+		trace_add_hl(_op, _t0, _t1, _t2, _bytes ? _bytes : ret, path); \
+	FT_UNLOCK(stats_lock);	\
 	PYUNLOCK();		\
+	inval;			\
 	return ret;
 
 #if FUSE_VERSION >= 22
@@ -207,1163 +625,4346 @@ fi_to_py(struct fuse_file_info *fi)
 	return (PyObject *)(uintptr_t)fi->fh;
 }
 
-#define PYO_CALLWITHFI(fi, fnc, fmt, ...)				      \
-	fi_to_py(fi) ?							      \
-	PyObject_CallFunction(fnc, #fmt "O", ## __VA_ARGS__, fi_to_py(fi)) :  \
-	PyObject_CallFunction(fnc, #fmt, ## __VA_ARGS__)
+#define PYO_CALLWITHFI(fi, fnc, ...)					      \
+	PYO_CALLWITHFH(fnc, fi_to_py(fi), __VA_ARGS__)
+
+/* release the filehandle if the fs has no handler to be given it */
+static int
+drop_fh(struct fuse_file_info *fi)
+{
+	if (fi->fh) {
+		PYLOCK();
+		Py_DECREF(fi_to_py(fi));
+		PYUNLOCK();
+		fi->fh = 0;
+	}
+
+	return 0;
+}
 #else
-#define PYO_CALLWITHFI(fi, fnc, fmt, ...)				      \
-	PyObject_CallFunction(fnc, #fmt, ## __VA_ARGS__)
+#define PYO_CALLWITHFI(fi, fnc, ...)					      \
+	PYO_CALLWITHFH(fnc, NULL, __VA_ARGS__)
 #endif /* FUSE_VERSION >= 22 */
 
+/*
+ * Calling the handlers.
+ *
+ * We use the vectorcall protocol with the arguments in an array on the
+ * stack, so no format string is parsed and no argument tuple is built
+ * per request. The arguments are made by the PY* converter macros below,
+ * and fuse_vcall() takes over their references. If any of them is NULL
+ * (ie. the conversion failed), the handler is not called.
+ *
+ * The array has a spare slot before the arguments, which we allow the
+ * callee to use (PY_VECTORCALL_ARGUMENTS_OFFSET; this spares a copy when
+ * calling bound methods) and another one after them for the filehandle.
+ */
 
-/* transform a Python integer to an unsigned C numeric value */
+#if PY_VERSION_HEX >= 0x03090000
+#define fuse_Vectorcall PyObject_Vectorcall
+#elif PY_VERSION_HEX >= 0x03080000
+#define fuse_Vectorcall _PyObject_Vectorcall
+#else
+#define PY_VECTORCALL_ARGUMENTS_OFFSET \
+	((size_t)1 << (8 * sizeof(size_t) - 1))
 
-#define py2attr(st, attr) {						\
-	if (PyInt_Check(pytmp) && sizeof((st)->attr) <= sizeof(long)) {	\
-		/*							\
-		 * We'd rather use here PyInt_AsUnsignedLong() here	\
-		 * but there is no such thing. Closest match is		\
-		 * PyInt_AsUnsignedLongMask() but that doesn't check	\
-		 * for overflows. Duh.					\
-		 */							\
-		ctmp = PyInt_AsLong(pytmp);				\
-		if (ctmp >						\
-		    /* damn the funcall overhead...			\
-		           PyInt_GetMax() */				\
-		           LONG_MAX) {					\
-			/*						\
-			 * If the value, as unsigned, is bigger than	\
-			 * Python ints can be, then it was a negative	\
-			 * integer so bail out.				\
-			 */						\
-			Py_DECREF(pytmp);				\
-			goto OUT_DECREF;				\
-		}							\
-	} else {							\
-		if (PyInt_Check(pytmp))					\
-			/*						\
-			 * This fnc doesn't catch overflows but I guess	\
-			 * it shouldn't overflow after passing		\
-			 * PyInt_Check() ...				\
-			 */						\
-			ctmp = PyInt_AsUnsignedLongLongMask(pytmp);	\
-		else if (PyLong_Check(pytmp))				\
-			ctmp = PyLong_AsUnsignedLongLong(pytmp);	\
-		else if (PyFloat_Check(pytmp))				\
-			ctmp =						\
-			  (unsigned long long)PyFloat_AsDouble(pytmp);	\
-		else {							\
-			Py_DECREF(pytmp);				\
-			goto OUT_DECREF;				\
-		}							\
-	}								\
-	Py_DECREF(pytmp);						\
-	if (PyErr_Occurred())						\
-		goto OUT_DECREF;					\
-	(st)->attr = ctmp;						\
-	if ((unsigned long long)(st)->attr != ctmp)			\
-		goto OUT_DECREF;					\
-}
+static PyObject *
+fuse_Vectorcall(PyObject *fnc, PyObject *const *args, size_t nargsf,
+                PyObject *kwnames)
+{
+	PyObject *pyargs, *v;
+	size_t i, n = nargsf & ~PY_VECTORCALL_ARGUMENTS_OFFSET;
 
-#define fetchattr_nam(st, attr, aname)					\
-	if (!(pytmp = PyObject_GetAttrString(v, aname)))		\
-		goto OUT_DECREF;					\
-	py2attr(st, attr);
+	(void)kwnames;
+	if (!(pyargs = PyTuple_New(n)))
+		return NULL;
+	for (i = 0; i < n; i++) {
+		Py_INCREF(args[i]);
+		PyTuple_SET_ITEM(pyargs, i, args[i]);
+	}
+	v = PyObject_Call(fnc, pyargs, NULL);
+	Py_DECREF(pyargs);
 
-#define fetchattr(st, attr)						\
-	fetchattr_nam(st, attr, #attr)
+	return v;
+}
+#endif
 
-#define fetchattr_soft(st, attr)					\
-	if (PyObject_HasAttrString(v, #attr)) {				\
-		pytmp = PyObject_GetAttrString(v, #attr);		\
-		if (!pytmp)						\
-			goto OUT_DECREF;				\
-	        if (pytmp == Py_None)					\
-			Py_DECREF(pytmp);				\
-		else							\
-			py2attr(st, attr);				\
+/*
+ * An OSError raised by a handler stands for returning -errno (this used to
+ * be done by ErrnoWrapper in fuse.py, at the cost of an extra Python frame
+ * per request). If the exception has no errno, it's left alone, to be
+ * reported by the caller.
+ */
+static PyObject *
+fuse_errno_result(PyObject *v)
+{
+	PyObject *type, *value, *tb, *e;
+
+	if (v || !PyErr_ExceptionMatches(PyExc_OSError))
+		return v;
+
+	PyErr_Fetch(&type, &value, &tb);
+	PyErr_NormalizeException(&type, &value, &tb);
+	e = value ? PyObject_GetAttrString(value, "errno") : NULL;
+	if (e && PyInt_Check(e))
+		v = PyNumber_Negative(e);
+	Py_XDECREF(e);
+	if (v) {
+		Py_XDECREF(type);
+		Py_XDECREF(value);
+		Py_XDECREF(tb);
+	} else {
+		PyErr_Clear();
+		PyErr_Restore(type, value, tb);
 	}
 
+	return v;
+}
+
 /*
- * Following macros are only for getattr-alikes, we undef them after
- * the getattr type functions.
+ * A file class method: calling it with (path, args..., fh) calls the
+ * method of fh with args. Instances stand for the file class methods in
+ * the callback table (cf. Fuse.Methproxy), and fuse_vcall() dispatches
+ * them right to the method of the filehandle object.
  */
+typedef struct {
+	PyObject_HEAD
+	PyObject *name;
+} FileMethodObject;
 
-#define fetchattr_soft_d(st, attr, defa)				\
-	fetchattr_soft(st, attr) else st->attr = defa
-
-#define FETCH_STAT_DATA()						\
-	fetchattr(st, st_mode);						\
-	fetchattr(st, st_ino);						\
-	fetchattr(st, st_dev);						\
-	fetchattr(st, st_nlink);					\
-	fetchattr(st, st_uid);						\
-	fetchattr(st, st_gid);						\
-	fetchattr(st, st_size);						\
-	fetchattr(st, st_atime);					\
-	fetchattr(st, st_mtime);					\
-	fetchattr(st, st_ctime);					\
-									\
-	/*								\
-	 * Following fields are not necessarily available on all	\
-	 * platforms (were "all" stands for "POSIX-like"). Therefore	\
-	 * we should have some #ifdef-s around... However, they _are_	\
-	 * available on those platforms where FUSE has a chance to	\
-	 * run now and in the foreseeable future, and we don't use	\
-	 * autotools so we just dare to throw these in as is.		\
-	 */								\
-									\
-	fetchattr_soft(st, st_rdev);					\
-	fetchattr_soft_d(st, st_blksize, 4096);				\
-	fetchattr_soft_d(st, st_blocks, (st->st_size + 511)/512)
-
+/* that of the main interpreter, cf. fuse_exec() */
+static PyTypeObject *FileMethod_Type = NULL;
 
-static int
-getattr_func(const char *path, struct stat *st)
+static PyObject *
+FileMethod_new(PyTypeObject *type, PyObject *args, PyObject *kw)
 {
-	PyObject *pytmp;
-	unsigned long long ctmp;
-
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(getattr_cb, "O&", &Path_AsDecodedUnicode, path) )
-#else
-	PROLOGUE( PyObject_CallFunction(getattr_cb, "s", path) )
-#endif
-	FETCH_STAT_DATA();
+	FileMethodObject *self;
+	PyObject *name;
 
-	ret = 0;
+	if (!PyArg_ParseTuple(args, "U:FileMethod", &name))
+		return NULL;
+	if (!(self = (FileMethodObject *)type->tp_alloc(type, 0)))
+		return NULL;
+	Py_INCREF(name);
+	PyUnicode_InternInPlace(&name);
+	self->name = name;
 
-	EPILOGUE
+	return (PyObject *)self;
 }
 
-#if FUSE_VERSION >= 25
-static int
-fgetattr_func(const char *path, struct stat *st, struct fuse_file_info *fi)
+static void
+FileMethod_dealloc(FileMethodObject *self)
 {
-	PyObject *pytmp;
-	unsigned long long ctmp;
+	PyTypeObject *tp = Py_TYPE(self);
 
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PYO_CALLWITHFI(fi, fgetattr_cb, O&, &Path_AsDecodedUnicode, path) )
-#else
-	PROLOGUE( PYO_CALLWITHFI(fi, fgetattr_cb, s, path) )
-#endif
+	Py_XDECREF(self->name);
+	tp->tp_free((PyObject *)self);
+	Py_DECREF(tp);
+}
 
-	FETCH_STAT_DATA();
+static PyObject *
+FileMethod_call(FileMethodObject *self, PyObject *args, PyObject *kw)
+{
+	Py_ssize_t n = PyTuple_GET_SIZE(args);
+	PyObject *meth, *margs, *v;
 
-	ret = 0;
+	if (n < 2) {
+		PyErr_Format(PyExc_TypeError,
+		             "file method %U needs a path and a filehandle",
+		             self->name);
+		return NULL;
+	}
+	if (!(meth = PyObject_GetAttr(PyTuple_GET_ITEM(args, n - 1),
+	                              self->name)))
+		return NULL;
+	if (!(margs = PyTuple_GetSlice(args, 1, n - 1))) {
+		Py_DECREF(meth);
+		return NULL;
+	}
+	v = PyObject_Call(meth, margs, kw);
+	Py_DECREF(margs);
+	Py_DECREF(meth);
 
-	EPILOGUE
+	return v;
+}
 
+static PyObject *
+FileMethod_repr(FileMethodObject *self)
+{
+	return PyUnicode_FromFormat("<file method %U>", self->name);
 }
-#endif
 
-#undef fetchattr_soft_d
-#undef FETCH_STAT_DATA
+static PyMemberDef FileMethod_members[] = {
+	{"name", T_OBJECT, offsetof(FileMethodObject, name), READONLY, NULL},
+	{NULL}
+};
 
-static int
-readlink_func(const char *path, char *link, size_t size)
-{
-	char *s;
+static PyType_Slot FileMethod_slots[] = {
+	{Py_tp_dealloc, FileMethod_dealloc},
+	{Py_tp_repr, FileMethod_repr},
+	{Py_tp_call, FileMethod_call},
+	{Py_tp_doc, "FileMethod(name): calling it with (path, *args, fh) calls\n"
+	            "fh.name(*args)."},
+	{Py_tp_members, FileMethod_members},
+	{Py_tp_new, FileMethod_new},
+	{0, NULL}
+};
 
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(readlink_cb, "O&", &Path_AsDecodedUnicode, path) )
+static PyType_Spec FileMethod_spec = {
+	.name = "fuseparts._fuse.FileMethod",
+	.basicsize = sizeof(FileMethodObject),
+	.flags = Py_TPFLAGS_DEFAULT,
+	.slots = FileMethod_slots,
+};
+
+/* args and nargs are as in fuse_vcall, fh is not in args */
+static PyObject *
+filemethod_vcall(FileMethodObject *fm, PyObject *fh, PyObject **args,
+                 size_t nargs)
+{
+#if PY_VERSION_HEX >= 0x03090000
+	PyObject *path = args[1], *v;
+
+	/* fh takes the place of the path, as self */
+	args[1] = fh;
+	v = PyObject_VectorcallMethod(fm->name, args + 1,
+	                              nargs | PY_VECTORCALL_ARGUMENTS_OFFSET,
+	                              NULL);
+	args[1] = path;
+
+	return v;
 #else
-	PROLOGUE( PyObject_CallFunction(readlink_cb, "s", path) )
+	PyObject *meth, *v;
+
+	if (!(meth = PyObject_GetAttr(fh, fm->name)))
+		return NULL;
+	v = fuse_Vectorcall(meth, args + 2,
+	                    (nargs - 1) | PY_VECTORCALL_ARGUMENTS_OFFSET, NULL);
+	Py_DECREF(meth);
+
+	return v;
 #endif
+}
 
-	if(!PyString_Check(v)) {
-		ret = -EINVAL;
-		goto OUT_DECREF;
+static PyObject *
+fuse_vcall(PyObject *fnc, PyObject *fh, PyObject **args, size_t nargs)
+{
+	PyObject *v = NULL;
+	size_t i;
+
+	if (fh)
+		req_fh = fh;
+	for (i = 1; i <= nargs; i++) {
+		if (!args[i])
+			goto out;
 	}
 
-	PATH_AS_STR_BEGIN(v, s);
-	strncpy(link, s, size);
-	PATH_AS_STR_END;
-	link[size-1] = '\0';
-	ret = 0;
+	if (fh && Py_TYPE(fnc) == FileMethod_Type) {
+		v = fuse_errno_result(
+		  filemethod_vcall((FileMethodObject *)fnc, fh, args, nargs));
+		goto out;
+	}
 
-	EPILOGUE
+	if (fh)
+		args[++nargs] = fh;
+
+	v = fuse_errno_result(
+	  fuse_Vectorcall(fnc, args + 1,
+	                  nargs | PY_VECTORCALL_ARGUMENTS_OFFSET, NULL));
+	if (fh)
+		nargs--;
+
+out:
+	for (i = 1; i <= nargs; i++)
+		Py_XDECREF(args[i]);
+
+	return v;
 }
 
-#if FUSE_VERSION >= 23
-static int
-opendir_func(const char *path, struct fuse_file_info *fi)
-{
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(opendir_cb, "O&", &Path_AsDecodedUnicode, path) )
-#else
-	PROLOGUE( PyObject_CallFunction(opendir_cb, "s", path) )
-#endif
+#define PYO_ARGV(...) ((PyObject *[]){ NULL, __VA_ARGS__, NULL })
 
-	fi->fh = (uintptr_t) v;
+/* call fnc with the given arguments, and then with fh if that's not NULL */
+#define PYO_CALLWITHFH(fnc, fh, ...)					      \
+	fuse_vcall(fnc, fh, PYO_ARGV(__VA_ARGS__),			      \
+	           sizeof(PYO_ARGV(__VA_ARGS__)) / sizeof(PyObject *) - 2)
 
-	ret = 0;
-	goto OUT;
+#define PYO_CALL(fnc, ...) PYO_CALLWITHFH(fnc, NULL, __VA_ARGS__)
 
-	EPILOGUE
-}
+#define PYO_CALL0(fnc) fuse_errno_result(fuse_Vectorcall(fnc, NULL, 0, NULL))
 
-static int
-releasedir_func(const char *path, struct fuse_file_info *fi)
+/*
+ * Flags, modes and sizes keep taking the same few values, most of which
+ * are out of the range of the small ints preallocated by Python. So we
+ * keep a small cache of them. (As it's only used with the GIL held, it
+ * needs no locking. Without the GIL, it's not worth a lock: it's left
+ * out.)
+ */
+
+#ifndef Py_GIL_DISABLED
+#define INT_CACHE_BITS 6
+#define INT_CACHE_SIZE (1 << INT_CACHE_BITS)
+
+static struct {
+	long key;
+	PyObject *obj;
+} int_cache[INT_CACHE_SIZE];
+
+static PyObject *
+py_int_cached(long i)
 {
-	PROLOGUE(
-	  fi_to_py(fi) ?
-#ifdef FIX_PATH_DECODING
-	  PyObject_CallFunction(releasedir_cb, "O&N", &Path_AsDecodedUnicode, path,
-	                        fi_to_py(fi)) :
-	  PyObject_CallFunction(releasedir_cb, "O&", &Path_AsDecodedUnicode, path)
-#else
-	  PyObject_CallFunction(releasedir_cb, "sN", path,
-	                        fi_to_py(fi)) :
-	  PyObject_CallFunction(releasedir_cb, "s", path)
-#endif
-	)
+	/* Fibonacci hashing, so that aligned sizes don't collide */
+	size_t h = (unsigned long long)i * 0x9E3779B97F4A7C15ULL >>
+	           (64 - INT_CACHE_BITS);
+	PyObject *o;
+
+	if (int_cache[h].obj && int_cache[h].key == i) {
+		Py_INCREF(int_cache[h].obj);
+		return int_cache[h].obj;
+	}
 
-	EPILOGUE
+	if (!(o = PyInt_FromLong(i)))
+		return NULL;
+	Py_XDECREF(int_cache[h].obj);
+	Py_INCREF(o);
+	int_cache[h].key = i;
+	int_cache[h].obj = o;
+
+	return o;
 }
+#endif
 
-static int
-fsyncdir_func(const char *path, int datasync, struct fuse_file_info *fi)
-{
 #ifdef FIX_PATH_DECODING
-	PROLOGUE( PYO_CALLWITHFI(fi, fsyncdir_cb, &Oi, &Path_AsDecodedUnicode, path, datasync) )
+#define PYSTR(str)	Path_AsDecodedUnicode((void *)(str))
+#elif PY_MAJOR_VERSION >= 3
+#define PYSTR(str)	PyUnicode_FromString(str)
 #else
-	PROLOGUE( PYO_CALLWITHFI(fi, fsyncdir_cb, si, path, datasync) )
+#define PYSTR(str)	PyString_FromString(str)
 #endif
-	EPILOGUE
-}
 
-static __inline int
-dir_add_entry(PyObject *v, void *buf, fuse_fill_dir_t df)
-#else
-static __inline int
-dir_add_entry(PyObject *v, fuse_dirh_t buf, fuse_dirfil_t df)
-#endif
-{
-	PyObject *pytmp;
-	unsigned long long ctmp;
-	int ret = -EINVAL;
-	struct stat st;
-	struct { off_t offset; } offs;
+/*
+ * Cache of path objects.
+ *
+ * Requests tend to hit the same few paths over and over. If enabled (by
+ * giving a positive path_cache_size to main()), we keep the most recently
+ * used path objects in a bounded LRU cache, keyed by the raw path, so
+ * that repeated requests to a path are spared of the decoding and get
+ * the very same str object (which makes identity based lookups possible
+ * in the fs, as long as the path stays cached).
+ *
+ * The cache is used with the GIL held only (and in free-threaded builds,
+ * with its lock held, but for setting it up and clearing it, which is
+ * done by main() while no request is being served).
+ */
 
-	memset(&st, 0, sizeof(st));
-	fetchattr_nam(&st, st_ino, "ino");
-	fetchattr_nam(&st, st_mode, "type");
-	fetchattr(&offs, offset);
+struct path_entry {
+	struct path_entry *hnext;		/* hash chain */
+	struct path_entry *prev, *next;		/* LRU list */
+	size_t hash;
+	size_t len;
+	PyObject *obj;
+	char path[];
+};
 
-	if (!(pytmp = PyObject_GetAttrString(v, "name")))
-		goto OUT_DECREF;
-	if (!PyString_Check(pytmp)) {
-		Py_DECREF(pytmp);
-		goto OUT_DECREF;
+static struct {
+	struct path_entry **buckets;
+	size_t mask;
+	size_t size, capacity;
+	struct path_entry lru;	/* list head, most recently used first */
+	unsigned long long hits, misses, evictions;
+	ft_mutex_t lock;
+} path_cache;
+
+static __inline size_t
+path_hash(const char *path, size_t *lenp)
+{
+	/* FNV-1a */
+	unsigned long long h = 0xcbf29ce484222325ULL;
+	const char *p;
+
+	for (p = path; *p; p++) {
+		h ^= (unsigned char)*p;
+		h *= 0x100000001b3ULL;
 	}
+	*lenp = p - path;
 
-	char *s;
-	PATH_AS_STR_BEGIN(pytmp, s);
-#if FUSE_VERSION >= 23
-	ret = df(buf, s, &st, offs.offset);
-#elif FUSE_VERSION >= 21
-	ret = df(buf, s, (st.st_mode & 0170000) >> 12, st.st_ino);
-#else
-	ret = df(buf, s, (st.st_mode & 0170000) >> 12);
-#endif
-	PATH_AS_STR_END;
-	Py_DECREF(pytmp);
+	return (size_t)h;
+}
 
-OUT_DECREF:
-	Py_DECREF(v);
+static __inline void
+path_lru_unlink(struct path_entry *e)
+{
+	e->prev->next = e->next;
+	e->next->prev = e->prev;
+}
 
-	return ret;
+static __inline void
+path_lru_push(struct path_entry *e)
+{
+	e->next = path_cache.lru.next;
+	e->prev = &path_cache.lru;
+	e->next->prev = e;
+	path_cache.lru.next = e;
 }
 
-#if FUSE_VERSION >= 23
-static int
-readdir_func(const char *path, void *buf, fuse_fill_dir_t df, off_t off,
-             struct fuse_file_info *fi)
+static void
+path_cache_evict(void)
 {
-	PyObject *iter, *w;
+	struct path_entry *e = path_cache.lru.prev, **ep;
+
+	for (ep = &path_cache.buckets[e->hash & path_cache.mask]; *ep != e;
+	     ep = &(*ep)->hnext)
+		;
+	*ep = e->hnext;
+	path_lru_unlink(e);
+	Py_DECREF(e->obj);
+	free(e);
+	path_cache.size--;
+}
 
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PYO_CALLWITHFI(fi, readdir_cb, O&K, &Path_AsDecodedUnicode, path, off) )
-#else
-	PROLOGUE( PYO_CALLWITHFI(fi, readdir_cb, sK, path, off) )
-#endif
-#else
-static int
-readdir_func(const char *path, fuse_dirh_t buf, fuse_dirfil_t df)
+static void
+path_cache_clear(void)
 {
-	PyObject *iter, *w;
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(readdir_cb, "O&K", &Path_AsDecodedUnicode, path) )
-#else
-	PROLOGUE( PyObject_CallFunction(readdir_cb, "sK", path) )
-#endif
-#endif
+	while (path_cache.size)
+		path_cache_evict();
+	free(path_cache.buckets);
+	path_cache.buckets = NULL;
+	path_cache.capacity = 0;
+}
 
-	iter = PyObject_GetIter(v);
-	if(!iter) {
-		PyErr_Print();
-		goto OUT_DECREF;
+static int
+path_cache_init(Py_ssize_t capacity)
+{
+	size_t nbuckets = 1;
+
+	path_cache_clear();
+	path_cache.lru.next = path_cache.lru.prev = &path_cache.lru;
+	path_cache.hits = path_cache.misses = path_cache.evictions = 0;
+	if (capacity <= 0)
+		return 0;
+
+	while (nbuckets < (size_t)capacity)
+		nbuckets <<= 1;
+	path_cache.buckets = calloc(nbuckets, sizeof(*path_cache.buckets));
+	if (!path_cache.buckets) {
+		PyErr_NoMemory();
+		return -1;
 	}
+	path_cache.mask = nbuckets - 1;
+	path_cache.capacity = capacity;
 
-	while ((w = PyIter_Next(iter))) {
-		if (dir_add_entry(w, buf, df))
-			break;
+	return 0;
+}
+
+static PyObject *
+py_path(const char *path)
+{
+	struct path_entry *e, **bucket;
+	size_t hash, len;
+	PyObject *obj;
+
+	if (!path_cache.capacity || !path)
+		return PYSTR(path);
+
+	hash = path_hash(path, &len);
+	FT_LOCK(path_cache.lock);
+	bucket = &path_cache.buckets[hash & path_cache.mask];
+	for (e = *bucket; e; e = e->hnext) {
+		if (e->hash == hash && e->len == len &&
+		    !memcmp(e->path, path, len)) {
+			path_cache.hits++;
+			if (path_cache.lru.next != e) {
+				path_lru_unlink(e);
+				path_lru_push(e);
+			}
+			obj = e->obj;
+			Py_INCREF(obj);
+			goto out;
+		}
 	}
 
-	Py_DECREF(iter);
-	if (PyErr_Occurred()) {
-		PyErr_Print();
-		goto OUT_DECREF;
+	path_cache.misses++;
+	if (!(obj = PYSTR(path)))
+		goto out;
+
+	e = malloc(sizeof(*e) + len + 1);
+	if (!e)
+		/* no big deal, just don't cache it */
+		goto out;
+	if (path_cache.size >= path_cache.capacity) {
+		path_cache_evict();
+		path_cache.evictions++;
 	}
-	ret = 0;
+	memcpy(e->path, path, len + 1);
+	e->len = len;
+	e->hash = hash;
+	Py_INCREF(obj);
+	e->obj = obj;
+	e->hnext = *bucket;
+	*bucket = e;
+	path_lru_push(e);
+	path_cache.size++;
 
-	EPILOGUE
+out:
+	FT_UNLOCK(path_cache.lock);
+	return obj;
 }
 
-static int
-mknod_func(const char *path, mode_t m, dev_t d)
+/*
+ * Cache of attributes.
+ *
+ * If enabled (by giving a positive attr_cache_ttl to main()), we keep the
+ * results of getattr and fgetattr for attr_cache_ttl seconds, keyed by
+ * the path, in an LRU cache which takes at most attr_cache_memory bytes.
+ * A hit is served without calling into Python, or even taking the GIL.
+ *
+ * As opposed to the kernel's attr_timeout, this knows about the ops which
+ * change things: when one of them is done, the entries of the paths it
+ * affected (eg. the parent directory too, for unlink) are dropped. Changes
+ * from elsewhere are noticed on expiry, or when Invalidate() is called.
+ *
+ * A getattr which overlaps with an invalidation may have got the state
+ * from before the change, so its result is not cached. We tell that by
+ * the invalidation count, which must not change meanwhile.
+ *
+ * The cache is used without the GIL, so it has a lock of its own.
+ */
+
+struct attr_entry {
+	struct attr_entry *hnext;		/* hash chain */
+	struct attr_entry *prev, *next;		/* LRU list */
+	size_t hash;
+	size_t len;
+	double expires;
+	struct stat st;
+	char path[];
+};
+
+static struct {
+	struct attr_entry **buckets;
+	size_t mask;
+	size_t size, memory, max_memory;
+	double ttl;
+	struct attr_entry lru;	/* list head, most recently used first */
+	unsigned long long hits, misses, evictions, invalidations;
+	pthread_mutex_t lock;
+} attr_cache = { .lock = PTHREAD_MUTEX_INITIALIZER };
+
+/* attr_cache_invalidate() flags */
+#define AC_PARENT	1	/* the parent directory too */
+#define AC_TREE		2	/* everything below the path too */
+
+/* a rough guess of the memory taken by an entry, for sizing the table */
+#define AC_ENTRY_GUESS	(sizeof(struct attr_entry) + 64)
+
+static __inline double
+monotonic_time(void)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(mknod_cb, "O&ii", &Path_AsDecodedUnicode, path, m, d) )
-#else
-	PROLOGUE( PyObject_CallFunction(mknod_cb, "sii", path, m, d) )
-#endif
-	EPILOGUE
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+
+	return ts.tv_sec + ts.tv_nsec * 1e-9;
 }
 
-static int
-mkdir_func(const char *path, mode_t m)
+static __inline size_t
+attr_entry_memory(size_t len)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(mkdir_cb, "O&i", &Path_AsDecodedUnicode, path, m) )
-#else
-	PROLOGUE( PyObject_CallFunction(mkdir_cb, "si", path, m) )
-#endif
-	EPILOGUE
+	return sizeof(struct attr_entry) + len + 1;
 }
 
-static int
-unlink_func(const char *path)
+static __inline size_t
+attr_hash(const char *path, size_t len)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(unlink_cb, "O&", &Path_AsDecodedUnicode, path) )
-#else
-	PROLOGUE( PyObject_CallFunction(unlink_cb, "s", path) )
-#endif
-	EPILOGUE
+	/* FNV-1a, as path_hash() */
+	unsigned long long h = 0xcbf29ce484222325ULL;
+	size_t i;
+
+	for (i = 0; i < len; i++) {
+		h ^= (unsigned char)path[i];
+		h *= 0x100000001b3ULL;
+	}
+
+	return (size_t)h;
 }
 
-static int
-rmdir_func(const char *path)
+static __inline void
+attr_lru_unlink(struct attr_entry *e)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(rmdir_cb, "O&", &Path_AsDecodedUnicode, path) )
-#else
-	PROLOGUE( PyObject_CallFunction(rmdir_cb, "s", path) )
-#endif
-	EPILOGUE
+	e->prev->next = e->next;
+	e->next->prev = e->prev;
 }
 
-static int
-symlink_func(const char *path, const char *path1)
+static __inline void
+attr_lru_push(struct attr_entry *e)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(symlink_cb, "O&O&", &Path_AsDecodedUnicode, path, &Path_AsDecodedUnicode, path1) )
-#else
-	PROLOGUE( PyObject_CallFunction(symlink_cb, "ss", path, path1) )
-#endif
-	EPILOGUE
+	e->next = attr_cache.lru.next;
+	e->prev = &attr_cache.lru;
+	e->next->prev = e;
+	attr_cache.lru.next = e;
 }
 
-static int
-rename_func(const char *path, const char *path1)
+static void
+attr_cache_remove(struct attr_entry *e)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(rename_cb, "O&O&", &Path_AsDecodedUnicode, path, &Path_AsDecodedUnicode, path1) )
-#else
-	PROLOGUE( PyObject_CallFunction(rename_cb, "ss", path, path1) )
-#endif
-	EPILOGUE
+	struct attr_entry **ep;
+
+	for (ep = &attr_cache.buckets[e->hash & attr_cache.mask]; *ep != e;
+	     ep = &(*ep)->hnext)
+		;
+	*ep = e->hnext;
+	attr_lru_unlink(e);
+	attr_cache.memory -= attr_entry_memory(e->len);
+	attr_cache.size--;
+	free(e);
 }
 
-static int
-link_func(const char *path, const char *path1)
+static struct attr_entry *
+attr_cache_find(const char *path, size_t len, size_t hash)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(link_cb, "O&O&", &Path_AsDecodedUnicode, path, &Path_AsDecodedUnicode, path1) )
-#else
-	PROLOGUE( PyObject_CallFunction(link_cb, "ss", path, path1) )
-#endif
-	EPILOGUE
+	struct attr_entry *e;
+
+	for (e = attr_cache.buckets[hash & attr_cache.mask]; e; e = e->hnext) {
+		if (e->hash == hash && e->len == len &&
+		    !memcmp(e->path, path, len))
+			return e;
+	}
+
+	return NULL;
 }
 
-static int
-chmod_func(const char *path, mode_t m)
+static void
+attr_cache_clear(void)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(chmod_cb, "O&i", &Path_AsDecodedUnicode, path, m) )
-#else
-	PROLOGUE( PyObject_CallFunction(chmod_cb, "si", path, m) )
-#endif
-	EPILOGUE
+	pthread_mutex_lock(&attr_cache.lock);
+	while (attr_cache.size)
+		attr_cache_remove(attr_cache.lru.prev);
+	free(attr_cache.buckets);
+	attr_cache.buckets = NULL;
+	attr_cache.ttl = 0;
+	pthread_mutex_unlock(&attr_cache.lock);
 }
 
 static int
-chown_func(const char *path, uid_t u, gid_t g)
+attr_cache_init(double ttl, Py_ssize_t max_memory)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(chown_cb, "O&ii", &Path_AsDecodedUnicode, path, u, g) )
-#else
-	PROLOGUE( PyObject_CallFunction(chown_cb, "sii", path, u, g) )
-#endif
-	EPILOGUE
+	size_t nbuckets = 1;
+
+	attr_cache_clear();
+	attr_cache.lru.next = attr_cache.lru.prev = &attr_cache.lru;
+	attr_cache.hits = attr_cache.misses = attr_cache.evictions =
+	  attr_cache.invalidations = 0;
+	attr_cache.max_memory = max_memory > 0 ? max_memory : 0;
+	if (ttl <= 0 || max_memory <= 0)
+		return 0;
+
+	while (nbuckets * AC_ENTRY_GUESS < (size_t)max_memory)
+		nbuckets <<= 1;
+	attr_cache.buckets = calloc(nbuckets, sizeof(*attr_cache.buckets));
+	if (!attr_cache.buckets) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	attr_cache.mask = nbuckets - 1;
+	attr_cache.ttl = ttl;
+
+	return 0;
 }
 
+/*
+ * Look up the attributes of path. Returns 1 on a hit, otherwise 0, and
+ * sets *gen for attr_cache_put().
+ */
 static int
-truncate_func(const char *path, off_t length)
+attr_cache_get(const char *path, struct stat *st, unsigned long long *gen)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(truncate_cb, "O&K", &Path_AsDecodedUnicode, path, length) )
-#else
-	PROLOGUE( PyObject_CallFunction(truncate_cb, "sK", path, length) )
-#endif
-	EPILOGUE
+	struct attr_entry *e;
+	size_t len;
+	int hit = 0;
+
+	if (!attr_cache.ttl || !path)
+		return 0;
+
+	len = strlen(path);
+	pthread_mutex_lock(&attr_cache.lock);
+	e = attr_cache_find(path, len, attr_hash(path, len));
+	if (e && e->expires > monotonic_time()) {
+		*st = e->st;
+		if (attr_cache.lru.next != e) {
+			attr_lru_unlink(e);
+			attr_lru_push(e);
+		}
+		attr_cache.hits++;
+		hit = 1;
+	} else {
+		if (e)
+			attr_cache_remove(e);
+		attr_cache.misses++;
+		*gen = attr_cache.invalidations;
+	}
+	pthread_mutex_unlock(&attr_cache.lock);
+
+	return hit;
 }
 
-#if FUSE_VERSION >= 25
-static int
-ftruncate_func(const char *path, off_t length, struct fuse_file_info *fi)
+static void
+attr_cache_put(const char *path, const struct stat *st,
+               unsigned long long gen)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PYO_CALLWITHFI(fi, ftruncate_cb, O&K, &Path_AsDecodedUnicode, path, length) )
-#else
-	PROLOGUE( PYO_CALLWITHFI(fi, ftruncate_cb, sK, path, length) )
-#endif
-	EPILOGUE
+	struct attr_entry *e;
+	size_t len, hash, need;
+
+	if (!attr_cache.ttl || !path)
+		return;
+
+	len = strlen(path);
+	hash = attr_hash(path, len);
+	need = attr_entry_memory(len);
+	pthread_mutex_lock(&attr_cache.lock);
+	if (gen != attr_cache.invalidations || need > attr_cache.max_memory)
+		goto out;
+
+	if ((e = attr_cache_find(path, len, hash))) {
+		attr_lru_unlink(e);
+	} else {
+		while (attr_cache.memory + need > attr_cache.max_memory) {
+			attr_cache_remove(attr_cache.lru.prev);
+			attr_cache.evictions++;
+		}
+		/* no big deal if this fails, just don't cache it */
+		if (!(e = malloc(need)))
+			goto out;
+		memcpy(e->path, path, len + 1);
+		e->len = len;
+		e->hash = hash;
+		e->hnext = attr_cache.buckets[hash & attr_cache.mask];
+		attr_cache.buckets[hash & attr_cache.mask] = e;
+		attr_cache.memory += need;
+		attr_cache.size++;
+	}
+	e->st = *st;
+	e->expires = monotonic_time() + attr_cache.ttl;
+	attr_lru_push(e);
+
+out:
+	pthread_mutex_unlock(&attr_cache.lock);
 }
-#endif
 
-static int
-utime_func(const char *path, struct utimbuf *u)
+static void
+attr_cache_drop(const char *path, size_t len)
 {
-	int actime = u ? u->actime : time(NULL);
-	int modtime = u ? u->modtime : actime;
-	PROLOGUE(
-#ifdef FIX_PATH_DECODING
-	  PyObject_CallFunction(utime_cb, "O&(ii)", &Path_AsDecodedUnicode, path, actime, modtime)
-#else
-	  PyObject_CallFunction(utime_cb, "s(ii)", path, actime, modtime)
-#endif
-	)
-	EPILOGUE
+	struct attr_entry *e;
+
+	if ((e = attr_cache_find(path, len, attr_hash(path, len))))
+		attr_cache_remove(e);
 }
 
-#if FUSE_VERSION >= 22
-static int
-read_func(const char *path, char *buf, size_t s, off_t off,
-                     struct fuse_file_info *fi)
-#else
-static int
-read_func(const char *path, char *buf, size_t s, off_t off)
-#endif
+/* drop the entry of path (and others, as told by flags) */
+static void
+attr_cache_invalidate(const char *path, int flags)
 {
-#if PY_VERSION_HEX < 0x02050000
-	PROLOGUE( PYO_CALLWITHFI(fi, read_cb, siK, path, s, off) )
-#else
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PYO_CALLWITHFI(fi, read_cb, O&nK, &Path_AsDecodedUnicode, path, s, off) )
+	struct attr_entry *e, *prev;
+	const char *slash;
+	size_t len;
+
+	if (!attr_cache.ttl || !path)
+		return;
+
+	len = strlen(path);
+	pthread_mutex_lock(&attr_cache.lock);
+	attr_cache.invalidations++;
+	attr_cache_drop(path, len);
+	if ((flags & AC_PARENT) && (slash = strrchr(path, '/')))
+		attr_cache_drop(path, slash == path ? 1 : slash - path);
+	if (flags & AC_TREE) {
+		for (e = attr_cache.lru.prev; e != &attr_cache.lru; e = prev) {
+			prev = e->prev;
+			if (e->len > len && !memcmp(e->path, path, len) &&
+			    (e->path[len] == '/' || path[len - 1] == '/'))
+				attr_cache_remove(e);
+		}
+	}
+	pthread_mutex_unlock(&attr_cache.lock);
+}
+
+#define PYPATH(path)	py_path(path)
+#define PYINT(i)	PyInt_FromLong(i)
+#define PYUINT(u)	PyLong_FromUnsignedLong(u)
+#define PYOFF(o)	PyLong_FromUnsignedLongLong(o)
+#ifdef Py_GIL_DISABLED
+#define PYCACHEDINT(i)	PyInt_FromLong(i)
 #else
-	PROLOGUE( PYO_CALLWITHFI(fi, read_cb, snK, path, s, off) )
-#endif
+#define PYCACHEDINT(i)	py_int_cached(i)
 #endif
+#define PYBYTES(b, l)	PyBytes_FromStringAndSize(b, l)
 
 
-#if PY_MAJOR_VERSION >= 3
-	Py_buffer buffer;
+/* transform a Python integer to an unsigned C numeric value */
 
-	if(PyObject_CheckBuffer(v)) {
-		PyObject_GetBuffer(v, &buffer, PyBUF_SIMPLE);
+#define py2attr(st, attr) {						\
+	if (PyInt_Check(pytmp) && sizeof((st)->attr) <= sizeof(long)) {	\
+		/*							\
+		 * We'd rather use here PyInt_AsUnsignedLong() here	\
+		 * but there is no such thing. Closest match is		\
+		 * PyInt_AsUnsignedLongMask() but that doesn't check	\
+		 * for overflows. Duh.					\
+		 */							\
+		ctmp = PyInt_AsLong(pytmp);				\
+		if (ctmp >						\
+		    /* damn the funcall overhead...			\
+		           PyInt_GetMax() */				\
+		           LONG_MAX) {					\
+			/*						\
+			 * If the value, as unsigned, is bigger than	\
+			 * Python ints can be, then it was a negative	\
+			 * integer so bail out.				\
+			 */						\
+			Py_DECREF(pytmp);				\
+			goto OUT_DECREF;				\
+		}							\
+	} else {							\
+		if (PyInt_Check(pytmp))					\
+			/*						\
+			 * This fnc doesn't catch overflows but I guess	\
+			 * it shouldn't overflow after passing		\
+			 * PyInt_Check() ...				\
+			 */						\
+			ctmp = PyInt_AsUnsignedLongLongMask(pytmp);	\
+		else if (PyLong_Check(pytmp))				\
+			ctmp = PyLong_AsUnsignedLongLong(pytmp);	\
+		else if (PyFloat_Check(pytmp))				\
+			ctmp =						\
+			  (unsigned long long)PyFloat_AsDouble(pytmp);	\
+		else {							\
+			Py_DECREF(pytmp);				\
+			goto OUT_DECREF;				\
+		}							\
+	}								\
+	Py_DECREF(pytmp);						\
+	if (PyErr_Occurred())						\
+		goto OUT_DECREF;					\
+	(st)->attr = ctmp;						\
+	if ((unsigned long long)(st)->attr != ctmp)			\
+		goto OUT_DECREF;					\
+}
 
-		if((size_t)buffer.len <= s) {
-			memcpy(buf, buffer.buf, buffer.len);
-			ret = buffer.len;
-		}
+#define fetchattr_nam(st, attr, aname)					\
+	if (!(pytmp = PyObject_GetAttrString(v, aname)))		\
+		goto OUT_DECREF;					\
+	py2attr(st, attr);
 
-		PyBuffer_Release(&buffer);
-	} else if(PyBytes_Check(v)) {
-		if((size_t)PyBytes_Size(v) > s)
-			goto OUT_DECREF;
-		memcpy(buf, PyBytes_AsString(v), PyBytes_Size(v));
-		ret = PyBytes_Size(v);
-	}
-#else
-	if(PyString_Check(v)) {
-		if(PyString_Size(v) > s)
-			goto OUT_DECREF;
-		memcpy(buf, PyString_AsString(v), PyString_Size(v));
-		ret = PyString_Size(v);
+#define fetchattr(st, attr)						\
+	fetchattr_nam(st, attr, #attr)
+
+#define fetchattr_soft(st, attr)					\
+	if (PyObject_HasAttrString(v, #attr)) {				\
+		pytmp = PyObject_GetAttrString(v, #attr);		\
+		if (!pytmp)						\
+			goto OUT_DECREF;				\
+	        if (pytmp == Py_None)					\
+			Py_DECREF(pytmp);				\
+		else							\
+			py2attr(st, attr);				\
 	}
-#endif
 
-	EPILOGUE
-}
+/*
+ * Conversion of getattr results.
+ *
+ * This is the hottest path of all, so we try to do it cheaply. Apart
+ * from the generic case (any object with the st_* attributes), we
+ * recognize
+ *
+ * - os.stat_result instances, whose fields are read by index;
+ * - plain tuples in os.stat_result sequence order, ie.
+ *   (st_mode, st_ino, st_dev, st_nlink, st_uid, st_gid, st_size,
+ *    st_atime, st_mtime, st_ctime);
+ * - instances of our Stat type (the base of fuse.Stat), which keeps
+ *   the stat fields in fixed slots.
+ *
+ * In the generic case the attribute names are interned in advance.
+ */
 
-#if FUSE_VERSION >= 22
-static int
-write_func(const char *path, const char *buf, size_t t, off_t off,
-           struct fuse_file_info *fi)
-#else
-static int
-write_func(const char *path, const char *buf, size_t t, off_t off)
-#endif
-{
-#if PY_MAJOR_VERSION >= 3
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PYO_CALLWITHFI(fi, write_cb, O&y#K, &Path_AsDecodedUnicode, path, buf, t, off) )
-#else
-	PROLOGUE( PYO_CALLWITHFI(fi, write_cb, sy#K, path, buf, t, off) )
-#endif
-#else
-	PROLOGUE( PYO_CALLWITHFI(fi, write_cb, ss#K, path, buf, t, off) )
-#endif
-	EPILOGUE
-}
+enum {
+	STF_MODE, STF_INO, STF_DEV, STF_NLINK, STF_UID, STF_GID, STF_SIZE,
+	STF_ATIME, STF_MTIME, STF_CTIME,
+	/*
+	 * Following fields are not necessarily available on all
+	 * platforms (were "all" stands for "POSIX-like"). Therefore
+	 * we should have some #ifdef-s around... However, they _are_
+	 * available on those platforms where FUSE has a chance to
+	 * run now and in the foreseeable future, and we don't use
+	 * autotools so we just dare to throw these in as is.
+	 *
+	 * They are optional for the fs, too.
+	 */
+	STF_RDEV, STF_BLKSIZE, STF_BLOCKS,
+	STF_NFIELDS
+};
 
-#if FUSE_VERSION >= 22
-static int
-open_func(const char *path, struct fuse_file_info *fi)
-{
-	PyObject *pytmp, *pytmp1;
+/* number of mandatory fields, also the length of a stat tuple */
+#define STF_NREQUIRED STF_RDEV
 
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(open_cb, "O&i", &Path_AsDecodedUnicode, path, fi->flags) )
-#else
-	PROLOGUE( PyObject_CallFunction(open_cb, "si", path, fi->flags) )
-#endif
+static const char *stat_field_names[STF_NFIELDS] = {
+	"st_mode", "st_ino", "st_dev", "st_nlink", "st_uid", "st_gid",
+	"st_size", "st_atime", "st_mtime", "st_ctime",
+	"st_rdev", "st_blksize", "st_blocks"
+};
 
-	pytmp = PyTuple_GetItem(v, 0);
+static PyObject *stat_field_pynames[STF_NFIELDS];
 
-#if FUSE_VERSION >= 23
-	pytmp1 = PyObject_GetAttrString(pytmp, "keep_cache");
-	if (pytmp1) {
-		fi->keep_cache = PyObject_IsTrue(pytmp1);
-		Py_DECREF(pytmp1);
-	} else {
-		PyErr_Clear();
-	}
-	pytmp1 = PyObject_GetAttrString(pytmp, "direct_io");
-	if (pytmp1) {
-		fi->direct_io = PyObject_IsTrue(pytmp1);
-		Py_DECREF(pytmp1);
-	} else {
-		PyErr_Clear();
-	}
+/* os.stat_result and the index of our fields in it (-1 if missing) */
+static PyTypeObject *stat_result_type = NULL;
+static Py_ssize_t stat_result_idx[STF_NFIELDS];
 
-	if (PyObject_IsTrue(PyTuple_GetItem(v, 1)))
-#endif
-	{
-		Py_INCREF(pytmp);
-		fi->fh = (uintptr_t) pytmp;
-	}
+typedef struct {
+	PyObject_HEAD
+	PyObject *fields[STF_NFIELDS];
+} StatObject;
 
-	ret = 0;
-	goto OUT_DECREF;
+/* that of the main interpreter, cf. fuse_exec() */
+static PyTypeObject *Stat_Type = NULL;
 
-	EPILOGUE
-}
-#else
+/*
+ * Transform a Python number to an unsigned C numeric value. Semantics are
+ * the same as of py2attr(): negative integers and non-numbers are
+ * rejected, floats are truncated.
+ */
 static int
-open_func(const char *path, int mode)
+py2ull(PyObject *o, unsigned long long *res)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(open_cb, "O&i", &Path_AsDecodedUnicode, path, mode) )
-#else
-	PROLOGUE( PyObject_CallFunction(open_cb, "si", path, mode) )
+	if (PyLong_Check(o)) {
+		*res = PyLong_AsUnsignedLongLong(o);
+		if (*res == (unsigned long long)-1 && PyErr_Occurred())
+			return -1;
+	}
+#if PY_MAJOR_VERSION < 3
+	else if (PyInt_Check(o)) {
+		long l = PyInt_AsLong(o);
+		if (l < 0)
+			return -1;
+		*res = l;
+	}
 #endif
-	EPILOGUE
+	else if (PyFloat_Check(o))
+		*res = (unsigned long long)PyFloat_AsDouble(o);
+	else
+		return -1;
+
+	return 0;
 }
-#endif
 
-#if FUSE_VERSION >= 25
 static int
-create_func(const char *path, mode_t mode, struct fuse_file_info *fi)
+fetch_stat_data(PyObject *v, struct stat *st)
 {
-	PyObject *pytmp, *pytmp1;
-
-	PROLOGUE(
-#ifdef FIX_PATH_DECODING
-	  PyObject_CallFunction(create_cb, "O&ii", &Path_AsDecodedUnicode, path, fi->flags, mode)
-#else
-	  PyObject_CallFunction(create_cb, "sii", path, fi->flags, mode)
-#endif
-	)
-
-	pytmp = PyTuple_GetItem(v, 0);
+	PyObject *items[STF_NFIELDS] = { NULL };
+	unsigned long long vals[STF_NFIELDS];
+	int have[STF_NFIELDS];
+	int owned = 0, ret = -EINVAL;
+	int i;
 
-	pytmp1 = PyObject_GetAttrString(pytmp, "keep_cache");
-	if (pytmp1) {
-		fi->keep_cache = PyObject_IsTrue(pytmp1);
-		Py_DECREF(pytmp1);
+	if (stat_result_type && Py_TYPE(v) == stat_result_type) {
+		for (i = 0; i < STF_NFIELDS; i++)
+			items[i] = stat_result_idx[i] < 0 ? NULL :
+			           PyStructSequence_GET_ITEM(v, stat_result_idx[i]);
+	} else if (PyTuple_CheckExact(v)) {
+		if (PyTuple_GET_SIZE(v) != STF_NREQUIRED)
+			return ret;
+		for (i = 0; i < STF_NFIELDS; i++)
+			items[i] = i < STF_NREQUIRED ? PyTuple_GET_ITEM(v, i) : NULL;
+	} else if (PyObject_TypeCheck(v, Stat_Type)) {
+		for (i = 0; i < STF_NFIELDS; i++)
+			items[i] = ((StatObject *)v)->fields[i];
 	} else {
-		PyErr_Clear();
+		owned = 1;
+		for (i = 0; i < STF_NFIELDS; i++) {
+			items[i] = PyObject_GetAttr(v, stat_field_pynames[i]);
+			if (!items[i]) {
+				if (i < STF_NREQUIRED ||
+				    !PyErr_ExceptionMatches(PyExc_AttributeError))
+					goto out;
+				PyErr_Clear();
+			}
+		}
 	}
-	pytmp1 = PyObject_GetAttrString(pytmp, "direct_io");
-	if (pytmp1) {
-		fi->direct_io = PyObject_IsTrue(pytmp1);
-		Py_DECREF(pytmp1);
-	} else {
-		PyErr_Clear();
+
+	for (i = 0; i < STF_NFIELDS; i++) {
+		have[i] = items[i] && items[i] != Py_None;
+		if (!have[i]) {
+			if (i < STF_NREQUIRED)
+				goto out;
+			continue;
+		}
+		if (py2ull(items[i], &vals[i]) < 0)
+			goto out;
 	}
 
-	if (PyObject_IsTrue(PyTuple_GetItem(v, 1))) {
-		Py_INCREF(pytmp);
-		fi->fh = (uintptr_t) pytmp;
+#define setstat(attr, idx)						\
+	st->attr = vals[idx];						\
+	if ((unsigned long long)st->attr != vals[idx])			\
+		goto out;
+
+	setstat(st_mode, STF_MODE);
+	setstat(st_ino, STF_INO);
+	setstat(st_dev, STF_DEV);
+	setstat(st_nlink, STF_NLINK);
+	setstat(st_uid, STF_UID);
+	setstat(st_gid, STF_GID);
+	setstat(st_size, STF_SIZE);
+	setstat(st_atime, STF_ATIME);
+	setstat(st_mtime, STF_MTIME);
+	setstat(st_ctime, STF_CTIME);
+	if (have[STF_RDEV]) {
+		setstat(st_rdev, STF_RDEV);
 	}
+	if (have[STF_BLKSIZE]) {
+		setstat(st_blksize, STF_BLKSIZE);
+	} else
+		st->st_blksize = 4096;
+	if (have[STF_BLOCKS]) {
+		setstat(st_blocks, STF_BLOCKS);
+	} else
+		st->st_blocks = (st->st_size + 511)/512;
+
+#undef setstat
 
 	ret = 0;
-	goto OUT;
 
-	EPILOGUE
+out:
+	if (owned) {
+		for (i = 0; i < STF_NFIELDS; i++)
+			Py_XDECREF(items[i]);
+	}
+	/* cf. the note on return values in README.new_fusepy_api.rst */
+	PyErr_Clear();
+
+	return ret;
 }
-#endif
 
-#if FUSE_VERSION >= 22
-static int
-release_func(const char *path, struct fuse_file_info *fi)
-{
-	PROLOGUE(
-	  fi_to_py(fi) ?
-#ifdef FIX_PATH_DECODING
-	  PyObject_CallFunction(release_cb, "O&iN", &Path_AsDecodedUnicode, path, fi->flags,
-#else
-	  PyObject_CallFunction(release_cb, "siN", path, fi->flags,
-#endif
-	                        fi_to_py(fi)) :
-#ifdef FIX_PATH_DECODING
-	  PyObject_CallFunction(release_cb, "O&i", &Path_AsDecodedUnicode, path, fi->flags)
-#else
-	  PyObject_CallFunction(release_cb, "si", path, fi->flags)
-#endif
-	)
-#else
-static int
-release_func(const char *path, int flags)
+static __inline int
+getattr_func_i(const char *path, struct stat *st)
 {
-	PROLOGUE( PyObject_CallFunction(release_cb, "si", path, flags) )
-#endif
+	PROLOGUE(OP_getattr, PYO_CALL(getattr_cb, PYPATH(path)))
+	ret = fetch_stat_data(v, st);
+
 	EPILOGUE
 }
 
-#if FUSE_VERSION >= 25
-static int
-statfs_func(const char *dummy, struct statvfs *fst)
-#else
 static int
-statfs_func(const char *dummy, struct statfs *fst)
-#endif
+getattr_func(const char *path, struct stat *st)
 {
-	PyObject *pytmp;
-	unsigned long long ctmp;
-	PROLOGUE( PyObject_CallFunction(statfs_cb, "") )
+	unsigned long long gen;
+	int ret;
+
+	if (attr_cache_get(path, st, &gen))
+		return 0;
+	ret = getattr_func_i(path, st);
+	if (ret == 0)
+		attr_cache_put(path, st, gen);
+
+	return ret;
+}
 
-	fetchattr(fst, f_bsize);
-#if FUSE_VERSION >= 25
-	fetchattr(fst, f_frsize);
-#endif
-	fetchattr(fst, f_blocks);
-	fetchattr(fst, f_bfree);
-	fetchattr(fst, f_bavail);
-	fetchattr(fst, f_files);
-	fetchattr(fst, f_ffree);
 #if FUSE_VERSION >= 25
-	fetchattr(fst, f_favail);
-	fetchattr(fst, f_flag);
-	fetchattr(fst, f_namemax);
-#else
-	fetchattr_nam(fst, f_namelen, "f_namemax");
-#endif
+static __inline int
+fgetattr_func_i(const char *path, struct stat *st, struct fuse_file_info *fi)
+{
+	PROLOGUE(OP_fgetattr, PYO_CALLWITHFI(fi, fgetattr_cb, PYPATH(path)))
 
-	ret = 0;
+	ret = fetch_stat_data(v, st);
 
 	EPILOGUE
+
 }
 
-#if FUSE_VERSION >= 22
-static int
-fsync_func(const char *path, int datasync, struct fuse_file_info *fi)
-#else
 static int
-fsync_func(const char *path, int datasync)
-#endif
+fgetattr_func(const char *path, struct stat *st, struct fuse_file_info *fi)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PYO_CALLWITHFI(fi, fsync_cb, O&i, &Path_AsDecodedUnicode, path, datasync) )
-#else
-	PROLOGUE( PYO_CALLWITHFI(fi, fsync_cb, si, path, datasync) )
+	unsigned long long gen;
+	int ret;
+
+	if (attr_cache_get(path, st, &gen))
+		return 0;
+	ret = fgetattr_func_i(path, st, fi);
+	if (ret == 0)
+		attr_cache_put(path, st, gen);
+
+	return ret;
+}
 #endif
+
+static int
+readlink_func(const char *path, char *link, size_t size)
+{
+	char *s;
+
+	PROLOGUE(OP_readlink, PYO_CALL(readlink_cb, PYPATH(path)))
+
+	if(!PyString_Check(v)) {
+		ret = -EINVAL;
+		goto OUT_DECREF;
+	}
+
+	PATH_AS_STR_BEGIN(v, s);
+	strncpy(link, s, size);
+	PATH_AS_STR_END;
+	link[size-1] = '\0';
+	ret = 0;
+
 	EPILOGUE
 }
 
-#if FUSE_VERSION >= 22
-static int
-flush_func(const char *path, struct fuse_file_info *fi)
-#else
+/*
+ * Directory entries are accepted in the following forms:
+ *
+ * - a bare name (str or bytes);
+ * - a (name, ino, type, offset) tuple;
+ * - any object with `name`, `ino`, `type` and `offset` attributes
+ *   (like fuse.Direntry).
+ *
+ * Listing big directories shouldn't require building a Python
+ * object per entry, hence the first two.
+ */
+
+enum { DE_NAME, DE_INO, DE_TYPE, DE_OFFSET, DE_NFIELDS };
+
+static const char *direntry_field_names[DE_NFIELDS] = {
+	"name", "ino", "type", "offset"
+};
+
+static PyObject *direntry_field_pynames[DE_NFIELDS];
+
+/*
+ * Convert a directory entry as returned by readdir. The name is passed
+ * back in *namep, its storage is owned by *holder (a new reference).
+ * Returns -1 with an exception set on failure.
+ */
 static int
-flush_func(const char *path)
-#endif
+fetch_direntry(PyObject *v, struct stat *st, off_t *offset, const char **namep,
+               PyObject **holder)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PYO_CALLWITHFI(fi, flush_cb, O&, &Path_AsDecodedUnicode, path) )
+	PyObject *items[DE_NFIELDS] = { NULL };
+	PyObject *name, *bytes = NULL;
+	unsigned long long vals[DE_NFIELDS] = { 0 };
+	int owned = 0, ret = -1;
+	int i;
+	const char *s;
+
+	if (PyUnicode_Check(v) || PyBytes_Check(v))
+		items[DE_NAME] = v;
+	else if (PyTuple_CheckExact(v)) {
+		if (PyTuple_GET_SIZE(v) != DE_NFIELDS) {
+			PyErr_SetString(PyExc_ValueError,
+			                "directory entry tuple must be "
+			                "(name, ino, type, offset)");
+			return ret;
+		}
+		for (i = 0; i < DE_NFIELDS; i++)
+			items[i] = PyTuple_GET_ITEM(v, i);
+	} else {
+		owned = 1;
+		for (i = 0; i < DE_NFIELDS; i++) {
+			items[i] = PyObject_GetAttr(v, direntry_field_pynames[i]);
+			if (!items[i])
+				goto out;
+		}
+	}
+
+	for (i = DE_INO; i < DE_NFIELDS; i++) {
+		if (items[i] && py2ull(items[i], &vals[i]) < 0) {
+			if (!PyErr_Occurred())
+				PyErr_Format(PyExc_TypeError,
+				             "invalid directory entry %s",
+				             direntry_field_names[i]);
+			goto out;
+		}
+	}
+
+	memset(st, 0, sizeof(*st));
+	st->st_ino = vals[DE_INO];
+	st->st_mode = vals[DE_TYPE];
+	*offset = vals[DE_OFFSET];
+	if ((unsigned long long)st->st_ino != vals[DE_INO] ||
+	    (unsigned long long)st->st_mode != vals[DE_TYPE] ||
+	    (unsigned long long)*offset != vals[DE_OFFSET]) {
+		PyErr_SetString(PyExc_OverflowError,
+		                "directory entry field out of range");
+		goto out;
+	}
+
+	name = items[DE_NAME];
+	if (PyBytes_Check(name))
+		s = PyBytes_AS_STRING(name);
+	else if (PyUnicode_Check(name)) {
+#if PY_MAJOR_VERSION >= 3
+		/* ASCII is the common case, and needs no conversion */
+		if (PyUnicode_IS_ASCII(name))
+			s = PyUnicode_AsUTF8(name);
+		else {
+			bytes = PyUnicode_EncodeFSDefault(name);
+			s = bytes ? PyBytes_AS_STRING(bytes) : NULL;
+		}
 #else
-	PROLOGUE( PYO_CALLWITHFI(fi, flush_cb, s, path) )
+		bytes = PyUnicode_AsEncodedString(name,
+		                                  Py_FileSystemDefaultEncoding,
+		                                  NULL);
+		s = bytes ? PyBytes_AS_STRING(bytes) : NULL;
 #endif
+		if (!s)
+			goto out;
+	} else {
+		PyErr_SetString(PyExc_TypeError,
+		                "directory entry name must be str or bytes");
+		goto out;
+	}
+
+	if (!bytes) {
+		/* the name itself keeps the string alive */
+		bytes = name;
+		Py_INCREF(bytes);
+	}
+	*namep = s;
+	*holder = bytes;
+	ret = 0;
+
+out:
+	if (owned) {
+		for (i = 0; i < DE_NFIELDS; i++)
+			Py_XDECREF(items[i]);
+	}
+
+	return ret;
+}
+
+#if FUSE_VERSION >= 23
+static int
+opendir_func(const char *path, struct fuse_file_info *fi)
+{
+	PROLOGUE(OP_opendir, PYO_CALL(opendir_cb, PYPATH(path)))
+
+	fi->fh = (uintptr_t) v;
+
+	ret = 0;
+	goto OUT;
+
 	EPILOGUE
 }
 
-#ifdef __APPLE__
 static int
-getxattr_func(const char *path, const char *name, char *value, size_t size, uint32_t position)
-#else
+releasedir_func(const char *path, struct fuse_file_info *fi)
+{
+	if (!releasedir_cb)
+		return drop_fh(fi);
+
+	/* this is where we drop the filehandle reference */
+	PROLOGUE(OP_releasedir,
+	  (req_fh = fi_to_py(fi)) ?
+	  PYO_CALL(releasedir_cb, PYPATH(path), fi_to_py(fi)) :
+	  PYO_CALL(releasedir_cb, PYPATH(path))
+	)
+
+	EPILOGUE
+}
+
 static int
-getxattr_func(const char *path, const char *name, char *value, size_t size)
-#endif
+fsyncdir_func(const char *path, int datasync, struct fuse_file_info *fi)
 {
-#if PY_VERSION_HEX < 0x02050000
-	PROLOGUE( PyObject_CallFunction(getxattr_cb, "ssi", path, name, size) )
-#else
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(getxattr_cb, "O&O&n", &Path_AsDecodedUnicode, path, &Path_AsDecodedUnicode, name, size) )
+	PROLOGUE(OP_fsyncdir, PYO_CALLWITHFI(fi, fsyncdir_cb, PYPATH(path), PYINT(datasync)))
+	EPILOGUE
+}
+
+static __inline int
+dir_add_entry(PyObject *v, void *buf, fuse_fill_dir_t df, int plus)
 #else
-	PROLOGUE( PyObject_CallFunction(getxattr_cb, "ssn", path, name, size) )
-#endif
+static __inline int
+dir_add_entry(PyObject *v, fuse_dirh_t buf, fuse_dirfil_t df, int plus)
 #endif
+{
+	PyObject *holder;
+	const char *s;
+	struct stat st;
+	off_t offset;
+	int ret;
 
-	if(PyString_Check(v)) {
-        /* size zero can be passed into these calls  to return the current size of
-         * the named extended attribute
-         */
-        if (size == 0) {
-		    ret = PyString_Size(v);
-			goto OUT_DECREF;
-        }
-
-        /* If the size of the value buffer is too small to hold the result,  errno
-         * is set to ERANGE.
-         */
-		if ((size_t)PyString_Size(v) > size) {
-            ret = -ERANGE;
-			goto OUT_DECREF;
-        }
+	if (fetch_direntry(v, &st, &offset, &s, &holder) < 0)
+		return -EINVAL;
 
-		char *s;
-		PATH_AS_STR_BEGIN(v, s);
-		memcpy(value, s, PyString_Size(v));
-		PATH_AS_STR_END;
-		ret = PyString_Size(v);
-	}
+#if FUSE_MAJOR_VERSION >= 3
+	/* with plus, the lib looks up the entry (calling getattr) */
+	ret = df(buf, s, &st, offset, plus ? FUSE_FILL_DIR_PLUS : 0);
+#elif FUSE_VERSION >= 23
+	(void)plus;
+	ret = df(buf, s, &st, offset);
+#elif FUSE_VERSION >= 21
+	ret = df(buf, s, (st.st_mode & 0170000) >> 12, st.st_ino);
+#else
+	ret = df(buf, s, (st.st_mode & 0170000) >> 12);
+#endif
+	Py_DECREF(holder);
 
-	EPILOGUE
+	return ret;
 }
 
+#if FUSE_MAJOR_VERSION >= 3
 static int
-listxattr_func(const char *path, char *list, size_t size)
+readdir_func(const char *path, void *buf, fuse_fill_dir_t df, off_t off,
+             struct fuse_file_info *fi, enum fuse_readdir_flags flags)
 {
 	PyObject *iter, *w;
-	char *lx = list;
-#if PY_VERSION_HEX < 0x02050000
-	PROLOGUE( PyObject_CallFunction(listxattr_cb, "si", path, size) )
-#else
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(listxattr_cb, "O&n", &Path_AsDecodedUnicode, path, size) )
+	Py_ssize_t i;
+	int r, plus = conn_conf.readdirplus && (flags & FUSE_READDIR_PLUS);
+
+	PROLOGUE(OP_readdir, PYO_CALLWITHFI(fi, readdir_cb, PYPATH(path), PYOFF(off)))
+#elif FUSE_VERSION >= 23
+static int
+readdir_func(const char *path, void *buf, fuse_fill_dir_t df, off_t off,
+             struct fuse_file_info *fi)
+{
+	PyObject *iter, *w;
+	Py_ssize_t i;
+	int r, plus = 0;
+
+	PROLOGUE(OP_readdir, PYO_CALLWITHFI(fi, readdir_cb, PYPATH(path), PYOFF(off)))
 #else
-	PROLOGUE( PyObject_CallFunction(listxattr_cb, "sn", path, size) )
-#endif
+static int
+readdir_func(const char *path, fuse_dirh_t buf, fuse_dirfil_t df)
+{
+	PyObject *iter, *w;
+	Py_ssize_t i;
+	int r, plus = 0;
+	PROLOGUE(OP_readdir, PYO_CALL(readdir_cb, PYPATH(path), PYOFF(0)))
 #endif
-	iter = PyObject_GetIter(v);
-	if(!iter) {
-		PyErr_Print();
-		goto OUT_DECREF;
-	}
-
-	for (;;) {
-		size_t ilen;
 
-		w = PyIter_Next(iter);
-		if (!w) {
-			ret = lx - list;
-			break;
+	if (PyList_CheckExact(v) || PyTuple_CheckExact(v)) {
+		/*
+		 * Don't bother with the iterator protocol if we
+		 * got all entries at once.
+		 */
+		for (i = 0; i < PySequence_Fast_GET_SIZE(v); i++) {
+			if (dir_add_entry(PySequence_Fast_GET_ITEM(v, i),
+			                  buf, df, plus))
+				break;
 		}
-
-		if (!PyString_Check(w)) {
-			Py_DECREF(w);
-			break;
+	} else {
+		iter = PyObject_GetIter(v);
+		if(!iter) {
+			PyErr_Print();
+			goto OUT_DECREF;
 		}
 
-		ilen = PyString_Size(w);
-		if (lx - list + ilen >= size) {
+		while ((w = PyIter_Next(iter))) {
+			r = dir_add_entry(w, buf, df, plus);
 			Py_DECREF(w);
-			break;
+			if (r)
+				break;
 		}
 
-		char *s;
-		PATH_AS_STR_BEGIN(w, s);
-		strncpy(lx, s, ilen + 1);
-		PATH_AS_STR_END;
-		lx += ilen + 1;
-
-		Py_DECREF(w);
+		Py_DECREF(iter);
 	}
-
-	Py_DECREF(iter);
 	if (PyErr_Occurred()) {
 		PyErr_Print();
-		ret = -EINVAL;
+		goto OUT_DECREF;
 	}
+	ret = 0;
 
 	EPILOGUE
 }
-#ifdef __APPLE__
-static int
-setxattr_func(const char *path, const char *name,
-		     const char *value, size_t size, int flags, uint32_t position)
+
+static int
+mknod_func(const char *path, mode_t m, dev_t d)
+{
+	PROLOGUE(OP_mknod, PYO_CALL(mknod_cb, PYPATH(path), PYCACHEDINT(m), PYINT((int)d)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, AC_PARENT) )
+}
+
+static int
+mkdir_func(const char *path, mode_t m)
+{
+	PROLOGUE(OP_mkdir, PYO_CALL(mkdir_cb, PYPATH(path), PYCACHEDINT(m)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, AC_PARENT) )
+}
+
+static int
+unlink_func(const char *path)
+{
+	PROLOGUE(OP_unlink, PYO_CALL(unlink_cb, PYPATH(path)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, AC_PARENT) )
+}
+
+static int
+rmdir_func(const char *path)
+{
+	PROLOGUE(OP_rmdir, PYO_CALL(rmdir_cb, PYPATH(path)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, AC_PARENT) )
+}
+
+/* path is the link made (that's what gets traced), target what it's to */
+static int
+symlink_func(const char *target, const char *path)
+{
+	PROLOGUE(OP_symlink, PYO_CALL(symlink_cb, PYSTR(target), PYPATH(path)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, AC_PARENT) )
+}
+
+static int
+rename_func(const char *path, const char *path1)
+{
+	PROLOGUE(OP_rename, PYO_CALL(rename_cb, PYPATH(path), PYPATH(path1)))
+	EPILOGUE_INVALIDATE(
+	  attr_cache_invalidate(path, AC_PARENT | AC_TREE);
+	  attr_cache_invalidate(path1, AC_PARENT | AC_TREE)
+	)
+}
+
+static int
+link_func(const char *path, const char *path1)
+{
+	PROLOGUE(OP_link, PYO_CALL(link_cb, PYPATH(path), PYPATH(path1)))
+	EPILOGUE_INVALIDATE(
+	  attr_cache_invalidate(path, 0);
+	  attr_cache_invalidate(path1, AC_PARENT)
+	)
+}
+
+static int
+chmod_func(const char *path, mode_t m)
+{
+	PROLOGUE(OP_chmod, PYO_CALL(chmod_cb, PYPATH(path), PYCACHEDINT(m)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+
+static int
+chown_func(const char *path, uid_t u, gid_t g)
+{
+	PROLOGUE(OP_chown, PYO_CALL(chown_cb, PYPATH(path), PYCACHEDINT((int)u), PYCACHEDINT((int)g)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+
+static int
+truncate_func(const char *path, off_t length)
+{
+	PROLOGUE(OP_truncate, PYO_CALL(truncate_cb, PYPATH(path), PYOFF(length)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+
+#if FUSE_VERSION >= 25
+static int
+ftruncate_func(const char *path, off_t length, struct fuse_file_info *fi)
+{
+	PROLOGUE(OP_ftruncate, PYO_CALLWITHFI(fi, ftruncate_cb, PYPATH(path), PYOFF(length)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+#endif
+
+static int
+utime_func(const char *path, struct utimbuf *u)
+{
+	int actime = u ? u->actime : time(NULL);
+	int modtime = u ? u->modtime : actime;
+	PROLOGUE(OP_utime,
+	  PYO_CALL(utime_cb, PYPATH(path), Py_BuildValue("(ii)", actime, modtime))
+	)
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+
+#if FUSE_VERSION >= 22
+static int
+read_func(const char *path, char *buf, size_t s, off_t off,
+                     struct fuse_file_info *fi)
+#else
+static int
+read_func(const char *path, char *buf, size_t s, off_t off)
+#endif
+{
+	PROLOGUE(OP_read, PYO_CALLWITHFI(fi, read_cb, PYPATH(path), PYCACHEDINT(s), PYOFF(off)))
+
+
+#if PY_MAJOR_VERSION >= 3
+	Py_buffer buffer;
+
+	if(PyObject_CheckBuffer(v)) {
+		PyObject_GetBuffer(v, &buffer, PyBUF_SIMPLE);
+
+		if((size_t)buffer.len <= s) {
+			memcpy(buf, buffer.buf, buffer.len);
+			ret = buffer.len;
+		}
+
+		PyBuffer_Release(&buffer);
+	} else if(PyBytes_Check(v)) {
+		if((size_t)PyBytes_Size(v) > s)
+			goto OUT_DECREF;
+		memcpy(buf, PyBytes_AsString(v), PyBytes_Size(v));
+		ret = PyBytes_Size(v);
+	}
+#else
+	if(PyString_Check(v)) {
+		if(PyString_Size(v) > s)
+			goto OUT_DECREF;
+		memcpy(buf, PyString_AsString(v), PyString_Size(v));
+		ret = PyString_Size(v);
+	}
+#endif
+
+	EPILOGUE
+}
+
+#if FUSE_VERSION >= 22 && PY_VERSION_HEX >= 0x03030000
+/* memoryview.release, cf. init_globals() */
+static PyCFunction memoryview_release_meth;
+
+/*
+ * The view wraps memory owned by FUSE, so make sure it's unusable once we
+ * get back to the lib, and drop our reference to it. v is the result of
+ * the handler which got the view, and is returned, unless the view can't
+ * be released as the handler still has buffers exported from it: then
+ * the request fails with EIO. An exception raised by the handler is kept
+ * pending for the caller.
+ */
+static PyObject *
+memoryview_release(PyObject *mv, PyObject *v)
+{
+	PyObject *type, *value, *tb, *r;
+
+	PyErr_Fetch(&type, &value, &tb);
+	r = memoryview_release_meth(mv, NULL);
+	Py_DECREF(mv);
+	if (r)
+		Py_DECREF(r);
+	else {
+		PyErr_Print();
+		if (v) {
+			Py_DECREF(v);
+			v = PyInt_FromLong(-EIO);
+		}
+	}
+	PyErr_Restore(type, value, tb);
+
+	return v;
+}
+
+static inline PyObject *
+readinto_func_i(const char *path, char *buf, size_t s, off_t off,
+                struct fuse_file_info *fi)
+{
+	PyObject *mv, *v;
+
+	mv = PyMemoryView_FromMemory(buf, s, PyBUF_WRITE);
+	if (!mv)
+		return NULL;
+
+	Py_INCREF(mv);
+	v = PYO_CALLWITHFI(fi, readinto_cb, PYPATH(path), mv, PYOFF(off));
+	v = memoryview_release(mv, v);
+
+	if (v && PyInt_Check(v) && PyInt_AsLong(v) > (long)s) {
+		Py_DECREF(v);
+		PyErr_SetString(PyExc_ValueError,
+		                "readinto reported more bytes than the buffer size");
+		v = NULL;
+	}
+
+	return v;
+}
+
+static int
+readinto_func(const char *path, char *buf, size_t s, off_t off,
+              struct fuse_file_info *fi)
+{
+	PROLOGUE(OP_read, readinto_func_i(path, buf, s, off, fi))
+	EPILOGUE
+}
+
+static inline PyObject *
+write_mv_func_i(const char *path, const char *buf, size_t t, off_t off,
+                struct fuse_file_info *fi)
+{
+	PyObject *mv, *v;
+
+	mv = PyMemoryView_FromMemory((char *)buf, t, PyBUF_READ);
+	if (!mv)
+		return NULL;
+
+	Py_INCREF(mv);
+	v = PYO_CALLWITHFI(fi, write_cb, PYPATH(path), mv, PYOFF(off));
+	v = memoryview_release(mv, v);
+
+	return v;
+}
+
+/*
+ * Variant of write_func which passes a read-only memoryview of the
+ * kernel supplied data instead of copying it into a bytes object.
+ */
+static int
+write_mv_func(const char *path, const char *buf, size_t t, off_t off,
+              struct fuse_file_info *fi)
+{
+	PROLOGUE(OP_write, write_mv_func_i(path, buf, t, off, fi))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+#endif
+
+#if FUSE_VERSION >= 22
+static int
+write_func(const char *path, const char *buf, size_t t, off_t off,
+           struct fuse_file_info *fi)
+#else
+static int
+write_func(const char *path, const char *buf, size_t t, off_t off)
+#endif
+{
+	PROLOGUE(OP_write, PYO_CALLWITHFI(fi, write_cb, PYPATH(path), PYBYTES(buf, t), PYOFF(off)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+
+#if FUSE_VERSION >= 22
+static int
+open_func(const char *path, struct fuse_file_info *fi)
+{
+	PyObject *pytmp, *pytmp1;
+
+	PROLOGUE(OP_open, PYO_CALL(open_cb, PYPATH(path), PYCACHEDINT(fi->flags)))
+
+	/* (filehandle, whether to keep it), cf. Fuse.lowwrap() */
+	if (!PyTuple_Check(v) || PyTuple_GET_SIZE(v) != 2)
+		goto OUT_DECREF;
+	pytmp = PyTuple_GET_ITEM(v, 0);
+
+#if FUSE_VERSION >= 23
+	pytmp1 = PyObject_GetAttrString(pytmp, "keep_cache");
+	if (pytmp1) {
+		fi->keep_cache = PyObject_IsTrue(pytmp1);
+		Py_DECREF(pytmp1);
+	} else {
+		PyErr_Clear();
+	}
+	pytmp1 = PyObject_GetAttrString(pytmp, "direct_io");
+	if (pytmp1) {
+		fi->direct_io = PyObject_IsTrue(pytmp1);
+		Py_DECREF(pytmp1);
+	} else {
+		PyErr_Clear();
+	}
+
+	if (PyObject_IsTrue(PyTuple_GET_ITEM(v, 1)))
+#endif
+	{
+		Py_INCREF(pytmp);
+		fi->fh = (uintptr_t) pytmp;
+	}
+
+	ret = 0;
+	goto OUT_DECREF;
+
+	EPILOGUE_INVALIDATE(
+	  if (fi->flags & O_TRUNC)
+		  attr_cache_invalidate(path, 0)
+	)
+}
+#else
+static int
+open_func(const char *path, int mode)
+{
+	PROLOGUE(OP_open, PYO_CALL(open_cb, PYPATH(path), PYCACHEDINT(mode)))
+	EPILOGUE
+}
+#endif
+
+#if FUSE_VERSION >= 25
+static int
+create_func(const char *path, mode_t mode, struct fuse_file_info *fi)
+{
+	PyObject *pytmp, *pytmp1;
+
+	PROLOGUE(OP_create,
+	  PYO_CALL(create_cb, PYPATH(path), PYCACHEDINT(fi->flags),
+	           PYCACHEDINT(mode))
+	)
+
+	if (!PyTuple_Check(v) || PyTuple_GET_SIZE(v) != 2)
+		goto OUT_DECREF;
+	pytmp = PyTuple_GET_ITEM(v, 0);
+
+	pytmp1 = PyObject_GetAttrString(pytmp, "keep_cache");
+	if (pytmp1) {
+		fi->keep_cache = PyObject_IsTrue(pytmp1);
+		Py_DECREF(pytmp1);
+	} else {
+		PyErr_Clear();
+	}
+	pytmp1 = PyObject_GetAttrString(pytmp, "direct_io");
+	if (pytmp1) {
+		fi->direct_io = PyObject_IsTrue(pytmp1);
+		Py_DECREF(pytmp1);
+	} else {
+		PyErr_Clear();
+	}
+
+	if (PyObject_IsTrue(PyTuple_GET_ITEM(v, 1))) {
+		Py_INCREF(pytmp);
+		fi->fh = (uintptr_t) pytmp;
+	}
+
+	ret = 0;
+	goto OUT_DECREF;
+
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, AC_PARENT) )
+}
+#endif
+
+#if FUSE_VERSION >= 22
+static int
+release_func(const char *path, struct fuse_file_info *fi)
+{
+	if (!release_cb)
+		return drop_fh(fi);
+
+	/* this is where we drop the filehandle reference */
+	PROLOGUE(OP_release,
+	  (req_fh = fi_to_py(fi)) ?
+	  PYO_CALL(release_cb, PYPATH(path), PYCACHEDINT(fi->flags),
+	           fi_to_py(fi)) :
+	  PYO_CALL(release_cb, PYPATH(path), PYCACHEDINT(fi->flags))
+	)
+#else
+static int
+release_func(const char *path, int flags)
+{
+	PROLOGUE(OP_release, PYO_CALL(release_cb, PYPATH(path), PYCACHEDINT(flags)))
+#endif
+	EPILOGUE
+}
+
+#if FUSE_VERSION >= 25
+static int
+fetch_statfs_data(PyObject *v, struct statvfs *fst)
+#else
+static int
+fetch_statfs_data(PyObject *v, struct statfs *fst)
+#endif
+{
+	PyObject *pytmp;
+	unsigned long long ctmp;
+
+	fetchattr(fst, f_bsize);
+#if FUSE_VERSION >= 25
+	fetchattr(fst, f_frsize);
+#endif
+	fetchattr(fst, f_blocks);
+	fetchattr(fst, f_bfree);
+	fetchattr(fst, f_bavail);
+	fetchattr(fst, f_files);
+	fetchattr(fst, f_ffree);
+#if FUSE_VERSION >= 25
+	fetchattr(fst, f_favail);
+	fetchattr(fst, f_flag);
+	fetchattr(fst, f_namemax);
+#else
+	fetchattr_nam(fst, f_namelen, "f_namemax");
+#endif
+
+	return 0;
+
+OUT_DECREF:
+	return -EINVAL;
+}
+
+#if FUSE_VERSION >= 25
+static int
+statfs_func(const char *path, struct statvfs *fst)
+#else
+static int
+statfs_func(const char *path, struct statfs *fst)
+#endif
+{
+	PROLOGUE(OP_statfs, PYO_CALL0(statfs_cb))
+
+	ret = fetch_statfs_data(v, fst);
+
+	EPILOGUE
+}
+
+#if FUSE_VERSION >= 22
+static int
+fsync_func(const char *path, int datasync, struct fuse_file_info *fi)
+#else
+static int
+fsync_func(const char *path, int datasync)
+#endif
+{
+	PROLOGUE(OP_fsync, PYO_CALLWITHFI(fi, fsync_cb, PYPATH(path), PYINT(datasync)))
+	EPILOGUE
+}
+
+#if FUSE_VERSION >= 22
+static int
+flush_func(const char *path, struct fuse_file_info *fi)
+#else
+static int
+flush_func(const char *path)
+#endif
+{
+	PROLOGUE(OP_flush, PYO_CALLWITHFI(fi, flush_cb, PYPATH(path)))
+	EPILOGUE
+}
+
+#ifdef __APPLE__
+static int
+getxattr_func(const char *path, const char *name, char *value, size_t size, uint32_t position)
+#else
+static int
+getxattr_func(const char *path, const char *name, char *value, size_t size)
+#endif
+{
+	PROLOGUE(OP_getxattr, PYO_CALL(getxattr_cb, PYPATH(path), PYSTR(name), PYCACHEDINT(size)))
+
+	if(PyString_Check(v)) {
+        /* size zero can be passed into these calls  to return the current size of
+         * the named extended attribute
+         */
+        if (size == 0) {
+		    ret = PyString_Size(v);
+			goto OUT_DECREF;
+        }
+
+        /* If the size of the value buffer is too small to hold the result,  errno
+         * is set to ERANGE.
+         */
+		if ((size_t)PyString_Size(v) > size) {
+            ret = -ERANGE;
+			goto OUT_DECREF;
+        }
+
+		char *s;
+		PATH_AS_STR_BEGIN(v, s);
+		memcpy(value, s, PyString_Size(v));
+		PATH_AS_STR_END;
+		ret = PyString_Size(v);
+	}
+
+	EPILOGUE
+}
+
+static int
+listxattr_func(const char *path, char *list, size_t size)
+{
+	PyObject *iter, *w;
+	char *lx = list;
+	PROLOGUE(OP_listxattr, PYO_CALL(listxattr_cb, PYPATH(path), PYCACHEDINT(size)))
+	iter = PyObject_GetIter(v);
+	if(!iter) {
+		PyErr_Print();
+		goto OUT_DECREF;
+	}
+
+	for (;;) {
+		size_t ilen;
+
+		w = PyIter_Next(iter);
+		if (!w) {
+			ret = lx - list;
+			break;
+		}
+
+		if (!PyString_Check(w)) {
+			Py_DECREF(w);
+			break;
+		}
+
+		ilen = PyString_Size(w);
+		if (lx - list + ilen >= size) {
+			Py_DECREF(w);
+			break;
+		}
+
+		char *s;
+		PATH_AS_STR_BEGIN(w, s);
+		strncpy(lx, s, ilen + 1);
+		PATH_AS_STR_END;
+		lx += ilen + 1;
+
+		Py_DECREF(w);
+	}
+
+	Py_DECREF(iter);
+	if (PyErr_Occurred()) {
+		PyErr_Print();
+		ret = -EINVAL;
+	}
+
+	EPILOGUE
+}
+#ifdef __APPLE__
+static int
+setxattr_func(const char *path, const char *name,
+		     const char *value, size_t size, int flags, uint32_t position)
+#else
+static int
+setxattr_func(const char *path, const char *name, const char *value,
+              size_t size, int flags)
+#endif
+{
+	PROLOGUE(OP_setxattr,
+	  PYO_CALL(setxattr_cb, PYPATH(path), PYSTR(name),
+#if PY_MAJOR_VERSION >= 3
+	           PyUnicode_FromStringAndSize(value, size),
+#else
+	           PyString_FromStringAndSize(value, size),
+#endif
+	           PYCACHEDINT(flags))
+	)
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+
+static int
+removexattr_func(const char *path, const char *name)
+{
+	PROLOGUE(OP_removexattr, PYO_CALL(removexattr_cb, PYPATH(path), PYSTR(name)))
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+
+#if FUSE_VERSION >= 25
+static int
+access_func(const char *path, int mask)
+{
+	PROLOGUE(OP_access, PYO_CALL(access_cb, PYPATH(path), PYCACHEDINT(mask)))
+	EPILOGUE
+}
+#endif
+
+#if FUSE_VERSION >= 23
+#if FUSE_MAJOR_VERSION >= 3
+static void *
+fsinit_func(struct fuse_conn_info *conn, struct fuse_config *cfg)
+#elif FUSE_VERSION >= 26
+static void *
+fsinit_func(struct fuse_conn_info *conn)
+#else
+static void *
+fsinit_func(void)
+#endif
+{
+#if FUSE_MAJOR_VERSION >= 3
+	(void)cfg;
+
+	if (conn_conf.writeback_cache)
+		conn->want |= conn->capable & FUSE_CAP_WRITEBACK_CACHE;
+	/* on by default if the kernel has it, but not of use to everyone */
+	if (conn_conf.readdirplus)
+		conn->want |= conn->capable & FUSE_CAP_READDIRPLUS;
+	else
+		conn->want &= ~(FUSE_CAP_READDIRPLUS |
+		                FUSE_CAP_READDIRPLUS_AUTO);
+#endif
+#if FUSE_VERSION >= 29
+	/*
+	 * Let the kernel hand over data through pipes if we can make use
+	 * of that (the lib will fall back to plain copying if not).
+	 */
+	if (read_buf_cb)
+		conn->want |= conn->capable & FUSE_CAP_SPLICE_WRITE;
+	if (write_buf_cb)
+		conn->want |= conn->capable & FUSE_CAP_SPLICE_READ;
+#elif FUSE_VERSION >= 26
+	(void)conn;
+#endif
+	if (fsinit_cb) {
+		PyObject *v;
+
+		PYLOCK();
+		v = PYO_CALL0(fsinit_cb);
+		if (v)
+			Py_DECREF(v);
+		else
+			PyErr_Print();
+		PYUNLOCK();
+	}
+
+	return NULL;
+}
+
+static void
+fsdestroy_func(void *param)
+{
+	(void)param;
+
+	PyObject *v;
+
+	PYLOCK();
+	v = PYO_CALL0(fsdestroy_cb);
+	if (v)
+		Py_DECREF(v);
+	else
+		PyErr_Print();
+	PYUNLOCK();
+}
+#endif
+
+#if FUSE_VERSION >= 26
+static inline PyObject *
+lock_func_i(const char *path, struct fuse_file_info *fi, int cmd,
+            struct flock *lock)
+{
+	PyObject *pyargs, *pykw = NULL, *v = NULL;
+
+	req_fh = fi_to_py(fi);
+	pyargs =
+	fi_to_py(fi) ?
+#ifdef FIX_PATH_DECODING
+	Py_BuildValue("(O&iKO)", &Path_AsDecodedUnicode, path, cmd, fi->lock_owner, fi_to_py(fi)) :
+	Py_BuildValue("(O&iK)", &Path_AsDecodedUnicode, path, cmd, fi->lock_owner);
+#else
+	Py_BuildValue("(siKO)", path, cmd, fi->lock_owner, fi_to_py(fi)) :
+	Py_BuildValue("(siK)", path, cmd, fi->lock_owner);
+#endif
+	if (! pyargs)
+		goto out;
+
+	pykw = Py_BuildValue("{sisKsKsi}",
+	                     "l_type",  lock->l_type,
+	                     "l_start", lock->l_start,
+	                     "l_len",   lock->l_len,
+	                     "l_pid",   lock->l_pid);
+	if (! pykw)
+		goto out;
+
+	v = fuse_errno_result(PyObject_Call(lock_cb, pyargs, pykw));
+
+out:
+	Py_XDECREF(pyargs);
+	Py_XDECREF(pykw);
+
+	return v;
+}
+
+static int
+lock_func(const char *path, struct fuse_file_info *fi, int cmd,
+          struct flock *lock)
+{
+	PyObject *pytmp;
+	unsigned long long ctmp;
+
+	PROLOGUE(OP_lock, lock_func_i(path, fi, cmd, lock))
+
+	fetchattr_soft(lock, l_type);
+	fetchattr_soft(lock, l_start);
+	fetchattr_soft(lock, l_len);
+	fetchattr_soft(lock, l_pid);
+
+	ret = 0;
+
+	EPILOGUE
+}
+
+static int
+utimens_func(const char *path, const struct timespec ts[2])
+{
+	PROLOGUE(OP_utimens,
+	  PYO_CALL(utimens_cb, PYPATH(path),
+	           PYINT((int)ts[0].tv_sec), PYINT((int)ts[0].tv_nsec),
+	           PYINT((int)ts[1].tv_sec), PYINT((int)ts[1].tv_nsec))
+	)
+
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+
+static int
+bmap_func(const char *path, size_t blocksize, uint64_t *idx)
+{
+	PyObject *pytmp;
+	unsigned long long ctmp;
+	struct { uint64_t idx; } idxwrapper;
+
+	PROLOGUE(OP_bmap,
+	  PYO_CALL(bmap_cb, PYPATH(path), PYCACHEDINT(blocksize), PYOFF(*idx))
+	)
+
+	/*
+	 * We can make use of our py -> C numeric conversion macro with some
+	 * customization of the parameters...
+	 */
+	pytmp = v;
+	Py_INCREF(pytmp);
+	py2attr(&idxwrapper, idx);
+
+	*idx = idxwrapper.idx;
+	ret = 0;
+
+	EPILOGUE
+}
+#endif
+
+#if FUSE_MAJOR_VERSION >= 3
+/*
+ * libfuse 3 merged fgetattr into getattr, ftruncate into truncate and
+ * utime into utimens, passing the file info if the file is open, and
+ * gave rename flags. These fit our handlers to that.
+ */
+
+static int
+getattr3_func(const char *path, struct stat *st, struct fuse_file_info *fi)
+{
+	if (fi && fgetattr_cb)
+		return fgetattr_func(path, st, fi);
+	if (!getattr_cb)
+		return -ENOSYS;
+
+	return getattr_func(path, st);
+}
+
+static int
+rename3_func(const char *path, const char *path1, unsigned int flags)
+{
+	/* RENAME_NOREPLACE and RENAME_EXCHANGE can't be passed on */
+	if (flags)
+		return -EINVAL;
+
+	return rename_func(path, path1);
+}
+
+static int
+chmod3_func(const char *path, mode_t m, struct fuse_file_info *fi)
+{
+	(void)fi;
+
+	return chmod_func(path, m);
+}
+
+static int
+chown3_func(const char *path, uid_t u, gid_t g, struct fuse_file_info *fi)
+{
+	(void)fi;
+
+	return chown_func(path, u, g);
+}
+
+static int
+truncate3_func(const char *path, off_t length, struct fuse_file_info *fi)
+{
+	if (fi && ftruncate_cb)
+		return ftruncate_func(path, length, fi);
+	if (!truncate_cb)
+		return -ENOSYS;
+
+	return truncate_func(path, length);
+}
+
+static int
+utimens3_func(const char *path, const struct timespec ts[2],
+              struct fuse_file_info *fi)
+{
+	struct utimbuf u;
+
+	(void)fi;
+
+	if (utimens_cb)
+		return utimens_func(path, ts);
+
+	/* as libfuse 2 does it for utime */
+	u.actime = ts[0].tv_sec;
+	u.modtime = ts[1].tv_sec;
+
+	return utime_func(path, &u);
+}
+#endif
+
+#if FUSE_VERSION >= 28
+static int
+ioctl_func(const char *path, int cmd, void *arg,
+	   struct fuse_file_info *fi, unsigned int flags, void *data)
+{
+	char* s;
+	char* input_data;
+	Py_ssize_t input_data_size, output_data_size;
+
+	input_data = (char*) data;
+	input_data_size = _IOC_SIZE(cmd);
+
+	// If not a "write" ioctl, do not send input data
+	if(!(_IOC_DIR(cmd) & _IOC_WRITE)) {
+		input_data = NULL;
+		input_data_size = 0;
+	}
+
+	PROLOGUE(OP_ioctl, PYO_CALLWITHFI(fi, ioctl_cb, PYPATH(path), PYUINT((unsigned int)cmd),
+	                        input_data ?
+	                        PYBYTES(input_data, input_data_size) :
+	                        (Py_INCREF(Py_None), Py_None),
+	                        PYUINT(flags)));
+
+	// get returned value if this is a "read" ioctl
+	if(_IOC_DIR(cmd) & _IOC_READ) {
+
+#if PY_MAJOR_VERSION >= 3
+		if(!PyBytes_Check(v)) {
+			ret = -EINVAL;
+			goto OUT_DECREF;
+		}
+
+		output_data_size = PyBytes_Size(v);
+
+		s = PyBytes_AsString(v);
+#else
+
+		if(!PyString_Check(v)) {
+			ret = -EINVAL;
+			goto OUT_DECREF;
+		}
+
+		output_data_size = PyString_Size(v);
+
+		s = PyString_AsString(v);
+#endif
+
+		if(output_data_size > _IOC_SIZE(cmd))
+			output_data_size = _IOC_SIZE(cmd);
+
+		memcpy(data,s,output_data_size);
+		ret = 0;
+	}
+	EPILOGUE
+}
+
+static const char pollhandle_name[] = "pollhandle";
+
+static void
+pollhandle_destructor(PyObject *p)
+{
+	struct fuse_pollhandle *ph;
+
+	ph = PyCapsule_GetPointer(p, pollhandle_name);
+	fuse_pollhandle_destroy(ph);
+}
+
+static int
+poll_func(const char *path, struct fuse_file_info *fi,
+	  struct fuse_pollhandle *ph, unsigned *reventsp)
+{
+	PyObject *pollhandle = Py_None;
+	int ret = -EINVAL;
+	PyObject *v;
+
+	PYLOCK();
+
+	if (ph) {
+		pollhandle = PyCapsule_New(ph, pollhandle_name, pollhandle_destructor);
+		if (!pollhandle) {
+			PyErr_Print();
+			goto OUT;
+		}
+	}
+
+	Py_INCREF(pollhandle);
+	v = PYO_CALLWITHFI(fi, poll_cb, PYPATH(path), pollhandle);
+	if (!v) {
+		PyErr_Print();
+		goto OUT;
+	}
+	if (v == Py_None) {
+		ret = 0;
+		goto OUT_DECREF;
+	}
+	if (PyInt_Check(v)) {
+		ret = PyInt_AsLong(v);
+		goto OUT_DECREF;
+	}
+
+OUT_DECREF:
+	Py_DECREF(v);
+OUT:
+	if (ph)
+		Py_DECREF(pollhandle);
+
+	PYUNLOCK();
+
+	if (ret > 0) {
+		*reventsp = ret;
+		ret = 0;
+	}
+
+	return ret;
+}
+#endif
+
+#ifdef HAVE_FALLOCATE_OP
+static int
+fallocate_func(const char *path, int mode, off_t off, off_t len,
+               struct fuse_file_info *fi)
+{
+	PROLOGUE(OP_fallocate,
+	  PYO_CALLWITHFI(fi, fallocate_cb, PYPATH(path), PYCACHEDINT(mode),
+	                 PYOFF(off), PYOFF(len))
+	)
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+#endif
+
+#if FUSE_AT_LEAST(3, 4)
+/* the filehandle of fi as an argument (None if there is none) */
+static PyObject *
+py_fh(struct fuse_file_info *fi)
+{
+	PyObject *fh = fi ? fi_to_py(fi) : NULL;
+
+	if (!fh)
+		fh = Py_None;
+	Py_INCREF(fh);
+
+	return fh;
+}
+
+static ssize_t
+copy_file_range_func(const char *path, struct fuse_file_info *fi,
+                     off_t off, const char *path_out,
+                     struct fuse_file_info *fi_out, off_t off_out,
+                     size_t len, int flags)
+{
+	/* we return the count as an int; copying less is allowed */
+	if (len > INT_MAX)
+		len = INT_MAX;
+
+	PROLOGUE(OP_copy_file_range,
+	  PYO_CALLWITHFI(fi, copy_file_range_cb, PYPATH(path), PYOFF(off),
+	                 PYPATH(path_out), py_fh(fi_out), PYOFF(off_out),
+	                 PYOFF(len), PYCACHEDINT(flags))
+	)
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path_out, 0) )
+}
+#endif
+
+#if FUSE_AT_LEAST(3, 8)
+/*
+ * The kernel only asks for SEEK_DATA and SEEK_HOLE. This doesn't use
+ * PROLOGUE, which would cut the resulting offset to an int.
+ */
+static off_t
+lseek_func(const char *path, off_t off, int whence, struct fuse_file_info *fi)
+{
+	off_t ret = -EINVAL;
+	long long pos;
+	PyObject *v;
+	unsigned long long t0 = op_begin(OP_lseek), t1, t2;
+
+	PYLOCK();
+	t1 = monotonic_ns();
+	req_fh = NULL;
+
+	v = PYO_CALLWITHFI(fi, lseek_cb, PYPATH(path), PYOFF(off),
+	                   PYCACHEDINT(whence));
+	if (v) {
+		pos = PyLong_AsLongLong(v);
+		Py_DECREF(v);
+		if (pos != -1 || !PyErr_Occurred())
+			ret = pos;
+	}
+	if (PyErr_Occurred())
+		PyErr_Print();
+
+	FT_LOCK(stats_lock);
+	t2 = op_end(OP_lseek, t0, t1, ret, 0);
+	if (trace.events)
+		trace_add_hl(OP_lseek, t0, t1, t2, ret, path);
+	FT_UNLOCK(stats_lock);
+	PYUNLOCK();
+
+	return ret;
+}
+#endif
+
+#if FUSE_VERSION >= 29
+/*
+ * The *_buf methods let the fs refer to a range of a file descriptor
+ * instead of passing data through Python. Moving the data is then up
+ * to the lib, which can splice it between the fd and /dev/fuse.
+ */
+
+/*
+ * read_buf has to give the data (or an errno): None or a byte count would
+ * pass for success in PROLOGUE, without the buffer being set.
+ */
+static PyObject *
+read_buf_result(PyObject *v)
+{
+	long n;
+
+	if (!v || !(v == Py_None || PyInt_Check(v)))
+		return v;
+	n = PyInt_Check(v) ? PyInt_AsLong(v) : 0;
+	if (n == -1 && PyErr_Occurred())
+		PyErr_Clear();
+	else if (n < 0)
+		return v;
+	Py_DECREF(v);
+	return PyInt_FromLong(-EINVAL);
+}
+
+static int
+read_buf_func(const char *path, struct fuse_bufvec **bufp, size_t size,
+              off_t off, struct fuse_file_info *fi)
+{
+	struct fuse_bufvec *bv;
+	Py_buffer buffer;
+	int fd;
+	long long pos;
+	Py_ssize_t len;
+
+	PROLOGUE(OP_read, read_buf_result(PYO_CALLWITHFI(fi, read_buf_cb, PYPATH(path), PYCACHEDINT(size), PYOFF(off))))
+
+	bv = malloc(sizeof(*bv));
+	if (!bv) {
+		ret = -ENOMEM;
+		goto OUT_DECREF;
+	}
+
+	if (PyTuple_Check(v)) {
+		/* (fd, offset, length) */
+		if (!PyArg_ParseTuple(v, "iLn", &fd, &pos, &len)) {
+			PyErr_Print();
+			free(bv);
+			goto OUT_DECREF;
+		}
+		if (pos < 0) {
+			free(bv);
+			goto OUT_DECREF;
+		}
+		if (len < 0 || (size_t)len > size)
+			len = size;
+
+		*bv = FUSE_BUFVEC_INIT(len);
+		bv->buf[0].flags = FUSE_BUF_IS_FD | FUSE_BUF_FD_SEEK;
+		bv->buf[0].fd = fd;
+		bv->buf[0].pos = pos;
+	} else if (PyObject_CheckBuffer(v)) {
+		/* plain data, just like what read would return */
+		if (PyObject_GetBuffer(v, &buffer, PyBUF_SIMPLE) < 0) {
+			PyErr_Print();
+			free(bv);
+			goto OUT_DECREF;
+		}
+		if ((size_t)buffer.len > size) {
+			PyBuffer_Release(&buffer);
+			free(bv);
+			goto OUT_DECREF;
+		}
+
+		*bv = FUSE_BUFVEC_INIT(buffer.len);
+		bv->buf[0].mem = malloc(buffer.len ? buffer.len : 1);
+		if (!bv->buf[0].mem) {
+			PyBuffer_Release(&buffer);
+			free(bv);
+			ret = -ENOMEM;
+			goto OUT_DECREF;
+		}
+		memcpy(bv->buf[0].mem, buffer.buf, buffer.len);
+		PyBuffer_Release(&buffer);
+	} else {
+		free(bv);
+		goto OUT_DECREF;
+	}
+
+	*bufp = bv;
+	_bytes = fuse_buf_size(bv);
+	ret = 0;
+
+	EPILOGUE
+}
+
+static int
+write_buf_func(const char *path, struct fuse_bufvec *buf, off_t off,
+               struct fuse_file_info *fi)
+{
+	struct fuse_bufvec dst;
+	size_t size = fuse_buf_size(buf);
+	ssize_t res;
+	int fd;
+	unsigned long long pos;
+
+	PROLOGUE(OP_write, PYO_CALLWITHFI(fi, write_buf_cb, PYPATH(path), PYCACHEDINT(size), PYOFF(off)))
+
+	/* (fd, offset) */
+	if (!PyArg_ParseTuple(v, "iK", &fd, &pos)) {
+		PyErr_Print();
+		goto OUT_DECREF;
+	}
+
+	dst = (struct fuse_bufvec)FUSE_BUFVEC_INIT(size);
+	dst.buf[0].flags = FUSE_BUF_IS_FD | FUSE_BUF_FD_SEEK;
+	dst.buf[0].fd = fd;
+	dst.buf[0].pos = pos;
+
+	Py_BEGIN_ALLOW_THREADS
+	res = fuse_buf_copy(&dst, buf, FUSE_BUF_SPLICE_NONBLOCK);
+	Py_END_ALLOW_THREADS
+
+	ret = res;
+
+	EPILOGUE_INVALIDATE( attr_cache_invalidate(path, 0) )
+}
+#endif
+
+#if FUSE_VERSION >= 26
+/*
+ * The low-level API.
+ *
+ * Here the handlers get inode numbers instead of paths, and the reply is
+ * sent by us. An op calls the handler between LL_BEGIN and LL_END, with
+ * a reply function that makes the reply from the result. That returns a
+ * positive errno value on failure, 0 for a plain success reply, or -1
+ * when it has sent the reply itself. A negative integer returned by the
+ * handler is an errno value, as in the high-level API.
+ *
+ * In asyncio mode a handler can also return a concurrent.futures.Future
+ * (cf. AsyncWrapper in fuse.py). Then we hold on to the request, and the
+ * reply is made from the result when the future is done, so the worker
+ * thread is free to go for the next request meanwhile.
+ */
+
+/* the request being served by this thread, for FuseGetContext() */
+static __thread fuse_req_t ll_req = NULL;
+
+/* default cache timeouts, cf. the Entry class */
+static double ll_attr_timeout = 1.0, ll_entry_timeout = 1.0;
+static int ll_write_memoryview = 0;
+
+/* type of the futures returned by handlers in asyncio mode */
+static PyTypeObject *ll_future_type = NULL;
+
+struct ll_call;
+
+typedef int (*ll_reply_t)(struct ll_call *call, PyObject *v);
+
+/* what the reply functions need to know of the request */
+struct ll_call {
+	fuse_req_t req;
+	ll_reply_t reply;
+	size_t size;
+	off_t off;
+	struct fuse_file_info fi;
+	/* for the stats and the trace */
+	int op, tid, deferred;
+	unsigned long long t0, t1;
+	long long bytes;
+	fuse_ino_t ino;
+	uintptr_t fh;
+	uid_t uid;
+	pid_t pid;
+};
+
+#define LL_BEGIN(opnum, inonum, replyfn)			\
+	struct ll_call call = { .req = req, .reply = replyfn,	\
+	                        .op = opnum, .ino = inonum };	\
+	PyObject *v;						\
+	int err;						\
+								\
+	call.t0 = op_begin(opnum);				\
+	PYLOCK();						\
+	call.t1 = monotonic_ns();				\
+	req_fh = NULL;						\
+	ll_req = req;
+
+#define LL_END							\
+	ll_req = NULL;						\
+	call.fh = (uintptr_t)req_fh;				\
+	err = ll_finish(&call, v);				\
+	PYUNLOCK();						\
+	if (err >= 0)						\
+		fuse_reply_err(req, err);
+
+/* what we put in a directory entry if the fs doesn't know the inode */
+#define LL_UNKNOWN_INO 0xffffffff
+
+static int ll_defer(struct ll_call *call, PyObject *fut);
+
+/* record the stats (and trace) of a request done with result ret */
+static void
+ll_op_end(struct ll_call *call, int ret)
+{
+	unsigned long long t2;
+	struct trace_event *ev;
+
+	FT_LOCK(stats_lock);
+	t2 = op_end(call->op, call->t0, call->t1, ret, call->bytes);
+	if (trace.events) {
+		ev = trace_add(call->op, call->t0, call->t1, t2, ret);
+		ev->path[0] = '\0';
+		ev->ino = call->ino;
+		ev->fh = call->fh;
+		ev->uid = call->uid;
+		ev->pid = call->pid;
+		ev->tid = call->tid;
+		ev->deferred = call->deferred;
+	}
+	FT_UNLOCK(stats_lock);
+}
+
+static int
+ll_finish(struct ll_call *call, PyObject *v)
+{
+	const struct fuse_ctx *ctx;
+	int err;
+
+	/* the request is gone once replied to */
+	if (trace.events && !call->deferred) {
+		ctx = fuse_req_ctx(call->req);
+		call->uid = ctx->uid;
+		call->pid = ctx->pid;
+		call->tid = current_tid();
+	}
+
+	if (!v) {
+		PyErr_Print();
+		ll_op_end(call, -EINVAL);
+		return EINVAL;
+	}
+
+	if (PyInt_Check(v) && PyInt_AsLong(v) < 0)
+		err = -PyInt_AsLong(v);
+	else if (ll_future_type && Py_TYPE(v) == ll_future_type) {
+		err = ll_defer(call, v);
+		/* it's still in flight */
+		if (err < 0) {
+			Py_DECREF(v);
+			return err;
+		}
+	} else
+		err = call->reply(call, v);
+	if (PyErr_Occurred())
+		PyErr_Print();
+	Py_DECREF(v);
+
+	ll_op_end(call, err > 0 ? -err : 0);
+
+	return err;
+}
+
+static const char ll_call_name[] = "fuse.ll_call";
+
+static void
+ll_call_destroy(PyObject *cap)
+{
+	struct ll_call *call = PyCapsule_GetPointer(cap, ll_call_name);
+
+	/* the future is gone without getting done */
+	if (call->req) {
+		fuse_reply_err(call->req, EIO);
+		ll_op_end(call, -EIO);
+	}
+	free(call);
+}
+
+static PyObject *
+ll_call_done(PyObject *cap, PyObject *fut)
+{
+	struct ll_call *call = PyCapsule_GetPointer(cap, ll_call_name);
+	int err;
+
+	if (call && call->req) {
+		err = ll_finish(call, fuse_errno_result(
+		        PyObject_CallMethod(fut, "result", NULL)));
+		if (err >= 0)
+			fuse_reply_err(call->req, err);
+		call->req = NULL;
+	}
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyMethodDef ll_call_done_def = {
+	"ll_call_done", (PyCFunction)ll_call_done, METH_O, NULL
+};
+
+/*
+ * Make the reply when the future is done. The request is replied to in
+ * any case, if nothing else, then with EIO when the future is dropped.
+ * Should that not be set up, the error is returned for the caller to
+ * reply with.
+ */
+static int
+ll_defer(struct ll_call *call, PyObject *fut)
+{
+	struct ll_call *pending;
+	PyObject *cap, *cb, *r;
+
+	if (!(pending = malloc(sizeof(*pending))))
+		return ENOMEM;
+	*pending = *call;
+	pending->deferred = 1;
+	if (!(cap = PyCapsule_New(pending, ll_call_name, ll_call_destroy))) {
+		free(pending);
+		return ENOMEM;
+	}
+
+	cb = PyCFunction_New(&ll_call_done_def, cap);
+	r = cb ? PyObject_CallMethod(fut, "add_done_callback", "O", cb) : NULL;
+	Py_XDECREF(cb);
+	if (!r) {
+		/* not the capsule, which the traceback may keep around */
+		pending->req = NULL;
+		Py_DECREF(cap);
+		return EIO;
+	}
+	Py_DECREF(r);
+	Py_DECREF(cap);
+
+	return -1;
+}
+
+static int
+fetch_timeout(PyObject *o, double *res)
+{
+	double d;
+
+	/* None stands for the default */
+	if (!o || o == Py_None)
+		return 0;
+
+	d = PyFloat_AsDouble(o);
+	if (d == -1.0 && PyErr_Occurred())
+		return -1;
+	*res = d;
+
+	return 0;
+}
+
+enum {
+	EN_INO, EN_GENERATION, EN_ATTR, EN_ATTR_TIMEOUT, EN_ENTRY_TIMEOUT,
+	EN_NFIELDS
+};
+
+static const char *entry_field_names[EN_NFIELDS] = {
+	"ino", "generation", "attr", "attr_timeout", "entry_timeout"
+};
+
+static PyObject *entry_field_pynames[EN_NFIELDS];
+
+/*
+ * Convert an Entry (anything with its attributes, only `ino` being
+ * mandatory). An entry with zero ino is a negative lookup result, which
+ * the kernel caches for entry_timeout.
+ */
+static int
+fetch_entry(PyObject *v, struct fuse_entry_param *e)
+{
+	PyObject *items[EN_NFIELDS] = { NULL };
+	unsigned long long ull;
+	int i, ret = -1;
+
+	memset(e, 0, sizeof(*e));
+	e->attr_timeout = ll_attr_timeout;
+	e->entry_timeout = ll_entry_timeout;
+
+	for (i = 0; i < EN_NFIELDS; i++) {
+		items[i] = PyObject_GetAttr(v, entry_field_pynames[i]);
+		if (!items[i]) {
+			if (i == EN_INO ||
+			    !PyErr_ExceptionMatches(PyExc_AttributeError))
+				goto out;
+			PyErr_Clear();
+		}
+	}
+
+	if (py2ull(items[EN_INO], &ull) < 0 ||
+	    (e->ino = ull) != ull)
+		goto bad;
+	if (items[EN_GENERATION] && items[EN_GENERATION] != Py_None) {
+		if (py2ull(items[EN_GENERATION], &ull) < 0 ||
+		    (e->generation = ull) != ull)
+			goto bad;
+	}
+	if (items[EN_ATTR] && items[EN_ATTR] != Py_None) {
+		if (fetch_stat_data(items[EN_ATTR], &e->attr) < 0)
+			goto bad;
+		if (!e->attr.st_ino)
+			e->attr.st_ino = e->ino;
+	} else if (e->ino)
+		goto bad;
+	if (fetch_timeout(items[EN_ATTR_TIMEOUT], &e->attr_timeout) < 0 ||
+	    fetch_timeout(items[EN_ENTRY_TIMEOUT], &e->entry_timeout) < 0)
+		goto out;
+
+	ret = 0;
+	goto out;
+
+bad:
+	if (!PyErr_Occurred())
+		PyErr_SetString(PyExc_TypeError, "invalid entry");
+out:
+	for (i = 0; i < EN_NFIELDS; i++)
+		Py_XDECREF(items[i]);
+
+	return ret;
+}
+
+/*
+ * Store the file handle object returned by open, opendir or create. As
+ * opposed to the high-level API, it's always kept (unless it's None),
+ * until release or releasedir.
+ */
+static void
+ll_set_fh(struct fuse_file_info *fi, PyObject *fh)
+{
+	PyObject *o;
+
+	if (fh == Py_None)
+		return;
+
+	o = PyObject_GetAttrString(fh, "keep_cache");
+	if (o) {
+		fi->keep_cache = PyObject_IsTrue(o);
+		Py_DECREF(o);
+	} else
+		PyErr_Clear();
+	o = PyObject_GetAttrString(fh, "direct_io");
+	if (o) {
+		fi->direct_io = PyObject_IsTrue(o);
+		Py_DECREF(o);
+	} else
+		PyErr_Clear();
+
+	Py_INCREF(fh);
+	fi->fh = (uintptr_t)fh;
+}
+
+/* if the reply didn't make it, there will be no release */
+static void
+ll_unset_fh(struct fuse_file_info *fi)
+{
+	Py_XDECREF(fi_to_py(fi));
+	fi->fh = 0;
+}
+
+/* getattr and setattr get a file info only if called for an open file */
+static __inline PyObject *
+ll_fh(struct fuse_file_info *fi)
+{
+	return fi ? fi_to_py(fi) : NULL;
+}
+
+static PyObject *
+py_fsencode(PyObject *o)
+{
+	if (PyBytes_Check(o)) {
+		Py_INCREF(o);
+		return o;
+	}
+	if (PyUnicode_Check(o))
+#if PY_MAJOR_VERSION >= 3
+		return PyUnicode_EncodeFSDefault(o);
+#else
+		return PyUnicode_AsEncodedString(o, Py_FileSystemDefaultEncoding,
+		                                 NULL);
+#endif
+
+	PyErr_SetString(PyExc_TypeError, "expected str or bytes");
+	return NULL;
+}
+
+/* the reply functions */
+
+static int
+ll_reply_none(struct ll_call *call, PyObject *v)
+{
+	return 0;
+}
+
+static int
+ll_reply_entry(struct ll_call *call, PyObject *v)
+{
+	struct fuse_entry_param e;
+
+	if (fetch_entry(v, &e) < 0)
+		return EINVAL;
+
+	fuse_reply_entry(call->req, &e);
+
+	return -1;
+}
+
+/* attributes come as a stat object, or a (stat, attr_timeout) pair */
+static int
+ll_reply_attr(struct ll_call *call, PyObject *v)
+{
+	struct stat st;
+	double timeout = ll_attr_timeout;
+
+	if (PyTuple_CheckExact(v) && PyTuple_GET_SIZE(v) == 2) {
+		if (fetch_timeout(PyTuple_GET_ITEM(v, 1), &timeout) < 0)
+			return EINVAL;
+		v = PyTuple_GET_ITEM(v, 0);
+	}
+
+	memset(&st, 0, sizeof(st));
+	if (fetch_stat_data(v, &st) < 0)
+		return EINVAL;
+
+	fuse_reply_attr(call->req, &st, timeout);
+
+	return -1;
+}
+
+static int
+ll_reply_readlink(struct ll_call *call, PyObject *v)
+{
+	PyObject *b;
+
+	if (!(b = py_fsencode(v)))
+		return EINVAL;
+	fuse_reply_readlink(call->req, PyBytes_AS_STRING(b));
+	Py_DECREF(b);
+
+	return -1;
+}
+
+static int
+ll_reply_open(struct ll_call *call, PyObject *v)
+{
+	ll_set_fh(&call->fi, v);
+	if (fuse_reply_open(call->req, &call->fi))
+		ll_unset_fh(&call->fi);
+
+	return -1;
+}
+
+/* create returns an Entry, or an (Entry, file handle) pair */
+static int
+ll_reply_create(struct ll_call *call, PyObject *v)
+{
+	struct fuse_entry_param e;
+	PyObject *fh = Py_None;
+
+	if (PyTuple_Check(v) && PyTuple_GET_SIZE(v) == 2) {
+		fh = PyTuple_GET_ITEM(v, 1);
+		v = PyTuple_GET_ITEM(v, 0);
+	}
+	if (fetch_entry(v, &e) < 0)
+		return EINVAL;
+
+	ll_set_fh(&call->fi, fh);
+	if (fuse_reply_create(call->req, &e, &call->fi))
+		ll_unset_fh(&call->fi);
+
+	return -1;
+}
+
+static int
+ll_reply_data(struct ll_call *call, PyObject *v)
+{
+	Py_buffer buffer;
+	int err = EINVAL;
+
+	if (PyObject_GetBuffer(v, &buffer, PyBUF_SIMPLE) < 0)
+		return err;
+
+	if ((size_t)buffer.len <= call->size) {
+		/* the buffer is pinned, no need to hold the GIL meanwhile */
+		Py_BEGIN_ALLOW_THREADS
+		fuse_reply_buf(call->req, buffer.buf, buffer.len);
+		Py_END_ALLOW_THREADS
+		call->bytes = buffer.len;
+		err = -1;
+	}
+	PyBuffer_Release(&buffer);
+
+	return err;
+}
+
+static int
+ll_reply_write(struct ll_call *call, PyObject *v)
+{
+	if (!PyInt_Check(v))
+		return EINVAL;
+
+	call->bytes = PyInt_AsLong(v);
+	fuse_reply_write(call->req, call->bytes);
+
+	return -1;
+}
+
+/*
+ * Add an entry to the readdir reply. Returns 1 if the entry did not fit
+ * in, -1 on error.
+ */
+static int
+ll_add_direntry(fuse_req_t req, char *buf, size_t size, size_t *pos,
+                PyObject *v, off_t nextoff)
+{
+	PyObject *holder;
+	const char *name;
+	struct stat st;
+	off_t offset;
+	size_t len;
+
+	if (fetch_direntry(v, &st, &offset, &name, &holder) < 0)
+		return -1;
+	if (!st.st_ino)
+		st.st_ino = LL_UNKNOWN_INO;
+
+	len = fuse_add_direntry(req, buf + *pos, size - *pos, name, &st,
+	                        offset ? offset : nextoff);
+	Py_DECREF(holder);
+	if (len > size - *pos)
+		return 1;
+	*pos += len;
+
+	return 0;
+}
+
+#if FUSE_MAJOR_VERSION >= 3
+struct ll_direntry_plus {
+	struct fuse_entry_param e;
+	const char *name;
+	PyObject *holder;
+	off_t off;
+	int looked_up;
+};
+
+/*
+ * Reply to readdirplus with the entries of v, along with what lookup
+ * gives for them. Each lookup counts as one for forget(), so first the
+ * entries which fit in are converted, and only if all of them could be
+ * are they looked up; should the reply still fail, the lookups are
+ * undone with forget(). Entries for which there's no lookup result go
+ * without attributes, as in a plain readdir reply. (A coroutine lookup
+ * is never run from here, cf. LowLevelFuse.main.)
+ */
+static int
+ll_reply_dirplus(struct ll_call *call, PyObject *v)
+{
+	PyObject *iter = NULL, *w, *lookup;
+	struct ll_direntry_plus *ents = NULL, *ent;
+	struct fuse_entry_param le;
+	size_t n = 0, alloc = 0, i, pos = 0, len;
+	char *buf = NULL;
+	int r = EINVAL;
+
+	if (!(iter = PyObject_GetIter(v)))
+		return EINVAL;
+
+	while ((w = PyIter_Next(iter))) {
+		if (n == alloc) {
+			alloc = alloc ? 2 * alloc : 16;
+			ent = realloc(ents, alloc * sizeof(*ents));
+			if (!ent) {
+				Py_DECREF(w);
+				r = ENOMEM;
+				goto out;
+			}
+			ents = ent;
+		}
+		ent = &ents[n];
+		memset(&ent->e, 0, sizeof(ent->e));
+		ent->looked_up = 0;
+		if (fetch_direntry(w, &ent->e.attr, &ent->off, &ent->name,
+		                   &ent->holder) < 0) {
+			Py_DECREF(w);
+			goto out;
+		}
+		Py_DECREF(w);
+		if (!ent->e.attr.st_ino)
+			ent->e.attr.st_ino = LL_UNKNOWN_INO;
+		if (!ent->off)
+			ent->off = call->off + n + 1;
+
+		len = fuse_add_direntry_plus(call->req, NULL, 0, ent->name,
+		                             NULL, 0);
+		if (len > call->size - pos) {
+			Py_DECREF(ent->holder);
+			break;
+		}
+		pos += len;
+		n++;
+	}
+	if (PyErr_Occurred() || !(buf = malloc(call->size))) {
+		if (!PyErr_Occurred())
+			r = ENOMEM;
+		goto out;
+	}
+
+	lookup = readdirplus_lookup_cb ? readdirplus_lookup_cb : lookup_cb;
+	pos = 0;
+	for (i = 0; i < n; i++) {
+		ent = &ents[i];
+		if (strcmp(ent->name, ".") && strcmp(ent->name, "..")) {
+			w = PYO_CALL(lookup, PYUINT(call->ino),
+			             PYSTR(ent->name));
+			if (w && w != Py_None && !PyInt_Check(w) &&
+			    fetch_entry(w, &le) == 0 && le.ino) {
+				ent->e = le;
+				ent->looked_up = 1;
+			}
+			if (PyErr_Occurred())
+				PyErr_Print();
+			Py_XDECREF(w);
+		}
+		pos += fuse_add_direntry_plus(call->req, buf + pos,
+		                              call->size - pos, ent->name,
+		                              &ent->e, ent->off);
+	}
+	if (fuse_reply_buf(call->req, buf, pos) && forget_cb) {
+		for (i = 0; i < n; i++) {
+			if (!ents[i].looked_up)
+				continue;
+			w = PYO_CALL(forget_cb, PYUINT(ents[i].e.ino),
+			             PYUINT(1));
+			if (w)
+				Py_DECREF(w);
+			else
+				PyErr_Print();
+		}
+	}
+	r = -1;
+
+out:
+	for (i = 0; i < n; i++)
+		Py_DECREF(ents[i].holder);
+	free(ents);
+	free(buf);
+	Py_DECREF(iter);
+
+	return r;
+}
+#endif
+
+/*
+ * Entries without an offset of their own get off + n as the offset,
+ * where n is their (one based) position in the result. That is, an fs
+ * which does not care about offsets should start listing from the
+ * off-th entry.
+ */
+static int
+ll_reply_dir(struct ll_call *call, PyObject *v)
+{
+	PyObject *iter = NULL, *w;
+	Py_ssize_t i;
+	size_t pos = 0;
+	char *buf;
+	int r;
+
+	if (!(PyList_CheckExact(v) || PyTuple_CheckExact(v)) &&
+	    !(iter = PyObject_GetIter(v)))
+		return EINVAL;
+	if (!(buf = malloc(call->size))) {
+		Py_XDECREF(iter);
+		return ENOMEM;
+	}
+
+	for (i = 0;; i++) {
+		if (iter) {
+			if (!(w = PyIter_Next(iter)))
+				break;
+		} else {
+			if (i >= PySequence_Fast_GET_SIZE(v))
+				break;
+			w = PySequence_Fast_GET_ITEM(v, i);
+			Py_INCREF(w);
+		}
+		r = ll_add_direntry(call->req, buf, call->size, &pos, w,
+		                    call->off + i + 1);
+		Py_DECREF(w);
+		if (r)
+			break;
+	}
+	Py_XDECREF(iter);
+
+	r = EINVAL;
+	if (!PyErr_Occurred()) {
+		fuse_reply_buf(call->req, buf, pos);
+		r = -1;
+	}
+	free(buf);
+
+	return r;
+}
+
+static int
+ll_reply_statfs(struct ll_call *call, PyObject *v)
+{
+	struct statvfs fst;
+
+	memset(&fst, 0, sizeof(fst));
+	if (fetch_statfs_data(v, &fst) < 0)
+		return EINVAL;
+
+	fuse_reply_statfs(call->req, &fst);
+
+	return -1;
+}
+
+/* reply the value of an attribute, or the list of attributes */
+static int
+ll_reply_xattr_buf(fuse_req_t req, const char *buf, size_t len, size_t size)
+{
+	if (size == 0)
+		fuse_reply_xattr(req, len);
+	else if (len > size)
+		return ERANGE;
+	else
+		fuse_reply_buf(req, buf, len);
+
+	return -1;
+}
+
+static int
+ll_reply_getxattr(struct ll_call *call, PyObject *v)
+{
+	PyObject *b;
+	int err;
+
+	/* as in the high-level API, the size can be given instead of the value */
+	if (PyInt_Check(v))
+		return ll_reply_xattr_buf(call->req, NULL, PyInt_AsLong(v), 0);
+
+	if (!(b = py_fsencode(v)))
+		return EINVAL;
+	err = ll_reply_xattr_buf(call->req, PyBytes_AS_STRING(b),
+	                         PyBytes_GET_SIZE(b), call->size);
+	Py_DECREF(b);
+
+	return err;
+}
+
+static int
+ll_reply_listxattr(struct ll_call *call, PyObject *v)
+{
+	PyObject *names, *b;
+	Py_ssize_t i, n;
+	size_t len = 0;
+	char *buf, *p;
+	int err = EINVAL;
+
+	if (PyInt_Check(v))
+		return ll_reply_xattr_buf(call->req, NULL, PyInt_AsLong(v), 0);
+
+	if (!(names = PySequence_List(v)))
+		return err;
+	n = PyList_GET_SIZE(names);
+	for (i = 0; i < n; i++) {
+		if (!(b = py_fsencode(PyList_GET_ITEM(names, i))))
+			break;
+		len += PyBytes_GET_SIZE(b) + 1;
+		PyList_SetItem(names, i, b);
+	}
+
+	/* the reply is the names with their terminating null bytes */
+	if (i == n) {
+		if ((buf = malloc(len + 1))) {
+			for (p = buf, i = 0; i < n; i++) {
+				b = PyList_GET_ITEM(names, i);
+				memcpy(p, PyBytes_AS_STRING(b),
+				       PyBytes_GET_SIZE(b) + 1);
+				p += PyBytes_GET_SIZE(b) + 1;
+			}
+			err = ll_reply_xattr_buf(call->req, buf, len,
+			                         call->size);
+			free(buf);
+		} else
+			err = ENOMEM;
+	}
+	Py_DECREF(names);
+
+	return err;
+}
+
+/* the ops */
+
+static void
+ll_init_func(void *userdata, struct fuse_conn_info *conn)
+{
+	(void)userdata;
+
+#if FUSE_MAJOR_VERSION >= 3
+	fsinit_func(conn, NULL);
+#else
+	fsinit_func(conn);
+#endif
+}
+
+static void
+ll_lookup_func(fuse_req_t req, fuse_ino_t parent, const char *name)
+{
+	LL_BEGIN(OP_lookup, parent, ll_reply_entry)
+	v = PYO_CALL(lookup_cb, PYUINT(parent), PYSTR(name));
+	LL_END
+}
+
+#if FUSE_MAJOR_VERSION >= 3
+static void
+ll_forget_func(fuse_req_t req, fuse_ino_t ino, uint64_t nlookup)
+#else
+static void
+ll_forget_func(fuse_req_t req, fuse_ino_t ino, unsigned long nlookup)
+#endif
+{
+	PyObject *v;
+
+	/* there is no way to report an error here */
+	PYLOCK();
+	v = PYO_CALL(forget_cb, PYUINT(ino), PYUINT(nlookup));
+	if (v)
+		Py_DECREF(v);
+	else
+		PyErr_Print();
+	PYUNLOCK();
+
+	fuse_reply_none(req);
+}
+
+static void
+ll_getattr_func(fuse_req_t req, fuse_ino_t ino, struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_getattr, ino, ll_reply_attr)
+	v = PYO_CALLWITHFH(getattr_cb, ll_fh(fi), PYUINT(ino));
+	LL_END
+}
+
+static PyObject *
+ll_setattr_arg(struct stat *attr, int to_set)
+{
+	StatObject *so;
+
+	so = (StatObject *)PyType_GenericNew(Stat_Type, NULL, NULL);
+	if (!so)
+		return NULL;
+
+#define setfield(idx, val)						\
+	if (!(so->fields[idx] = (val)))					\
+		goto err;
+
+	if (to_set & FUSE_SET_ATTR_MODE) {
+		setfield(STF_MODE, PyLong_FromUnsignedLong(attr->st_mode));
+	}
+	if (to_set & FUSE_SET_ATTR_UID) {
+		setfield(STF_UID, PyLong_FromUnsignedLong(attr->st_uid));
+	}
+	if (to_set & FUSE_SET_ATTR_GID) {
+		setfield(STF_GID, PyLong_FromUnsignedLong(attr->st_gid));
+	}
+	if (to_set & FUSE_SET_ATTR_SIZE) {
+		setfield(STF_SIZE, PyLong_FromLongLong(attr->st_size));
+	}
+#ifdef __APPLE__
+	if (to_set & FUSE_SET_ATTR_ATIME) {
+		setfield(STF_ATIME, PyFloat_FromDouble(attr->st_atimespec.tv_sec +
+		                                       attr->st_atimespec.tv_nsec * 1e-9));
+	}
+	if (to_set & FUSE_SET_ATTR_MTIME) {
+		setfield(STF_MTIME, PyFloat_FromDouble(attr->st_mtimespec.tv_sec +
+		                                       attr->st_mtimespec.tv_nsec * 1e-9));
+	}
+#else
+	if (to_set & FUSE_SET_ATTR_ATIME) {
+		setfield(STF_ATIME, PyFloat_FromDouble(attr->st_atim.tv_sec +
+		                                       attr->st_atim.tv_nsec * 1e-9));
+	}
+	if (to_set & FUSE_SET_ATTR_MTIME) {
+		setfield(STF_MTIME, PyFloat_FromDouble(attr->st_mtim.tv_sec +
+		                                       attr->st_mtim.tv_nsec * 1e-9));
+	}
+#endif
+
+#undef setfield
+
+	return (PyObject *)so;
+
+err:
+	Py_DECREF(so);
+	return NULL;
+}
+
+static void
+ll_setattr_func(fuse_req_t req, fuse_ino_t ino, struct stat *attr, int to_set,
+                struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_setattr, ino, ll_reply_attr)
+	v = PYO_CALLWITHFH(setattr_cb, ll_fh(fi), PYUINT(ino),
+	                   ll_setattr_arg(attr, to_set), PYINT(to_set));
+	LL_END
+}
+
+static void
+ll_readlink_func(fuse_req_t req, fuse_ino_t ino)
+{
+	LL_BEGIN(OP_readlink, ino, ll_reply_readlink)
+	v = PYO_CALL(readlink_cb, PYUINT(ino));
+	LL_END
+}
+
+static void
+ll_mknod_func(fuse_req_t req, fuse_ino_t parent, const char *name,
+              mode_t mode, dev_t rdev)
+{
+	LL_BEGIN(OP_mknod, parent, ll_reply_entry)
+	v = PYO_CALL(mknod_cb, PYUINT(parent), PYSTR(name), PYCACHEDINT(mode),
+	             PYOFF(rdev));
+	LL_END
+}
+
+static void
+ll_mkdir_func(fuse_req_t req, fuse_ino_t parent, const char *name, mode_t mode)
+{
+	LL_BEGIN(OP_mkdir, parent, ll_reply_entry)
+	v = PYO_CALL(mkdir_cb, PYUINT(parent), PYSTR(name), PYCACHEDINT(mode));
+	LL_END
+}
+
+static void
+ll_unlink_func(fuse_req_t req, fuse_ino_t parent, const char *name)
+{
+	LL_BEGIN(OP_unlink, parent, ll_reply_none)
+	v = PYO_CALL(unlink_cb, PYUINT(parent), PYSTR(name));
+	LL_END
+}
+
+static void
+ll_rmdir_func(fuse_req_t req, fuse_ino_t parent, const char *name)
+{
+	LL_BEGIN(OP_rmdir, parent, ll_reply_none)
+	v = PYO_CALL(rmdir_cb, PYUINT(parent), PYSTR(name));
+	LL_END
+}
+
+static void
+ll_symlink_func(fuse_req_t req, const char *link, fuse_ino_t parent,
+                const char *name)
+{
+	LL_BEGIN(OP_symlink, parent, ll_reply_entry)
+	v = PYO_CALL(symlink_cb, PYSTR(link), PYUINT(parent), PYSTR(name));
+	LL_END
+}
+
+#if FUSE_MAJOR_VERSION >= 3
+static void
+ll_rename_func(fuse_req_t req, fuse_ino_t parent, const char *name,
+               fuse_ino_t newparent, const char *newname, unsigned int flags)
+{
+	/* RENAME_NOREPLACE and RENAME_EXCHANGE can't be passed on */
+	if (flags) {
+		fuse_reply_err(req, EINVAL);
+		return;
+	}
+#else
+static void
+ll_rename_func(fuse_req_t req, fuse_ino_t parent, const char *name,
+               fuse_ino_t newparent, const char *newname)
+{
+#endif
+	LL_BEGIN(OP_rename, parent, ll_reply_none)
+	v = PYO_CALL(rename_cb, PYUINT(parent), PYSTR(name), PYUINT(newparent),
+	             PYSTR(newname));
+	LL_END
+}
+
+static void
+ll_link_func(fuse_req_t req, fuse_ino_t ino, fuse_ino_t newparent,
+             const char *newname)
+{
+	LL_BEGIN(OP_link, ino, ll_reply_entry)
+	v = PYO_CALL(link_cb, PYUINT(ino), PYUINT(newparent), PYSTR(newname));
+	LL_END
+}
+
+static void
+ll_open_func(fuse_req_t req, fuse_ino_t ino, struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_open, ino, ll_reply_open)
+	call.fi = *fi;
+	v = PYO_CALL(open_cb, PYUINT(ino), PYCACHEDINT(fi->flags));
+	LL_END
+}
+
+static void
+ll_read_func(fuse_req_t req, fuse_ino_t ino, size_t size, off_t off,
+             struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_read, ino, ll_reply_data)
+	call.size = size;
+	v = PYO_CALLWITHFI(fi, read_cb, PYUINT(ino), PYCACHEDINT(size),
+	                   PYOFF(off));
+	LL_END
+}
+
+static PyObject *
+ll_write_call(fuse_ino_t ino, const char *buf, size_t size, off_t off,
+              struct fuse_file_info *fi)
+{
+#if PY_VERSION_HEX >= 0x03030000
+	PyObject *mv, *v;
+
+	if (ll_write_memoryview) {
+		mv = PyMemoryView_FromMemory((char *)buf, size, PyBUF_READ);
+		if (!mv)
+			return NULL;
+
+		Py_INCREF(mv);
+		v = PYO_CALLWITHFI(fi, write_cb, PYUINT(ino), mv, PYOFF(off));
+
+		return memoryview_release(mv, v);
+	}
+#endif
+
+	return PYO_CALLWITHFI(fi, write_cb, PYUINT(ino), PYBYTES(buf, size),
+	                      PYOFF(off));
+}
+
+static void
+ll_write_func(fuse_req_t req, fuse_ino_t ino, const char *buf, size_t size,
+              off_t off, struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_write, ino, ll_reply_write)
+	v = ll_write_call(ino, buf, size, off, fi);
+	LL_END
+}
+
+static void
+ll_flush_func(fuse_req_t req, fuse_ino_t ino, struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_flush, ino, ll_reply_none)
+	v = PYO_CALLWITHFI(fi, flush_cb, PYUINT(ino));
+	LL_END
+}
+
+static void
+ll_release_func(fuse_req_t req, fuse_ino_t ino, struct fuse_file_info *fi)
+{
+	/* this is where we drop the filehandle reference */
+	if (!release_cb) {
+		PYLOCK();
+		ll_unset_fh(fi);
+		PYUNLOCK();
+		fuse_reply_err(req, 0);
+		return;
+	}
+
+	LL_BEGIN(OP_release, ino, ll_reply_none)
+	v = (req_fh = fi_to_py(fi)) ?
+	    PYO_CALL(release_cb, PYUINT(ino), PYCACHEDINT(fi->flags),
+	             fi_to_py(fi)) :
+	    PYO_CALL(release_cb, PYUINT(ino), PYCACHEDINT(fi->flags));
+	LL_END
+}
+
+static void
+ll_fsync_func(fuse_req_t req, fuse_ino_t ino, int datasync,
+              struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_fsync, ino, ll_reply_none)
+	v = PYO_CALLWITHFI(fi, fsync_cb, PYUINT(ino), PYINT(datasync));
+	LL_END
+}
+
+static void
+ll_opendir_func(fuse_req_t req, fuse_ino_t ino, struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_opendir, ino, ll_reply_open)
+	call.fi = *fi;
+	v = PYO_CALL(opendir_cb, PYUINT(ino));
+	LL_END
+}
+
+static void
+ll_readdir_func(fuse_req_t req, fuse_ino_t ino, size_t size, off_t off,
+                struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_readdir, ino, ll_reply_dir)
+	call.size = size;
+	call.off = off;
+	v = PYO_CALLWITHFI(fi, readdir_cb, PYUINT(ino), PYOFF(off));
+	LL_END
+}
+
+#if FUSE_MAJOR_VERSION >= 3
+/* readdir, with the entries looked up (cf. ll_reply_dirplus()) */
+static void
+ll_readdirplus_func(fuse_req_t req, fuse_ino_t ino, size_t size, off_t off,
+                    struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_readdirplus, ino, ll_reply_dirplus)
+	call.size = size;
+	call.off = off;
+	v = PYO_CALLWITHFI(fi, readdir_cb, PYUINT(ino), PYOFF(off));
+	LL_END
+}
+#endif
+
+static void
+ll_releasedir_func(fuse_req_t req, fuse_ino_t ino, struct fuse_file_info *fi)
+{
+	if (!releasedir_cb) {
+		PYLOCK();
+		ll_unset_fh(fi);
+		PYUNLOCK();
+		fuse_reply_err(req, 0);
+		return;
+	}
+
+	LL_BEGIN(OP_releasedir, ino, ll_reply_none)
+	v = (req_fh = fi_to_py(fi)) ?
+	    PYO_CALL(releasedir_cb, PYUINT(ino), fi_to_py(fi)) :
+	    PYO_CALL(releasedir_cb, PYUINT(ino));
+	LL_END
+}
+
+static void
+ll_fsyncdir_func(fuse_req_t req, fuse_ino_t ino, int datasync,
+                 struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_fsyncdir, ino, ll_reply_none)
+	v = PYO_CALLWITHFI(fi, fsyncdir_cb, PYUINT(ino), PYINT(datasync));
+	LL_END
+}
+
+static void
+ll_statfs_func(fuse_req_t req, fuse_ino_t ino)
+{
+	LL_BEGIN(OP_statfs, ino, ll_reply_statfs)
+	v = PYO_CALL0(statfs_cb);
+	LL_END
+}
+
+static void
+ll_setxattr_func(fuse_req_t req, fuse_ino_t ino, const char *name,
+                 const char *value, size_t size, int flags)
+{
+	LL_BEGIN(OP_setxattr, ino, ll_reply_none)
+	v = PYO_CALL(setxattr_cb, PYUINT(ino), PYSTR(name),
+	             PYBYTES(value, size), PYCACHEDINT(flags));
+	LL_END
+}
+
+static void
+ll_getxattr_func(fuse_req_t req, fuse_ino_t ino, const char *name, size_t size)
+{
+	LL_BEGIN(OP_getxattr, ino, ll_reply_getxattr)
+	call.size = size;
+	v = PYO_CALL(getxattr_cb, PYUINT(ino), PYSTR(name), PYCACHEDINT(size));
+	LL_END
+}
+
+static void
+ll_listxattr_func(fuse_req_t req, fuse_ino_t ino, size_t size)
+{
+	LL_BEGIN(OP_listxattr, ino, ll_reply_listxattr)
+	call.size = size;
+	v = PYO_CALL(listxattr_cb, PYUINT(ino), PYCACHEDINT(size));
+	LL_END
+}
+
+static void
+ll_removexattr_func(fuse_req_t req, fuse_ino_t ino, const char *name)
+{
+	LL_BEGIN(OP_removexattr, ino, ll_reply_none)
+	v = PYO_CALL(removexattr_cb, PYUINT(ino), PYSTR(name));
+	LL_END
+}
+
+static void
+ll_access_func(fuse_req_t req, fuse_ino_t ino, int mask)
+{
+	LL_BEGIN(OP_access, ino, ll_reply_none)
+	v = PYO_CALL(access_cb, PYUINT(ino), PYCACHEDINT(mask));
+	LL_END
+}
+
+static void
+ll_create_func(fuse_req_t req, fuse_ino_t parent, const char *name,
+               mode_t mode, struct fuse_file_info *fi)
+{
+	LL_BEGIN(OP_create, parent, ll_reply_create)
+	call.fi = *fi;
+	v = PYO_CALL(create_cb, PYUINT(parent), PYSTR(name), PYCACHEDINT(mode),
+	             PYCACHEDINT(fi->flags));
+	LL_END
+}
+#endif /* FUSE_VERSION >= 26 */
+
+#ifdef PYFUSE_SESSION_LOOP
+/*
+ * The multithreaded loop, after the one of libfuse 2.9, which can't be
+ * told how many threads to have. Each worker reads a request, starts a
+ * new worker if no other one is left idle (that is, waiting for a
+ * request), then serves the request; afterwards, it exits if there are
+ * more idle workers than max_idle. We also keep to max_threads, and
+ * with gil_aware, don't start a worker while as many of them as can
+ * run Python code at once (one, unless the GIL is disabled) are waiting
+ * for the GIL already, as the new one would just join them. It gets
+ * started later, if there's still no idle worker when the GIL is taken
+ * by a waiter (cf. loop_gil_taken()).
+ */
+
+struct loop_worker {
+	struct loop_worker *prev, *next;
+	pthread_t thread;
+#if FUSE_MAJOR_VERSION >= 3
+	struct fuse_buf fbuf;	/* its memory is allocated by the lib */
 #else
-static int
-setxattr_func(const char *path, const char *name, const char *value,
-              size_t size, int flags)
+	size_t bufsize;
+	char *buf;
+#endif
+};
+
+static struct {
+	pthread_mutex_t lock;
+	struct fuse_session *se;
+#if FUSE_MAJOR_VERSION < 3
+	struct fuse_chan *ch;
 #endif
+	struct loop_worker workers;	/* head of the list of them */
+	int nworkers;
+	int nidle;
+	int cpus;		/* can run Python code at once */
+	int deferred;		/* a worker is due, held back for the GIL */
+	int exit;
+	int error;
+	sem_t finish;
+} loop;
+
+/* the start of struct fuse_in_header of the kernel, and the forget ops */
+struct loop_in_header {
+	uint32_t len;
+	uint32_t opcode;
+};
+#define LOOP_FUSE_FORGET	2
+#define LOOP_FUSE_BATCH_FORGET	42
+
+static void *loop_work(void *data);
+
+static void
+loop_free_worker(struct loop_worker *w)
 {
-	PROLOGUE(
-#ifdef FIX_PATH_DECODING
-	  PyObject_CallFunction(setxattr_cb, "O&O&s#i", &Path_AsDecodedUnicode, path, &Path_AsDecodedUnicode, name, value, size,
+#if FUSE_MAJOR_VERSION >= 3
+	free(w->fbuf.mem);
 #else
-	  PyObject_CallFunction(setxattr_cb, "sss#i", path, name, value, size,
+	free(w->buf);
 #endif
-	                        flags)
-	)
-	EPILOGUE
+	free(w);
 }
 
+/* whether a new worker may be started, with loop.lock held */
 static int
-removexattr_func(const char *path, const char *name)
+loop_may_start(void)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(removexattr_cb, "O&O&", &Path_AsDecodedUnicode, path, &Path_AsDecodedUnicode, name) )
-#else
-	PROLOGUE( PyObject_CallFunction(removexattr_cb, "ss", path, name) )
-#endif
-	EPILOGUE
+	if (loop_conf.max_threads && loop.nworkers >= loop_conf.max_threads)
+		return 0;
+	if (loop_conf.gil_aware &&
+	    __atomic_load_n(&gil_waiting, __ATOMIC_RELAXED) >= loop.cpus) {
+		loop.deferred = 1;
+		return 0;
+	}
+
+	return 1;
 }
 
-#if FUSE_VERSION >= 25
+/* start a worker, with loop.lock held */
 static int
-access_func(const char *path, int mask)
+loop_start_worker(void)
 {
-#ifdef FIX_PATH_DECODING
-	PROLOGUE( PyObject_CallFunction(access_cb, "O&i", &Path_AsDecodedUnicode, path, mask) )
-#else
-	PROLOGUE( PyObject_CallFunction(access_cb, "si", path, mask) )
+	struct loop_worker *w;
+	pthread_attr_t attr;
+	sigset_t set, oldset;
+	char *stack_size;
+	int res;
+
+	if (!(w = calloc(1, sizeof(*w))))
+		return -1;
+#if FUSE_MAJOR_VERSION < 3
+	w->bufsize = fuse_chan_bufsize(loop.ch);
+	if (!(w->buf = malloc(w->bufsize))) {
+		free(w);
+		return -1;
+	}
 #endif
-	EPILOGUE
+
+	pthread_attr_init(&attr);
+	if (loop_conf.stack_size)
+		pthread_attr_setstacksize(&attr, loop_conf.stack_size);
+	else if ((stack_size = getenv("FUSE_THREAD_STACK")) &&
+	         pthread_attr_setstacksize(&attr, atoi(stack_size)))
+		fprintf(stderr, "fuse: invalid stack size: %s\n", stack_size);
+
+	/* signals are for the main thread */
+	sigemptyset(&set);
+	sigaddset(&set, SIGTERM);
+	sigaddset(&set, SIGINT);
+	sigaddset(&set, SIGHUP);
+	sigaddset(&set, SIGQUIT);
+	pthread_sigmask(SIG_BLOCK, &set, &oldset);
+	res = pthread_create(&w->thread, &attr, loop_work, w);
+	pthread_sigmask(SIG_SETMASK, &oldset, NULL);
+	pthread_attr_destroy(&attr);
+	if (res) {
+		fprintf(stderr, "fuse: error creating thread: %s\n",
+		        strerror(res));
+		loop_free_worker(w);
+		return -1;
+	}
+
+	w->next = &loop.workers;
+	w->prev = loop.workers.prev;
+	w->prev->next = w;
+	loop.workers.prev = w;
+	loop.nworkers++;
+	loop.nidle++;
+
+	return 0;
 }
-#endif
 
-#if FUSE_VERSION >= 23
-#if FUSE_VERSION >= 26
-static void *
-fsinit_func(struct fuse_conn_info *conn)
+static void
+loop_unlink_worker(struct loop_worker *w)
 {
-	(void)conn;
-#else
+	w->prev->next = w->next;
+	w->next->prev = w->prev;
+}
+
 static void *
-fsinit_func(void)
+loop_work(void *data)
 {
+	struct loop_worker *w = data;
+#if FUSE_MAJOR_VERSION >= 3
+	/* kept between requests, so that its memory is reused */
+	struct fuse_buf *fbuf = &w->fbuf;
+#else
+	struct fuse_chan *ch;
+	struct fuse_buf sbuf, *fbuf = &sbuf;
 #endif
-	PYLOCK();
-	PyObject_CallFunction(fsinit_cb, "");
-	PYUNLOCK();
+	uint32_t opcode;
+	int res, forget;
+
+	while (!fuse_session_exited(loop.se)) {
+#if FUSE_MAJOR_VERSION < 3
+		ch = loop.ch;
+		memset(fbuf, 0, sizeof(*fbuf));
+		fbuf->mem = w->buf;
+		fbuf->size = w->bufsize;
+#endif
+
+		pthread_setcancelstate(PTHREAD_CANCEL_ENABLE, NULL);
+#if FUSE_MAJOR_VERSION >= 3
+		res = fuse_session_receive_buf(loop.se, fbuf);
+#else
+		res = fuse_session_receive_buf(loop.se, fbuf, &ch);
+#endif
+		pthread_setcancelstate(PTHREAD_CANCEL_DISABLE, NULL);
+		if (res == -EINTR)
+			continue;
+		if (res <= 0) {
+			if (res < 0) {
+				fuse_session_exit(loop.se);
+				loop.error = -1;
+			}
+			break;
+		}
+
+		/* these come in bursts, and don't take long */
+		forget = 0;
+		if (!(fbuf->flags & FUSE_BUF_IS_FD)) {
+			opcode = ((struct loop_in_header *)fbuf->mem)->opcode;
+			forget = opcode == LOOP_FUSE_FORGET ||
+			         opcode == LOOP_FUSE_BATCH_FORGET;
+		}
+
+		pthread_mutex_lock(&loop.lock);
+		if (loop.exit) {
+			pthread_mutex_unlock(&loop.lock);
+			return NULL;
+		}
+		if (!forget)
+			loop.nidle--;
+		if (!loop.nidle && loop_may_start())
+			loop_start_worker();
+		pthread_mutex_unlock(&loop.lock);
+
+#if FUSE_MAJOR_VERSION >= 3
+		fuse_session_process_buf(loop.se, fbuf);
+#else
+		fuse_session_process_buf(loop.se, fbuf, ch);
+#endif
+
+		pthread_mutex_lock(&loop.lock);
+		if (!forget)
+			loop.nidle++;
+		if (loop_conf.max_idle >= 0 && loop.nidle > loop_conf.max_idle &&
+		    loop.nworkers > 1) {
+			if (loop.exit) {
+				pthread_mutex_unlock(&loop.lock);
+				return NULL;
+			}
+			loop_unlink_worker(w);
+			loop.nidle--;
+			loop.nworkers--;
+			pthread_mutex_unlock(&loop.lock);
+
+			pthread_detach(w->thread);
+			loop_free_worker(w);
+			return NULL;
+		}
+		pthread_mutex_unlock(&loop.lock);
+	}
 
+	sem_post(&loop.finish);
 	return NULL;
 }
 
+/*
+ * A worker took the GIL (which it holds). Start the worker held back
+ * for it, if it's still due.
+ */
 static void
-fsdestroy_func(void *param)
+loop_gil_taken(void)
 {
-	(void)param;
-
-	PYLOCK();
-	PyObject_CallFunction(fsdestroy_cb, "");
-	PYUNLOCK();
+	if (__atomic_sub_fetch(&gil_waiting, 1, __ATOMIC_RELAXED) >= loop.cpus ||
+	    !__atomic_load_n(&loop.deferred, __ATOMIC_RELAXED))
+		return;
+
+	pthread_mutex_lock(&loop.lock);
+	if (loop.deferred && !loop.exit) {
+		loop.deferred = 0;
+		if (!loop.nidle && loop_may_start())
+			loop_start_worker();
+	}
+	pthread_mutex_unlock(&loop.lock);
 }
-#endif
 
-#if FUSE_VERSION >= 26
-static inline PyObject *
-lock_func_i(const char *path, struct fuse_file_info *fi, int cmd,
-            struct flock *lock)
+static int
+loop_session(struct fuse_session *se)
 {
-	PyObject *pyargs, *pykw = NULL, *v = NULL;
+	struct loop_worker *w;
+	int err;
 
-	pyargs =
-	fi_to_py(fi) ?
-#ifdef FIX_PATH_DECODING
-	Py_BuildValue("(O&iKO)", &Path_AsDecodedUnicode, path, cmd, fi->lock_owner, fi_to_py(fi)) :
-	Py_BuildValue("(O&iK)", &Path_AsDecodedUnicode, path, cmd, fi->lock_owner);
+	memset(&loop, 0, sizeof(loop));
+	loop.se = se;
+#if FUSE_MAJOR_VERSION < 3
+	loop.ch = fuse_session_next_chan(se, NULL);
+#endif
+	loop.workers.prev = loop.workers.next = &loop.workers;
+#ifdef Py_GIL_DISABLED
+	if ((loop.cpus = sysconf(_SC_NPROCESSORS_ONLN)) < 1)
+		loop.cpus = 1;
 #else
-	Py_BuildValue("(siKO)", path, cmd, fi->lock_owner, fi_to_py(fi)) :
-	Py_BuildValue("(siK)", path, cmd, fi->lock_owner);
+	loop.cpus = 1;
 #endif
-	if (! pyargs)
-		goto out;
-
-	pykw = Py_BuildValue("{sisKsKsi}",
-	                     "l_type",  lock->l_type,
-	                     "l_start", lock->l_start,
-	                     "l_len",   lock->l_len,
-	                     "l_pid",   lock->l_pid);
-	if (! pykw)
-		goto out;
-
-	v = PyObject_Call(lock_cb, pyargs, pykw);
+	sem_init(&loop.finish, 0, 0);
+	pthread_mutex_init(&loop.lock, NULL);
+
+	pthread_mutex_lock(&loop.lock);
+	err = loop_start_worker();
+	pthread_mutex_unlock(&loop.lock);
+	if (!err) {
+		/* sem_wait() is interrupted by the exit signals */
+		while (!fuse_session_exited(se))
+			sem_wait(&loop.finish);
+
+		pthread_mutex_lock(&loop.lock);
+		for (w = loop.workers.next; w != &loop.workers; w = w->next)
+			pthread_cancel(w->thread);
+		loop.exit = 1;
+		pthread_mutex_unlock(&loop.lock);
+
+		while ((w = loop.workers.next) != &loop.workers) {
+			pthread_join(w->thread, NULL);
+			pthread_mutex_lock(&loop.lock);
+			loop_unlink_worker(w);
+			pthread_mutex_unlock(&loop.lock);
+			loop_free_worker(w);
+		}
+		err = loop.error;
+	}
 
-out:
-	Py_XDECREF(pyargs);
-	Py_XDECREF(pykw);
+	pthread_mutex_destroy(&loop.lock);
+	sem_destroy(&loop.finish);
+	fuse_session_reset(se);
 
-	return v;
+	return err;
 }
+#endif /* PYFUSE_SESSION_LOOP */
 
+/*
+ * Check and set the settings of the multithreaded loop, as passed to
+ * main() and lowlevel_main().
+ */
 static int
-lock_func(const char *path, struct fuse_file_info *fi, int cmd,
-          struct flock *lock)
+loop_configure(int max_threads, int max_idle, Py_ssize_t stack_size,
+               int gil_aware, int clone_fd)
 {
-	PyObject *pytmp;
-	unsigned long long ctmp;
-
-	PROLOGUE( lock_func_i(path, fi, cmd, lock) )
-
-	fetchattr_soft(lock, l_type);
-	fetchattr_soft(lock, l_start);
-	fetchattr_soft(lock, l_len);
-	fetchattr_soft(lock, l_pid);
+	if (max_threads < 0) {
+		PyErr_SetString(PyExc_ValueError,
+		                "max_threads must not be negative");
+		return -1;
+	}
+	if (max_idle < -1) {
+		PyErr_SetString(PyExc_ValueError,
+		                "max_idle_threads must be -1 or more");
+		return -1;
+	}
+	if (stack_size < 0 ||
+	    (stack_size && stack_size < (Py_ssize_t)PTHREAD_STACK_MIN)) {
+		PyErr_Format(PyExc_ValueError,
+		             "stack_size must be 0 or at least %ld",
+		             (long)PTHREAD_STACK_MIN);
+		return -1;
+	}
+#ifndef PYFUSE_SESSION_LOOP
+	if ((max_threads || max_idle != 10 || stack_size || gil_aware) &&
+	    PyErr_WarnEx(NULL, "the multithreaded loop can't be configured "
+	                       "with this build", 1) < 0)
+		return -1;
+#endif
+#if FUSE_MAJOR_VERSION >= 3
+	/* that's up to the loop of libfuse, which only has max_idle */
+	if (clone_fd && (max_threads || stack_size || gil_aware) &&
+	    PyErr_WarnEx(NULL, "with clone_fd, only max_idle_threads of the "
+	                       "multithreaded loop can be set", 1) < 0)
+		return -1;
+#else
+	if (clone_fd &&
+	    PyErr_WarnEx(NULL, "clone_fd needs libfuse 3", 1) < 0)
+		return -1;
+	clone_fd = 0;
+#endif
 
-	ret = 0;
+	loop_conf.max_threads = max_threads;
+	loop_conf.max_idle = max_idle;
+	loop_conf.stack_size = stack_size;
+	loop_conf.gil_aware = gil_aware;
+	loop_conf.clone_fd = clone_fd;
 
-	EPILOGUE
+	return 0;
 }
 
+/*
+ * Check and set what to ask of the kernel for the connection, as passed
+ * to main() and lowlevel_main().
+ */
 static int
-utimens_func(const char *path, const struct timespec ts[2])
+conn_configure(int writeback_cache, int readdirplus)
 {
-	PROLOGUE(
-	  PyObject_CallFunction(
-	#ifdef FIX_PATH_DECODING
-                                utimens_cb, "O&iiii", &Path_AsDecodedUnicode, path,
-	#else
-                                utimens_cb, "siiii", path,
-	#endif
-	                        ts[0].tv_sec, ts[0].tv_nsec,
-	                        ts[1].tv_sec, ts[1].tv_nsec)
-        )
+#if FUSE_MAJOR_VERSION < 3
+	if ((writeback_cache || readdirplus) &&
+	    PyErr_WarnEx(NULL, "writeback_cache and readdirplus need "
+	                       "libfuse 3", 1) < 0)
+		return -1;
+	writeback_cache = readdirplus = 0;
+#endif
 
-	EPILOGUE
+	conn_conf.writeback_cache = writeback_cache;
+	conn_conf.readdirplus = readdirplus;
+
+	return 0;
 }
 
+/* run the multithreaded loop of either the high-level or the low-level lib */
 static int
-bmap_func(const char *path, size_t blocksize, uint64_t *idx)
+pyfuse_loop_mt(struct fuse *f, struct fuse_session *se)
 {
-	PyObject *pytmp;
-	unsigned long long ctmp;
-	struct { uint64_t idx; } idxwrapper;
+	int err = -1;
+#ifdef WITH_THREAD
+	PyThreadState *save;
+#if FUSE_MAJOR_VERSION >= 3
+	struct fuse_loop_config config = {
+		.clone_fd = loop_conf.clone_fd,
+		.max_idle_threads = loop_conf.max_idle < 0 ?
+		                    UINT_MAX : (unsigned int)loop_conf.max_idle,
+	};
+#endif
 
-	PROLOGUE(
-#if PY_VERSION_HEX < 0x02050000
-	  PyObject_CallFunction(bmap_cb, "siK", path, blocksize, *idx)
-#else
-#ifdef FIX_PATH_DECODING
-	  PyObject_CallFunction(bmap_cb, "O&nK", &Path_AsDecodedUnicode, path, blocksize, *idx)
+#if PY_VERSION_HEX < 0x03070000
+	PyEval_InitThreads();
+#endif
+	interp = PyThreadState_Get()->interp;
+#if PY_MAJOR_VERSION >= 3
+	pthread_once(&worker_key_once, worker_key_create);
+	workers_persistent = worker_key_ok;
+#endif
+	save = PyEval_SaveThread();
+#if FUSE_MAJOR_VERSION >= 3
+	/* the workers read from fds of their own, which only libfuse can do */
+	if (loop_conf.clone_fd)
+		err = f ? fuse_loop_mt(f, &config) :
+		          fuse_session_loop_mt(se, &config);
+	else
+#endif
+#ifdef PYFUSE_SESSION_LOOP
+	if (!f)
+		err = loop_session(se);
+	else if (fuse_start_cleanup_thread(f) == 0) {
+		err = loop_session(fuse_get_session(f));
+		fuse_stop_cleanup_thread(f);
+	}
+#elif FUSE_MAJOR_VERSION >= 3
+	err = f ? fuse_loop_mt(f, &config) : fuse_session_loop_mt(se, &config);
+#elif FUSE_VERSION >= 26
+	err = f ? fuse_loop_mt(f) : fuse_session_loop_mt(se);
 #else
-	  PyObject_CallFunction(bmap_cb, "snK", path, blocksize, *idx)
+	err = fuse_loop_mt(f);
+#endif
+	PyEval_RestoreThread(save);
+#if PY_MAJOR_VERSION >= 3
+	/* the workers are gone by now, with their thread states */
+	workers_persistent = 0;
 #endif
+	interp = NULL;
 #endif
-	)
 
-	/*
-	 * We can make use of our py -> C numeric conversion macro with some
-	 * customization of the parameters...
-	 */
-	pytmp = v;
-	Py_INCREF(pytmp);
-	py2attr(&idxwrapper, idx);
+	return(err);
+}
 
-	*idx = idxwrapper.idx;
-	ret = 0;
+/* we are the only worker */
+static void
+call_worker_init(void)
+{
+	PyObject *v;
 
-	EPILOGUE
+	if (!worker_init_cb)
+		return;
+
+	v = PyObject_CallObject(worker_init_cb, NULL);
+	if (v)
+		Py_DECREF(v);
+	else
+		PyErr_Print();
 }
-#endif
 
-#if FUSE_VERSION >= 28
+/*
+ * Run the single-threaded loop. The callbacks take the GIL on their own
+ * (cf. PYLOCK), so we can let other Python threads, like the one of an
+ * asyncio event loop, run while waiting for requests.
+ */
 static int
-ioctl_func(const char *path, int cmd, void *arg,
-	   struct fuse_file_info *fi, unsigned int flags, void *data)
+pyfuse_loop(struct fuse *f, struct fuse_session *se)
 {
-	char* s;
-	char* input_data;
-	Py_ssize_t input_data_size, output_data_size;
-
-	input_data = (char*) data;
-	input_data_size = _IOC_SIZE(cmd);
-
-	// If not a "write" ioctl, do not send input data
-	if(!(_IOC_DIR(cmd) & _IOC_WRITE)) {
-		input_data = NULL;
-		input_data_size = 0;
-	}
+	int err;
 
+	interp = NULL;
+	call_worker_init();
 #if PY_MAJOR_VERSION >= 3
-#ifdef FIX_PATH_DECODING
-	PROLOGUE(PYO_CALLWITHFI(fi, ioctl_cb, O&Iy#I, &Path_AsDecodedUnicode, path,cmd,(char*)input_data,input_data_size,flags));
-#else
-	PROLOGUE(PYO_CALLWITHFI(fi, ioctl_cb, sIy#I, path,cmd,(char*)input_data,input_data_size,flags));
+	Py_BEGIN_ALLOW_THREADS
 #endif
+#if FUSE_VERSION >= 26
+	err = f ? fuse_loop(f) : fuse_session_loop(se);
 #else
-	PROLOGUE(PYO_CALLWITHFI(fi, ioctl_cb, sIs#I, path,cmd,(char*)input_data,input_data_size,flags));
+	err = fuse_loop(f);
+#endif
+#if PY_MAJOR_VERSION >= 3
+	Py_END_ALLOW_THREADS
 #endif
 
-	// get returned value if this is a "read" ioctl
-	if(_IOC_DIR(cmd) & _IOC_READ) {
+	return err;
+}
 
-#if PY_MAJOR_VERSION >= 3
-		if(!PyBytes_Check(v)) {
-			ret = -EINVAL;
-			goto OUT_DECREF;
-		}
+/*
+ * Make an argv for the lib from the fuse_args sequence. The strings are
+ * kept alive by *holder, which is to be released after the argv.
+ */
+static char **
+make_fuse_argv(PyObject *fargseq, int *fargcp, PyObject **holder)
+{
+	PyObject *pa, *pb;
+	char **fargv;
+	int fargc, i;
 
-		output_data_size = PyBytes_Size(v);
+	if (!fargseq || !PySequence_Check(fargseq) ||
+	    (fargc = PySequence_Length(fargseq)) <= 0) {
+		PyErr_SetString(PyExc_TypeError,
+		                "fuse_args is not a non-empty sequence");
+		return NULL;
+	}
 
-		s = PyBytes_AsString(v);
-#else
+	if (!(*holder = PyTuple_New(fargc)))
+		return NULL;
+	fargv = malloc(fargc * sizeof(char *));
+	if (!fargv) {
+		Py_DECREF(*holder);
+		PyErr_NoMemory();
+		return NULL;
+	}
 
-		if(!PyString_Check(v)) {
-			ret = -EINVAL;
-			goto OUT_DECREF;
+	for (i = 0; i < fargc; i++) {
+		pa = PySequence_GetItem(fargseq, i);
+		if (!pa)
+			goto err;
+		if (!PyString_Check(pa)) {
+			Py_DECREF(pa);
+			PyErr_SetString(PyExc_TypeError,
+			                "fuse argument is not a string");
+			goto err;
+		}
+#ifdef FIX_PATH_DECODING
+		pb = PyUnicode_EncodeFSDefault(pa);
+		Py_DECREF(pa);
+		if (!pb)
+			goto err;
+		fargv[i] = PyBytes_AsString(pb);
+#else
+		pb = pa;
+		if (!(fargv[i] = PyString_AsString(pb))) {
+			Py_DECREF(pb);
+			goto err;
 		}
+#endif
+		PyTuple_SET_ITEM(*holder, i, pb);
+	}
 
-		output_data_size = PyString_Size(v);
+	*fargcp = fargc;
+	return fargv;
 
-		s = PyString_AsString(v);
-#endif
+err:
+	free(fargv);
+	Py_DECREF(*holder);
+	return NULL;
+}
 
-		if(output_data_size > _IOC_SIZE(cmd))
-			output_data_size = _IOC_SIZE(cmd);
+/* the filesystem being served, for Invalidate() from other threads */
+static struct fuse *fuse=NULL;
+
+/*
+ * The callbacks, the caches and the statistics are those of the filesystem
+ * served by the main interpreter. Sub-interpreters can use the types, the
+ * request context and the slots, but not the rest.
+ */
+static int
+check_main_interpreter(PyObject *self)
+{
+	if (PyThreadState_Get()->interp == PyInterpreterState_Main())
+		return 0;
+	PyErr_SetString(FUSE_ERROR(self),
+	                "only available in the main interpreter");
+	return -1;
+}
+
+/*
+ * One filesystem is served at a time, as the callbacks and the caches are
+ * process wide. The service loop runs with the GIL released, so even
+ * with the GIL, that takes an atomic flag.
+ */
+static int serving = 0;
 
-		memcpy(data,s,output_data_size);
-		ret = 0;
+static int
+serving_begin(PyObject *self)
+{
+	int idle = 0;
+
+	if (check_main_interpreter(self) < 0)
+		return -1;
+	if (!__atomic_compare_exchange_n(&serving, &idle, 1, 0,
+	                                 __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE)) {
+		PyErr_SetString(FUSE_ERROR(self),
+		                "a filesystem is being served already");
+		return -1;
 	}
-	EPILOGUE
+
+	return 0;
 }
 
-static const char pollhandle_name[] = "pollhandle";
+#define CB_HOLD(name)	Py_XINCREF(name ## _cb);
+#define CB_DROP(name)				\
+	if (owned)				\
+		Py_XDECREF(name ## _cb);	\
+	name ## _cb = NULL;
 
+/* take references to the callbacks, once set from the arguments of main() */
 static void
-pollhandle_destructor(PyObject *p)
+callbacks_hold(void)
 {
-	struct fuse_pollhandle *ph;
-
-	ph = PyCapsule_GetPointer(p, pollhandle_name);
-	fuse_pollhandle_destroy(ph);
+	FUSE_CALLBACKS(CB_HOLD)
 }
 
-static int
-poll_func(const char *path, struct fuse_file_info *fi,
-	  struct fuse_pollhandle *ph, unsigned *reventsp)
+/* unset the callbacks, dropping the references to them if owned */
+static void
+callbacks_drop(int owned)
 {
-	PyObject *pollhandle = Py_None;
-	int ret = -EINVAL;
-	PyObject *v;
+	FUSE_CALLBACKS(CB_DROP)
+}
 
-	PYLOCK();
+#undef CB_HOLD
+#undef CB_DROP
 
-	if (ph) {
-		pollhandle = PyCapsule_New(ph, pollhandle_name, pollhandle_destructor);
-		if (!pollhandle) {
-			PyErr_Print();
-			goto OUT;
-		}
-	}
+static void
+serving_end(void)
+{
+	callbacks_drop(1);
+	__atomic_store_n(&serving, 0, __ATOMIC_RELEASE);
+}
 
-#ifdef FIX_PATH_DECODING
-	v = PYO_CALLWITHFI(fi, poll_cb, O&O, &Path_AsDecodedUnicode, path, pollhandle);
-#else
-	v = PYO_CALLWITHFI(fi, poll_cb, sO, path, pollhandle);
-#endif
-	if (!v) {
-		PyErr_Print();
-		goto OUT;
+#if FUSE_MAJOR_VERSION >= 3
+/*
+ * libfuse 3 has no fuse_setup() and fuse_teardown() any more, these do
+ * what those did.
+ */
+static struct fuse *
+pyfuse_setup(struct fuse_args *args, const struct fuse_operations *op,
+             size_t op_size)
+{
+	struct fuse_cmdline_opts opts;
+	struct fuse *f = NULL;
+
+	memset(&opts, 0, sizeof(opts));
+	if (fuse_parse_cmdline(args, &opts) == -1)
+		return NULL;
+	if (opts.show_version) {
+		fuse_lowlevel_version();
+		goto out;
 	}
-	if (v == Py_None) {
-		ret = 0;
-		goto OUT_DECREF;
+	if (opts.show_help) {
+		fuse_cmdline_help();
+		fuse_lib_help(args);
+		goto out;
 	}
-	if (PyInt_Check(v)) {
-		ret = PyInt_AsLong(v);
-		goto OUT_DECREF;
+	if (!opts.mountpoint) {
+		fprintf(stderr, "fuse: no mount point\n");
+		goto out;
 	}
+	if (opts.clone_fd)
+		loop_conf.clone_fd = 1;
 
-OUT_DECREF:
-	Py_DECREF(v);
-OUT:
-	if (ph)
-		Py_DECREF(pollhandle);
-
-	PYUNLOCK();
-
-	if (ret > 0) {
-		*reventsp = ret;
-		ret = 0;
-	}
+	if (!(f = fuse_new(args, op, op_size, NULL)))
+		goto out;
+	if (fuse_mount(f, opts.mountpoint) == -1)
+		goto out_destroy;
+	if (fuse_daemonize(opts.foreground) == -1 ||
+	    fuse_set_signal_handlers(fuse_get_session(f)) == -1)
+		goto out_unmount;
+	goto out;
+
+out_unmount:
+	fuse_unmount(f);
+out_destroy:
+	fuse_destroy(f);
+	f = NULL;
+out:
+	free(opts.mountpoint);
 
-	return ret;
+	return f;
 }
-#endif
 
-static int
-pyfuse_loop_mt(struct fuse *f)
+static void
+pyfuse_teardown(struct fuse *f)
 {
-	int err = -1;
-#ifdef WITH_THREAD
-	PyThreadState *save;
-
-#if PY_VERSION_HEX < 0x03070000
-	PyEval_InitThreads();
-#endif
-	interp = PyThreadState_Get()->interp;
-	save = PyEval_SaveThread();
-	err = fuse_loop_mt(f);
-	PyEval_RestoreThread(save);
-	interp = NULL;
-#endif
-
-	return(err);
+	fuse_remove_signal_handlers(fuse_get_session(f));
+	fuse_unmount(f);
+	fuse_destroy(f);
 }
-
-static struct fuse *fuse=NULL;
+#endif
 
 static PyObject *
-Fuse_main(PyObject *self, PyObject *args, PyObject *kw)
+fuse_main_serve(PyObject *self, PyObject *args, PyObject *kw)
 {
+#if FUSE_MAJOR_VERSION >= 3
+	struct fuse_args fa;
+#else
+	char *fmp;
+	int mthp;
 #if FUSE_VERSION < 26
 	int fd;
 #endif
-	int multithreaded=0, mthp;
-	PyObject *fargseq = NULL;
+#endif
+	int multithreaded=0, write_memoryview=0, path_cache_size=0;
+	int max_threads = 0, max_idle = 10, gil_aware = 0, clone_fd = 0;
+	int writeback_cache = 0, readdirplus = 0;
+	double attr_cache_ttl = 0;
+	Py_ssize_t attr_cache_memory = 4 << 20, trace_size = 0, stack_size = 0;
+	PyObject *fargseq = NULL, *fargholder;
 	int err;
-	int i;
-	char *fmp;
 	struct fuse_operations op;
+	struct fuse *f;
 	int fargc;
 	char **fargv;
 
@@ -1375,14 +4976,19 @@ Fuse_main(PyObject *self, PyObject *args, PyObject *kw)
 		"create", "opendir", "releasedir", "fsyncdir", "flush",
 	        "ftruncate", "fgetattr", "getxattr", "listxattr", "setxattr",
 	        "removexattr", "access", "lock", "utimens", "bmap",
-		"fsinit", "fsdestroy", "ioctl",  "poll", "fuse_args",
-		"multithreaded", NULL
+		"fsinit", "fsdestroy", "ioctl",  "poll", "readinto",
+		"read_buf", "write_buf", "fuse_args", "multithreaded", "write_memoryview",
+		"path_cache_size", "worker_init", "attr_cache_ttl",
+		"attr_cache_memory", "trace_size", "max_threads",
+		"max_idle_threads", "stack_size", "gil_aware", "clone_fd",
+		"writeback_cache", "readdirplus", "copy_file_range", "fallocate",
+		"lseek", NULL
 	};
 
 	memset(&op, 0, sizeof(op));
 
 	if (!PyArg_ParseTupleAndKeywords(args, kw,
-	                                 "|OOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOi",
+	                                 "|OOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOiiiOdnniiniiiiOOO",
 	                                 kwlist, &getattr_cb, &readlink_cb,
 	                                 &readdir_cb, &mknod_cb, &mkdir_cb,
 	                                 &unlink_cb, &rmdir_cb, &symlink_cb,
@@ -1398,20 +5004,41 @@ Fuse_main(PyObject *self, PyObject *args, PyObject *kw)
 	                                 &removexattr_cb, &access_cb,
 	                                 &lock_cb, &utimens_cb, &bmap_cb,
 	                                 &fsinit_cb, &fsdestroy_cb, &ioctl_cb,
-	                                 &poll_cb, &fargseq, &multithreaded))
+	                                 &poll_cb, &readinto_cb, &read_buf_cb,
+	                                 &write_buf_cb, &fargseq,
+	                                 &multithreaded, &write_memoryview,
+	                                 &path_cache_size, &worker_init_cb,
+	                                 &attr_cache_ttl, &attr_cache_memory,
+	                                 &trace_size, &max_threads, &max_idle,
+	                                 &stack_size, &gil_aware, &clone_fd,
+	                                 &writeback_cache, &readdirplus,
+	                                 &copy_file_range_cb, &fallocate_cb,
+	                                 &lseek_cb)) {
+		callbacks_drop(0);
+		return NULL;
+	}
+
+	if (worker_init_cb == Py_None)
+		worker_init_cb = NULL;
+	callbacks_hold();
+
+	if (path_cache_init(path_cache_size) < 0 ||
+	    attr_cache_init(attr_cache_ttl, attr_cache_memory) < 0 ||
+	    trace_init(trace_size) < 0 ||
+	    loop_configure(max_threads, max_idle, stack_size, gil_aware,
+	                   clone_fd) < 0 ||
+	    conn_configure(writeback_cache, readdirplus) < 0)
 		return NULL;
 
 #define DO_ONE_ATTR_AS(fname, pyname)		\
-	 if(pyname ## _cb) {			\
-		Py_INCREF(pyname ## _cb);	\
+	 if(pyname ## _cb)			\
 		op.fname = pyname ## _func;	\
-	} else					\
+	else					\
 		op.fname = NULL;
 
 #define DO_ONE_ATTR(name)			\
 	DO_ONE_ATTR_AS(name, name)
 
-	DO_ONE_ATTR(getattr);
 	DO_ONE_ATTR(readlink);
 #if FUSE_VERSION >= 23
 	DO_ONE_ATTR(opendir);
@@ -1426,12 +5053,7 @@ Fuse_main(PyObject *self, PyObject *args, PyObject *kw)
 	DO_ONE_ATTR(unlink);
 	DO_ONE_ATTR(rmdir);
 	DO_ONE_ATTR(symlink);
-	DO_ONE_ATTR(rename);
 	DO_ONE_ATTR(link);
-	DO_ONE_ATTR(chmod);
-	DO_ONE_ATTR(chown);
-	DO_ONE_ATTR(truncate);
-	DO_ONE_ATTR(utime);
 	DO_ONE_ATTR(open);
 	DO_ONE_ATTR(read);
 	DO_ONE_ATTR(write);
@@ -1444,14 +5066,11 @@ Fuse_main(PyObject *self, PyObject *args, PyObject *kw)
 	DO_ONE_ATTR(setxattr);
 	DO_ONE_ATTR(removexattr);
 #if FUSE_VERSION >= 25
-	DO_ONE_ATTR(ftruncate);
-	DO_ONE_ATTR(fgetattr);
 	DO_ONE_ATTR(access);
 	DO_ONE_ATTR(create);
 #endif
 #if FUSE_VERSION >= 26
 	DO_ONE_ATTR(lock);
-	DO_ONE_ATTR(utimens);
 	DO_ONE_ATTR(bmap);
 #endif
 #if FUSE_VERSION >= 23
@@ -1462,114 +5081,472 @@ Fuse_main(PyObject *self, PyObject *args, PyObject *kw)
 	DO_ONE_ATTR(ioctl);
 	DO_ONE_ATTR(poll);
 #endif
+#if FUSE_VERSION >= 29
+	DO_ONE_ATTR(read_buf);
+	DO_ONE_ATTR(write_buf);
+	if (read_buf_cb || write_buf_cb)
+		op.init = fsinit_func;
+#endif
+#ifdef HAVE_FALLOCATE_OP
+	DO_ONE_ATTR(fallocate);
+#endif
+#if FUSE_AT_LEAST(3, 4)
+	DO_ONE_ATTR(copy_file_range);
+#endif
+#if FUSE_AT_LEAST(3, 8)
+	DO_ONE_ATTR(lseek);
+#endif
+#if FUSE_MAJOR_VERSION >= 3
+	if (getattr_cb || fgetattr_cb)
+		op.getattr = getattr3_func;
+	if (rename_cb)
+		op.rename = rename3_func;
+	if (chmod_cb)
+		op.chmod = chmod3_func;
+	if (chown_cb)
+		op.chown = chown3_func;
+	if (truncate_cb || ftruncate_cb)
+		op.truncate = truncate3_func;
+	if (utimens_cb || utime_cb)
+		op.utimens = utimens3_func;
+	/* we have the connection to set up in any case */
+	op.init = fsinit_func;
+#else
+	DO_ONE_ATTR(getattr);
+	DO_ONE_ATTR(rename);
+	DO_ONE_ATTR(chmod);
+	DO_ONE_ATTR(chown);
+	DO_ONE_ATTR(truncate);
+	DO_ONE_ATTR(utime);
+#if FUSE_VERSION >= 25
+	DO_ONE_ATTR(ftruncate);
+	DO_ONE_ATTR(fgetattr);
+#endif
+#if FUSE_VERSION >= 26
+	DO_ONE_ATTR(utimens);
+#endif
+#endif
+#if FUSE_VERSION >= 22
+	/* we have to drop the file handles even if the fs doesn't care */
+	if (open_cb || create_cb)
+		op.release = release_func;
+#endif
+#if FUSE_VERSION >= 23
+	if (opendir_cb)
+		op.releasedir = releasedir_func;
+#endif
+#if FUSE_VERSION >= 22 && PY_VERSION_HEX >= 0x03030000
+	/* readinto takes precedence over read if both are available */
+	if (readinto_cb)
+		op.read = readinto_func;
+	if (write_memoryview && write_cb)
+		op.write = write_mv_func;
+#endif
 
 #undef DO_ONE_ATTR
 #undef DO_ONE_ATTR_AS
 
-	if (!fargseq || !PySequence_Check(fargseq) ||
-            (fargc = PySequence_Length(fargseq)) == 0) {
-		PyErr_SetString(PyExc_TypeError,
-		                "fuse_args is not a non-empty sequence");
-		return(NULL);
-	}
+	if (!(fargv = make_fuse_argv(fargseq, &fargc, &fargholder)))
+		return NULL;
 
-	fargv = malloc(fargc * sizeof(char *));
-	if (!fargv)
-		return(PyErr_NoMemory());
-#ifdef FIX_PATH_DECODING
-	PyObject **tmp_bytes = malloc(fargc * sizeof(PyObject *));
-	if (!tmp_bytes)
-		return(PyErr_NoMemory());
+	/*
+   	 * We don't use the mthp value, set below. We just pass it on so that
+   	 * the lib won't end up in dereferring a NULL pointer.
+   	 * (Later versions check for NULL, nevertheless we play safe.)
+   	 */
+#if FUSE_MAJOR_VERSION >= 3
+	fa.argc = fargc;
+	fa.argv = fargv;
+	fa.allocated = 0;
+	f = pyfuse_setup(&fa, &op, sizeof(op));
+	fuse_opt_free_args(&fa);
+#elif FUSE_VERSION >= 26
+	f = fuse_setup(fargc, fargv, &op, sizeof(op), &fmp, &mthp, NULL);
+#elif FUSE_VERSION >= 22
+	f = fuse_setup(fargc, fargv, &op, sizeof(op), &fmp, &mthp, &fd);
+#else
+	f = __fuse_setup(fargc, fargv, &op, &fmp, &mthp, &fd);
 #endif
 
-	if (fargseq) {
-		for (i=0; i < fargc; i++) {
-			PyObject *pa;
+	free(fargv);
+	Py_DECREF(fargholder);
 
-			pa = PySequence_GetItem(fargseq, i);
-			if (!PyString_Check(pa)) {
-				Py_DECREF(pa);
+	if (f == NULL) {
+		PyErr_SetString(FUSE_ERROR(self), "filesystem initialization failed");
 
-				PyErr_SetString(PyExc_TypeError,
-			                        "fuse argument is not a string");
-		                return(NULL);
-			}
-#ifdef FIX_PATH_DECODING
-			tmp_bytes[i] = PyUnicode_EncodeFSDefault(pa);
-			fargv[i] = PyBytes_AsString(tmp_bytes[i]);
+		return (NULL);
+	}
+	__atomic_store_n(&fuse, f, __ATOMIC_RELEASE);
+
+#ifndef WITH_THREAD
+	if (multithreaded) {
+		multithreaded = 0;
+#if PY_MAJOR_VERSION > 2 || (PY_MAJOR_VERSION == 2 && PY_MINOR_VERSION >= 5)
+		PyErr_WarnEx(NULL, "Python thread support not available, "
+		                   "enforcing single-threaded operation", 1);
+#else
+		PyErr_Warn(NULL, "Python thread support not available, "
+		                 "enforcing single-threaded operation");
+#endif
+	}
+#endif
+
+	if (multithreaded)
+		err = pyfuse_loop_mt(f, NULL);
+	else
+		err = pyfuse_loop(f, NULL);
+
+	__atomic_store_n(&fuse, NULL, __ATOMIC_RELEASE);
+#if FUSE_MAJOR_VERSION >= 3
+	pyfuse_teardown(f);
+#elif FUSE_VERSION >= 26
+	fuse_teardown(f, fmp);
+#elif FUSE_VERSION >= 22
+	fuse_teardown(f, fd, fmp);
 #else
-			fargv[i] =  PyString_AsString(pa);
+	__fuse_teardown(f, fd, fmp);
 #endif
 
-			Py_DECREF(pa);
-		}
+	path_cache_clear();
+	attr_cache_clear();
+
+	if (err == -1) {
+		PyErr_SetString(FUSE_ERROR(self), "service loop failed");
+
+		return (NULL);
 	}
 
-	/*
-   	 * We don't use the mthp value, set below. We just pass it on so that
-   	 * the lib won't end up in dereferring a NULL pointer.
-   	 * (Later versions check for NULL, nevertheless we play safe.)
-   	 */
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *
+Fuse_main(PyObject *self, PyObject *args, PyObject *kw)
+{
+	PyObject *ret;
+
+	if (serving_begin(self) < 0)
+		return NULL;
+	ret = fuse_main_serve(self, args, kw);
+	serving_end();
+
+	return ret;
+}
+
 #if FUSE_VERSION >= 26
-	fuse = fuse_setup(fargc, fargv, &op, sizeof(op), &fmp, &mthp, NULL);
-#elif FUSE_VERSION >= 22
-	fuse = fuse_setup(fargc, fargv, &op, sizeof(op), &fmp, &mthp, &fd);
+/* what the notify functions take, while a low-level fs is running */
+#if FUSE_MAJOR_VERSION >= 3
+typedef struct fuse_session ll_notify_t;
 #else
-	fuse = __fuse_setup(fargc, fargv, &op, &fmp, &mthp, &fd);
+typedef struct fuse_chan ll_notify_t;
 #endif
+static ll_notify_t *ll_notify = NULL;
 
-#ifdef FIX_PATH_DECODING
-	for (i=0; i < fargc; i++)
-		Py_DECREF(tmp_bytes[i]);
+static PyObject *
+fuse_lowlevel_serve(PyObject *self, PyObject *args, PyObject *kw)
+{
+	int multithreaded = 0, write_memoryview = 0, foreground = 0;
+	int max_threads = 0, max_idle = 10, gil_aware = 0, clone_fd = 0;
+	int writeback_cache = 0, readdirplus = 0;
+	double attr_timeout = 1.0, entry_timeout = 1.0;
+	Py_ssize_t trace_size = 0, stack_size = 0;
+	PyObject *fargseq = NULL, *fargholder, *future_type = NULL;
+	struct fuse_lowlevel_ops op;
+	struct fuse_args fa;
+	struct fuse_session *se;
+#if FUSE_MAJOR_VERSION >= 3
+	struct fuse_cmdline_opts opts;
+#else
+	struct fuse_chan *ch;
+#endif
+	char *mountpoint = NULL;
+	char **fargv;
+	int fargc, err = -1, running = 0;
+
+	static char *kwlist[] = {
+		"lookup", "forget", "getattr", "setattr", "readlink",
+		"mknod", "mkdir", "unlink", "rmdir", "symlink", "rename",
+		"link", "open", "read", "write", "flush", "release", "fsync",
+		"opendir", "readdir", "releasedir", "fsyncdir", "statfs",
+		"setxattr", "getxattr", "listxattr", "removexattr", "access",
+		"create", "fsinit", "fsdestroy", "fuse_args", "multithreaded",
+		"write_memoryview", "worker_init", "attr_timeout",
+		"entry_timeout", "future_type", "trace_size", "max_threads",
+		"max_idle_threads", "stack_size", "gil_aware", "clone_fd",
+		"writeback_cache", "readdirplus", "readdirplus_lookup", NULL
+	};
+
+	memset(&op, 0, sizeof(op));
+
+	if (!PyArg_ParseTupleAndKeywords(args, kw,
+	                                 "|OOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOiiOddOniiniiiiO",
+	                                 kwlist, &lookup_cb, &forget_cb,
+	                                 &getattr_cb, &setattr_cb,
+	                                 &readlink_cb, &mknod_cb, &mkdir_cb,
+	                                 &unlink_cb, &rmdir_cb, &symlink_cb,
+	                                 &rename_cb, &link_cb, &open_cb,
+	                                 &read_cb, &write_cb, &flush_cb,
+	                                 &release_cb, &fsync_cb, &opendir_cb,
+	                                 &readdir_cb, &releasedir_cb,
+	                                 &fsyncdir_cb, &statfs_cb,
+	                                 &setxattr_cb, &getxattr_cb,
+	                                 &listxattr_cb, &removexattr_cb,
+	                                 &access_cb, &create_cb, &fsinit_cb,
+	                                 &fsdestroy_cb, &fargseq,
+	                                 &multithreaded, &write_memoryview,
+	                                 &worker_init_cb, &attr_timeout,
+	                                 &entry_timeout, &future_type,
+	                                 &trace_size, &max_threads, &max_idle,
+	                                 &stack_size, &gil_aware, &clone_fd,
+	                                 &writeback_cache, &readdirplus,
+	                                 &readdirplus_lookup_cb)) {
+		callbacks_drop(0);
+		return NULL;
+	}
+
+	if (worker_init_cb == Py_None)
+		worker_init_cb = NULL;
+	callbacks_hold();
 
-	free(tmp_bytes);
+	if (trace_init(trace_size) < 0 ||
+	    loop_configure(max_threads, max_idle, stack_size, gil_aware,
+	                   clone_fd) < 0 ||
+	    conn_configure(writeback_cache, readdirplus) < 0)
+		return NULL;
+
+	if (future_type == Py_None)
+		future_type = NULL;
+	if (future_type && !PyType_Check(future_type)) {
+		PyErr_SetString(PyExc_TypeError, "future_type must be a type");
+
+		return NULL;
+	}
+	Py_XINCREF(future_type);
+	Py_XDECREF(ll_future_type);
+	ll_future_type = (PyTypeObject *)future_type;
+
+	ll_attr_timeout = attr_timeout;
+	ll_entry_timeout = entry_timeout;
+	ll_write_memoryview = write_memoryview;
+
+#define DO_ONE_LL_ATTR(name)			\
+	if (name ## _cb)			\
+		op.name = ll_ ## name ## _func;
+
+	DO_ONE_LL_ATTR(lookup);
+	DO_ONE_LL_ATTR(forget);
+	DO_ONE_LL_ATTR(getattr);
+	DO_ONE_LL_ATTR(setattr);
+	DO_ONE_LL_ATTR(readlink);
+	DO_ONE_LL_ATTR(mknod);
+	DO_ONE_LL_ATTR(mkdir);
+	DO_ONE_LL_ATTR(unlink);
+	DO_ONE_LL_ATTR(rmdir);
+	DO_ONE_LL_ATTR(symlink);
+	DO_ONE_LL_ATTR(rename);
+	DO_ONE_LL_ATTR(link);
+	DO_ONE_LL_ATTR(open);
+	DO_ONE_LL_ATTR(read);
+	DO_ONE_LL_ATTR(write);
+	DO_ONE_LL_ATTR(flush);
+	DO_ONE_LL_ATTR(release);
+	DO_ONE_LL_ATTR(fsync);
+	DO_ONE_LL_ATTR(opendir);
+	DO_ONE_LL_ATTR(readdir);
+	DO_ONE_LL_ATTR(releasedir);
+	DO_ONE_LL_ATTR(fsyncdir);
+	DO_ONE_LL_ATTR(statfs);
+	DO_ONE_LL_ATTR(setxattr);
+	DO_ONE_LL_ATTR(getxattr);
+	DO_ONE_LL_ATTR(listxattr);
+	DO_ONE_LL_ATTR(removexattr);
+	DO_ONE_LL_ATTR(access);
+	DO_ONE_LL_ATTR(create);
+	/* we have to drop the file handles even if the fs doesn't care */
+	if (open_cb || create_cb)
+		op.release = ll_release_func;
+	if (opendir_cb)
+		op.releasedir = ll_releasedir_func;
+	if (fsinit_cb)
+		op.init = ll_init_func;
+	if (fsdestroy_cb)
+		op.destroy = fsdestroy_func;
+#if FUSE_MAJOR_VERSION >= 3
+	if (readdirplus && readdir_cb && lookup_cb)
+		op.readdirplus = ll_readdirplus_func;
+	/* we have the connection to set up in any case */
+	op.init = ll_init_func;
+#endif
+
+#undef DO_ONE_LL_ATTR
+
+	if (!(fargv = make_fuse_argv(fargseq, &fargc, &fargholder)))
+		return NULL;
+	fa.argc = fargc;
+	fa.argv = fargv;
+	fa.allocated = 0;
+
+#if FUSE_MAJOR_VERSION >= 3
+	memset(&opts, 0, sizeof(opts));
+	if (fuse_parse_cmdline(&fa, &opts) == -1)
+		goto out;
+	mountpoint = opts.mountpoint;
+	foreground = opts.foreground;
+	if (opts.show_version)
+		fuse_lowlevel_version();
+	else if (opts.show_help) {
+		fuse_cmdline_help();
+		fuse_lowlevel_help();
+	}
+	if (opts.show_version || opts.show_help || !mountpoint)
+		goto out;
+	if (opts.clone_fd)
+		loop_conf.clone_fd = 1;
+
+	if (!(se = fuse_session_new(&fa, &op, sizeof(op), NULL)))
+		goto out;
+	if (fuse_set_signal_handlers(se) == -1)
+		goto out_destroy;
+	if (fuse_session_mount(se, mountpoint) != 0)
+		goto out_handlers;
+	__atomic_store_n(&ll_notify, se, __ATOMIC_RELEASE);
+#else
+	if (fuse_parse_cmdline(&fa, &mountpoint, NULL, &foreground) == -1 ||
+	    !mountpoint)
+		goto out;
+	if (!(ch = fuse_mount(mountpoint, &fa)))
+		goto out;
+	if (!(se = fuse_lowlevel_new(&fa, &op, sizeof(op), NULL)))
+		goto out_unmount;
+	if (fuse_set_signal_handlers(se) == -1)
+		goto out_destroy;
+	fuse_session_add_chan(se, ch);
+	__atomic_store_n(&ll_notify, ch, __ATOMIC_RELEASE);
 #endif
 
+	if (fuse_daemonize(foreground) == -1)
+		goto out_remove;
+	running = 1;
+
+#ifndef WITH_THREAD
+	multithreaded = 0;
+#endif
+	if (multithreaded)
+		err = pyfuse_loop_mt(NULL, se);
+	else
+		err = pyfuse_loop(NULL, se);
+
+#if FUSE_MAJOR_VERSION >= 3
+out_remove:
+	__atomic_store_n(&ll_notify, NULL, __ATOMIC_RELEASE);
+	fuse_session_unmount(se);
+out_handlers:
+	fuse_remove_signal_handlers(se);
+out_destroy:
+	fuse_session_destroy(se);
+#else
+out_remove:
+	__atomic_store_n(&ll_notify, NULL, __ATOMIC_RELEASE);
+	fuse_remove_signal_handlers(se);
+	fuse_session_remove_chan(ch);
+out_destroy:
+	fuse_session_destroy(se);
+out_unmount:
+	fuse_unmount(mountpoint, ch);
+#endif
+out:
+	free(mountpoint);
+	fuse_opt_free_args(&fa);
 	free(fargv);
+	Py_DECREF(fargholder);
+
+	if (!running) {
+		PyErr_SetString(FUSE_ERROR(self), "filesystem initialization failed");
+
+		return NULL;
+	}
+	if (err == -1) {
+		PyErr_SetString(FUSE_ERROR(self), "service loop failed");
+
+		return NULL;
+	}
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyObject *
+FuseLowLevelMain(PyObject *self, PyObject *args, PyObject *kw)
+{
+	PyObject *ret;
+
+	if (serving_begin(self) < 0)
+		return NULL;
+	ret = fuse_lowlevel_serve(self, args, kw);
+	serving_end();
+
+	return ret;
+}
 
-	if (fuse == NULL) {
-		PyErr_SetString(Py_FuseError, "filesystem initialization failed");
+static char FuseInvalidateInode__doc__[] =
+	"Tell Fuse kernel module to invalidate the cached attributes (and data\n"
+	"in the given range) of an inode, in low-level mode\n";
+
+static PyObject *
+FuseInvalidateInode(PyObject *self, PyObject *args)
+{
+	unsigned long ino;
+	long long off = 0, len = 0;
+	ll_notify_t *ch;
+	int err;
 
-		return (NULL);
+	if (!PyArg_ParseTuple(args, "k|LL", &ino, &off, &len) ||
+	    check_main_interpreter(self) < 0)
+		return NULL;
+	if (!(ch = __atomic_load_n(&ll_notify, __ATOMIC_ACQUIRE))) {
+		PyErr_SetString(FUSE_ERROR(self), "no low-level filesystem is running");
+		return NULL;
 	}
 
-#ifndef WITH_THREAD
-	if (multithreaded) {
-		multithreaded = 0;
-#if PY_MAJOR_VERSION > 2 || (PY_MAJOR_VERSION == 2 && PY_MINOR_VERSION >= 5)
-		PyErr_WarnEx(NULL, "Python thread support not available, "
-		                   "enforcing single-threaded operation", 1);
-#else
-		PyErr_Warn(NULL, "Python thread support not available, "
-		                 "enforcing single-threaded operation");
-#endif
-	}
-#endif
+	Py_BEGIN_ALLOW_THREADS
+	err = fuse_lowlevel_notify_inval_inode(ch, ino, off, len);
+	Py_END_ALLOW_THREADS
 
-	if (multithreaded)
-		err = pyfuse_loop_mt(fuse);
-	else {
-		interp = NULL;
-		err = fuse_loop(fuse);
-	}
+	return PyInt_FromLong(err);
+}
 
-#if FUSE_VERSION >= 26
-	fuse_teardown(fuse, fmp);
-#elif FUSE_VERSION >= 22
-	fuse_teardown(fuse, fd, fmp);
-#else
-	__fuse_teardown(fuse, fd, fmp);
-#endif
+static char FuseInvalidateEntry__doc__[] =
+	"Tell Fuse kernel module to drop a cached directory entry, in low-level\n"
+	"mode\n";
 
-	if (err == -1) {
-		PyErr_SetString(Py_FuseError, "service loop failed");
+static PyObject *
+FuseInvalidateEntry(PyObject *self, PyObject *args)
+{
+	unsigned long parent;
+	PyObject *name, *b;
+	ll_notify_t *ch;
+	int err;
 
-		return (NULL);
+	if (!PyArg_ParseTuple(args, "kO", &parent, &name) ||
+	    check_main_interpreter(self) < 0)
+		return NULL;
+	if (!(ch = __atomic_load_n(&ll_notify, __ATOMIC_ACQUIRE))) {
+		PyErr_SetString(FUSE_ERROR(self), "no low-level filesystem is running");
+		return NULL;
 	}
+	if (!(b = py_fsencode(name)))
+		return NULL;
 
-	Py_INCREF(Py_None);
-	return Py_None;
+	Py_BEGIN_ALLOW_THREADS
+	err = fuse_lowlevel_notify_inval_entry(ch, parent,
+	                                       PyBytes_AS_STRING(b),
+	                                       PyBytes_GET_SIZE(b));
+	Py_END_ALLOW_THREADS
+	Py_DECREF(b);
+
+	return PyInt_FromLong(err);
 }
+#endif /* FUSE_VERSION >= 26 */
 
 static char FuseInvalidate__doc__[] =
 	"Tell Fuse kernel module to explicitly invalidate a cached inode's contents\n";
@@ -1579,9 +5556,11 @@ FuseInvalidate(PyObject *self, PyObject *args)
 {
 	char *path;
 	PyObject *ret, *arg1;
+	struct fuse *f;
 	int err;
 
-	if (!(arg1 = PyTuple_GetItem(args, 1)))
+	if (!(arg1 = PyTuple_GetItem(args, 1)) ||
+	    check_main_interpreter(self) < 0)
 		return(NULL);
 
 	if(!PyString_Check(arg1)) {
@@ -1590,9 +5569,20 @@ FuseInvalidate(PyObject *self, PyObject *args)
 		return(NULL);
 	}
 
+	if (!(f = __atomic_load_n(&fuse, __ATOMIC_ACQUIRE))) {
+		PyErr_SetString(FUSE_ERROR(self), "no high-level filesystem is running");
+
+		return(NULL);
+	}
+
 	PATH_AS_STR_BEGIN(arg1, path);
 
-	err = fuse_invalidate(fuse, path);
+	attr_cache_invalidate(path, 0);
+#if FUSE_MAJOR_VERSION >= 3
+	err = fuse_invalidate_path(f, path);
+#else
+	err = fuse_invalidate(f, path);
+#endif
 	PATH_AS_STR_END;
 
 	ret = PyInt_FromLong(err);
@@ -1609,35 +5599,258 @@ FuseGetContext(PyObject *self, PyObject *args)
 	struct fuse_context *fc;
 	PyObject *ret;
 	PyObject *num;
+	uid_t uid;
+	gid_t gid;
+	pid_t pid;
+
+#if FUSE_VERSION >= 26
+	if (ll_req) {
+		const struct fuse_ctx *ctx = fuse_req_ctx(ll_req);
+
+		uid = ctx->uid;
+		gid = ctx->gid;
+		pid = ctx->pid;
+	} else
+#endif
+	{
+		/* we are not in a request, eg. called from a foreign thread */
+		if (!(fc = fuse_get_context())) {
+			PyErr_SetString(FUSE_ERROR(self), "no request context");
+
+			return NULL;
+		}
+		uid = fc->uid;
+		gid = fc->gid;
+		pid = fc->pid;
+	}
 
-	fc = fuse_get_context();
 	ret = PyDict_New();
 
 	if(!ret)
 		return(NULL);
 
-	num = PyInt_FromLong(fc->uid);
+	num = PyInt_FromLong(uid);
 	PyDict_SetItemString(ret, "uid", num);
 	Py_XDECREF( num );
 
-	num = PyInt_FromLong(fc->gid);
+	num = PyInt_FromLong(gid);
 	PyDict_SetItemString(ret, "gid", num);
 	Py_XDECREF( num );
 
-	num = PyInt_FromLong(fc->pid);
+	num = PyInt_FromLong(pid);
 	PyDict_SetItemString(ret, "pid", num);
 	Py_XDECREF( num );
 
 	return(ret);
 }
 
+static char FusePathCacheStats__doc__[] =
+	"Return the statistics of the path cache in a dict. size, capacity,\n"
+	"hits, misses, evictions\n";
+
+static PyObject *
+FusePathCacheStats(PyObject *self, PyObject *args)
+{
+	PyObject *ret;
+
+	if (check_main_interpreter(self) < 0)
+		return NULL;
+
+	FT_LOCK(path_cache.lock);
+	ret = Py_BuildValue("{snsnsKsKsK}",
+	                    "size", (Py_ssize_t)path_cache.size,
+	                    "capacity", (Py_ssize_t)path_cache.capacity,
+	                    "hits", path_cache.hits,
+	                    "misses", path_cache.misses,
+	                    "evictions", path_cache.evictions);
+	FT_UNLOCK(path_cache.lock);
+
+	return ret;
+}
+
+static char FuseAttrCacheStats__doc__[] =
+	"Return the statistics of the attribute cache in a dict. size, memory,\n"
+	"max_memory, ttl, hits, misses, evictions, invalidations\n";
+
+static PyObject *
+FuseAttrCacheStats(PyObject *self, PyObject *args)
+{
+	PyObject *ret;
+
+	if (check_main_interpreter(self) < 0)
+		return NULL;
+
+	pthread_mutex_lock(&attr_cache.lock);
+	ret = Py_BuildValue("{snsnsnsdsKsKsKsK}",
+	                    "size", (Py_ssize_t)attr_cache.size,
+	                    "memory", (Py_ssize_t)attr_cache.memory,
+	                    "max_memory", (Py_ssize_t)attr_cache.max_memory,
+	                    "ttl", attr_cache.ttl,
+	                    "hits", attr_cache.hits,
+	                    "misses", attr_cache.misses,
+	                    "evictions", attr_cache.evictions,
+	                    "invalidations", attr_cache.invalidations);
+	pthread_mutex_unlock(&attr_cache.lock);
+
+	return ret;
+}
+
+static char FuseGetStats__doc__[] =
+	"Return the statistics of the ops served, in a dict keyed by the names\n"
+	"of the ops which have been called. Each value is a dict of: calls,\n"
+	"errors (a dict of errno -> count), bytes (read or written), time_ns\n"
+	"(spent in total), gil_wait_ns (spent waiting for the GIL), in_flight\n"
+	"(the number of requests being served), latency (a list, the item i\n"
+	"of which is the number of calls which took less than 2**(i + 10) ns\n"
+	"and more than the previous limit; the last one has no upper limit)\n";
+
+static PyObject *
+FuseGetStats(PyObject *self, PyObject *args)
+{
+	PyObject *ret, *d = NULL, *errs = NULL, *hist = NULL, *o, *k;
+	struct op_stats copy, *st = &copy;
+	int op, i, in_flight;
+
+	if (check_main_interpreter(self) < 0 || !(ret = PyDict_New()))
+		return NULL;
+
+	for (op = 0; op < OP_COUNT; op++) {
+		FT_LOCK(stats_lock);
+		copy = op_stats[op];
+		FT_UNLOCK(stats_lock);
+		in_flight = __atomic_load_n(&op_stats[op].in_flight,
+		                            __ATOMIC_RELAXED);
+		if (!st->calls && !in_flight)
+			continue;
+
+		if (!(errs = PyDict_New()) ||
+		    !(hist = PyList_New(OP_HIST_BUCKETS)))
+			goto err;
+		for (i = 0; i < OP_ERRNOS; i++) {
+			if (!st->errnos[i])
+				continue;
+			o = PyLong_FromUnsignedLongLong(st->errnos[i]);
+			k = PyInt_FromLong(i);
+			if (!o || !k || PyDict_SetItem(errs, k, o) < 0) {
+				Py_XDECREF(o);
+				Py_XDECREF(k);
+				goto err;
+			}
+			Py_DECREF(o);
+			Py_DECREF(k);
+		}
+		for (i = 0; i < OP_HIST_BUCKETS; i++) {
+			o = PyLong_FromUnsignedLongLong(st->hist[i]);
+			if (!o)
+				goto err;
+			PyList_SET_ITEM(hist, i, o);
+		}
+
+		d = Py_BuildValue("{sKsNsKsKsKsisN}",
+		                  "calls", st->calls,
+		                  "errors", errs,
+		                  "bytes", st->bytes,
+		                  "time_ns", st->time_ns,
+		                  "gil_wait_ns", st->gil_ns,
+		                  "in_flight", in_flight,
+		                  "latency", hist);
+		errs = hist = NULL;
+		if (!d || PyDict_SetItemString(ret, op_names[op], d) < 0)
+			goto err;
+		Py_CLEAR(d);
+	}
+
+	return ret;
+
+err:
+	Py_XDECREF(errs);
+	Py_XDECREF(hist);
+	Py_XDECREF(d);
+	Py_DECREF(ret);
+	return NULL;
+}
+
+static char FuseResetStats__doc__[] =
+	"Zero the counters of the op statistics (but in_flight).\n";
+
+static PyObject *
+FuseResetStats(PyObject *self, PyObject *args)
+{
+	int op;
+
+	if (check_main_interpreter(self) < 0)
+		return NULL;
+
+	/* in_flight is the last one */
+	FT_LOCK(stats_lock);
+	for (op = 0; op < OP_COUNT; op++)
+		memset(&op_stats[op], 0, offsetof(struct op_stats, in_flight));
+	FT_UNLOCK(stats_lock);
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static char FuseGetTrace__doc__[] =
+	"Return the requests in the trace buffer, oldest first, as a list of\n"
+	"tuples: (op, start, gil, end, result, path, ino, fh, uid, pid, tid,\n"
+	"deferred). start, gil and end are the times (in ns, of the monotonic\n"
+	"clock) of getting the request, the GIL and being done; result is 0\n"
+	"or a negative errno (or for reads and writes, the bytes moved); path\n"
+	"is None in the low-level API, ino is 0 in the high-level one; fh is\n"
+	"the id() of the filehandle, or 0; uid and pid are those of the\n"
+	"caller; tid is the thread id of the worker; deferred is true for\n"
+	"low-level requests replied to when a future got done.\n";
+
+static PyObject *
+FuseGetTrace(PyObject *self, PyObject *args)
+{
+	unsigned long long first, i;
+	struct trace_event *ev;
+	PyObject *ret, *o;
+
+	if (check_main_interpreter(self) < 0)
+		return NULL;
+
+	FT_LOCK(stats_lock);
+	first = trace.count > trace.size ? trace.count - trace.size : 0;
+	if (!(ret = PyList_New(trace.count - first)))
+		goto out;
+
+	for (i = first; i < trace.count; i++) {
+		ev = &trace.events[i % trace.size];
+		o = Py_BuildValue("(sKKKLNKKIiiN)", op_names[ev->op],
+		                  ev->t0, ev->t1, ev->t2, ev->ret,
+		                  ev->ino ? (Py_INCREF(Py_None), Py_None) :
+		                            PyUnicode_DecodeFSDefault(ev->path),
+		                  (unsigned long long)ev->ino,
+		                  (unsigned long long)ev->fh, ev->uid, ev->pid,
+		                  ev->tid, PyBool_FromLong(ev->deferred));
+		if (!o) {
+			Py_CLEAR(ret);
+			break;
+		}
+		PyList_SET_ITEM(ret, i - first, o);
+	}
+
+out:
+	FT_UNLOCK(stats_lock);
+	return ret;
+}
+
 static char FuseAPIVersion__doc__[] =
 	"Return FUSE API version.\n";
 
 static PyObject *
 FuseAPIVersion(PyObject *self, PyObject *args)
 {
+#if FUSE_MAJOR_VERSION >= 3
+	/* FUSE_VERSION went from maj * 10 + min to this in libfuse 3.x */
+	PyObject *favers = PyInt_FromLong(FUSE_MAJOR_VERSION * 100 +
+	                                  FUSE_MINOR_VERSION);
+#else
 	PyObject *favers = PyInt_FromLong(FUSE_VERSION);
+#endif
 
 	return favers;
 }
@@ -1662,50 +5875,394 @@ FuseNotifyPoll(PyObject *self, PyObject *arg)
 	return PyInt_FromLong(ret);
 }
 
+/*
+ * Numbered slots of bytes, through which interpreters (which have their
+ * own objects, and maybe their own GIL) hand data to each other: it's
+ * copied in and out, so no object is shared.
+ */
+#define XI_SLOTS 256
+
+static struct {
+	pthread_mutex_t lock;
+	char *data[XI_SLOTS];
+	Py_ssize_t len[XI_SLOTS];
+} xi_slots = { PTHREAD_MUTEX_INITIALIZER };
+
+static char FuseSlotPut__doc__[] =
+	"Put a copy of some bytes into a numbered slot (0 to 255), replacing\n"
+	"what was in it. The slots are shared by all interpreters.\n";
+
+static PyObject *
+FuseSlotPut(PyObject *self, PyObject *args)
+{
+	Py_ssize_t slot;
+	Py_buffer view;
+	char *data, *old;
+
+	if (!PyArg_ParseTuple(args, "ny*", &slot, &view))
+		return NULL;
+	if (slot < 0 || slot >= XI_SLOTS) {
+		PyBuffer_Release(&view);
+		PyErr_SetString(PyExc_IndexError, "slot out of range");
+		return NULL;
+	}
+	/* at least a byte, so that an empty slot differs from empty data */
+	if (!(data = malloc(view.len ? view.len : 1))) {
+		PyBuffer_Release(&view);
+		return PyErr_NoMemory();
+	}
+	memcpy(data, view.buf, view.len);
+
+	pthread_mutex_lock(&xi_slots.lock);
+	old = xi_slots.data[slot];
+	xi_slots.data[slot] = data;
+	xi_slots.len[slot] = view.len;
+	pthread_mutex_unlock(&xi_slots.lock);
+
+	free(old);
+	PyBuffer_Release(&view);
+
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static char FuseSlotTake__doc__[] =
+	"Take the bytes out of a numbered slot, leaving it empty. None if it's\n"
+	"empty.\n";
+
+static PyObject *
+FuseSlotTake(PyObject *self, PyObject *args)
+{
+	Py_ssize_t slot, len;
+	PyObject *ret;
+	char *data;
+
+	if (!PyArg_ParseTuple(args, "n", &slot))
+		return NULL;
+	if (slot < 0 || slot >= XI_SLOTS) {
+		PyErr_SetString(PyExc_IndexError, "slot out of range");
+		return NULL;
+	}
+
+	pthread_mutex_lock(&xi_slots.lock);
+	data = xi_slots.data[slot];
+	len = xi_slots.len[slot];
+	xi_slots.data[slot] = NULL;
+	pthread_mutex_unlock(&xi_slots.lock);
+
+	if (!data) {
+		Py_INCREF(Py_None);
+		return Py_None;
+	}
+	ret = PyBytes_FromStringAndSize(data, len);
+	free(data);
+
+	return ret;
+}
+
+static int
+Stat_traverse(StatObject *self, visitproc visit, void *arg)
+{
+	int i;
+
+	for (i = 0; i < STF_NFIELDS; i++)
+		Py_VISIT(self->fields[i]);
+#if PY_VERSION_HEX >= 0x03090000
+	Py_VISIT(Py_TYPE(self));
+#endif
+
+	return 0;
+}
+
+static int
+Stat_clear(StatObject *self)
+{
+	int i;
+
+	for (i = 0; i < STF_NFIELDS; i++)
+		Py_CLEAR(self->fields[i]);
+
+	return 0;
+}
+
+static void
+Stat_dealloc(StatObject *self)
+{
+	PyTypeObject *tp = Py_TYPE(self);
+
+	PyObject_GC_UnTrack(self);
+	Stat_clear(self);
+	tp->tp_free((PyObject *)self);
+	Py_DECREF(tp);
+}
+
+#define STAT_MEMBER(name, idx)						\
+	{ name, T_OBJECT_EX,						\
+	  offsetof(StatObject, fields) + (idx) * sizeof(PyObject *), 0, NULL }
+
+static PyMemberDef Stat_members[] = {
+	STAT_MEMBER("st_mode",    STF_MODE),
+	STAT_MEMBER("st_ino",     STF_INO),
+	STAT_MEMBER("st_dev",     STF_DEV),
+	STAT_MEMBER("st_nlink",   STF_NLINK),
+	STAT_MEMBER("st_uid",     STF_UID),
+	STAT_MEMBER("st_gid",     STF_GID),
+	STAT_MEMBER("st_size",    STF_SIZE),
+	STAT_MEMBER("st_atime",   STF_ATIME),
+	STAT_MEMBER("st_mtime",   STF_MTIME),
+	STAT_MEMBER("st_ctime",   STF_CTIME),
+	STAT_MEMBER("st_rdev",    STF_RDEV),
+	STAT_MEMBER("st_blksize", STF_BLKSIZE),
+	STAT_MEMBER("st_blocks",  STF_BLOCKS),
+	{NULL}
+};
+
+#undef STAT_MEMBER
+
+static PyType_Slot Stat_slots[] = {
+	{Py_tp_dealloc, Stat_dealloc},
+	{Py_tp_doc, "Container of stat fields with fixed storage, which can be "
+	            "converted\nquickly for FUSE. Unset fields are missing."},
+	{Py_tp_traverse, Stat_traverse},
+	{Py_tp_clear, Stat_clear},
+	{Py_tp_members, Stat_members},
+	{Py_tp_new, PyType_GenericNew},
+	{0, NULL}
+};
+
+static PyType_Spec Stat_spec = {
+	.name = "fuseparts._fuse.Stat",
+	.basicsize = sizeof(StatObject),
+	.flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC,
+	.slots = Stat_slots,
+};
+
+/*
+ * Find out where the stat fields are in an os.stat_result. If something
+ * goes wrong, we simply won't have the stat_result fast path.
+ */
+static void
+init_stat_result_idx(void)
+{
+	PyObject *os = NULL, *srt = NULL, *nf = NULL, *seq = NULL, *sr = NULL;
+	PyObject *idx;
+	Py_ssize_t n;
+	int i;
+
+	if (!(os = PyImport_ImportModule("os")) ||
+	    !(srt = PyObject_GetAttrString(os, "stat_result")) ||
+	    !PyType_Check(srt) ||
+	    !(nf = PyObject_GetAttrString(srt, "n_fields")) ||
+	    (n = PyInt_AsLong(nf)) < 0)
+		goto out;
+
+	/* a stat_result which holds its own indices as values */
+	if (!(seq = PyTuple_New(n)))
+		goto out;
+	for (i = 0; i < n; i++) {
+		if (!(idx = PyInt_FromLong(i)))
+			goto out;
+		PyTuple_SET_ITEM(seq, i, idx);
+	}
+	if (!(sr = PyObject_CallFunctionObjArgs(srt, seq, NULL)))
+		goto out;
+
+	for (i = 0; i < STF_NFIELDS; i++) {
+		idx = PyObject_GetAttr(sr, stat_field_pynames[i]);
+		if (idx && PyInt_Check(idx)) {
+			stat_result_idx[i] = PyInt_AsLong(idx);
+		} else {
+			if (i < STF_NREQUIRED) {
+				Py_XDECREF(idx);
+				goto out;
+			}
+			stat_result_idx[i] = -1;
+		}
+		Py_XDECREF(idx);
+		PyErr_Clear();
+	}
+
+	Py_INCREF(srt);
+	stat_result_type = (PyTypeObject *)srt;
+
+out:
+	PyErr_Clear();
+	Py_XDECREF(sr);
+	Py_XDECREF(seq);
+	Py_XDECREF(nf);
+	Py_XDECREF(srt);
+	Py_XDECREF(os);
+}
+
 static PyMethodDef Fuse_methods[] = {
 	{"main",	(PyCFunction)Fuse_main,	 METH_VARARGS|METH_KEYWORDS},
 	{"FuseGetContext", (PyCFunction)FuseGetContext, METH_VARARGS, FuseGetContext__doc__},
 	{"FuseInvalidate", (PyCFunction)FuseInvalidate, METH_VARARGS, FuseInvalidate__doc__},
 	{"FuseAPIVersion", (PyCFunction)FuseAPIVersion, METH_NOARGS,  FuseAPIVersion__doc__},
 	{"FuseNotifyPoll", (PyCFunction)FuseNotifyPoll, METH_O,       FuseNotifyPoll__doc__},
+	{"FusePathCacheStats", (PyCFunction)FusePathCacheStats, METH_NOARGS, FusePathCacheStats__doc__},
+	{"FuseAttrCacheStats", (PyCFunction)FuseAttrCacheStats, METH_NOARGS, FuseAttrCacheStats__doc__},
+	{"FuseGetStats", (PyCFunction)FuseGetStats, METH_NOARGS, FuseGetStats__doc__},
+	{"FuseResetStats", (PyCFunction)FuseResetStats, METH_NOARGS, FuseResetStats__doc__},
+	{"FuseGetTrace", (PyCFunction)FuseGetTrace, METH_NOARGS, FuseGetTrace__doc__},
+	{"FuseSlotPut", (PyCFunction)FuseSlotPut, METH_VARARGS, FuseSlotPut__doc__},
+	{"FuseSlotTake", (PyCFunction)FuseSlotTake, METH_VARARGS, FuseSlotTake__doc__},
+#if FUSE_VERSION >= 26
+	{"lowlevel_main", (PyCFunction)FuseLowLevelMain, METH_VARARGS|METH_KEYWORDS},
+	{"FuseInvalidateInode", (PyCFunction)FuseInvalidateInode, METH_VARARGS, FuseInvalidateInode__doc__},
+	{"FuseInvalidateEntry", (PyCFunction)FuseInvalidateEntry, METH_VARARGS, FuseInvalidateEntry__doc__},
+#endif
 	{NULL,		NULL}		/* sentinel */
 };
 
-#if PY_MAJOR_VERSION >= 3
-static struct PyModuleDef fuse_module = {
-	PyModuleDef_HEAD_INIT,
-	"_fuse",     /* m_name */
-	"FUSE module",  /* m_doc */
-	-1,                  /* m_size */
-	Fuse_methods
-};
-#endif
+static int
+fuse_traverse(PyObject *m, visitproc visit, void *arg)
+{
+	fuse_state *st = FUSE_STATE(m);
 
-PyObject *PyInit__fuse(void)
+	Py_VISIT(st->error);
+	Py_VISIT(st->stat_type);
+	Py_VISIT(st->filemethod_type);
+
+	return 0;
+}
+
+static int
+fuse_clear(PyObject *m)
 {
-	PyObject *m, *d;
+	fuse_state *st = FUSE_STATE(m);
 
-	/* Create the module and add the functions */
-#if PY_MAJOR_VERSION >= 3
-	m = PyModule_Create(&fuse_module);
-#else
-	m = Py_InitModule3("_fuse", Fuse_methods, "FUSE module");
+	Py_CLEAR(st->error);
+	Py_CLEAR(st->stat_type);
+	Py_CLEAR(st->filemethod_type);
+
+	return 0;
+}
+
+static void
+fuse_free(void *m)
+{
+	fuse_clear((PyObject *)m);
+}
+
+/*
+ * Set up the globals the C code of the filesystem uses; once, by the main
+ * interpreter.
+ */
+static int
+init_globals(fuse_state *st)
+{
+	int i;
+
+	for (i = 0; i < STF_NFIELDS; i++) {
+		stat_field_pynames[i] = PyUnicode_InternFromString(stat_field_names[i]);
+		if (!stat_field_pynames[i])
+			return -1;
+	}
+	init_stat_result_idx();
+	for (i = 0; i < DE_NFIELDS; i++) {
+		direntry_field_pynames[i] =
+		  PyUnicode_InternFromString(direntry_field_names[i]);
+		if (!direntry_field_pynames[i])
+			return -1;
+	}
+#if FUSE_VERSION >= 26
+	for (i = 0; i < EN_NFIELDS; i++) {
+		entry_field_pynames[i] =
+		  PyUnicode_InternFromString(entry_field_names[i]);
+		if (!entry_field_pynames[i])
+			return -1;
+	}
+#endif
+#if FUSE_VERSION >= 22 && PY_VERSION_HEX >= 0x03030000
+	{
+		PyMethodDef *md;
+
+		for (md = PyMemoryView_Type.tp_methods; md->ml_name; md++) {
+			if (!strcmp(md->ml_name, "release"))
+				memoryview_release_meth = md->ml_meth;
+		}
+		if (!memoryview_release_meth) {
+			PyErr_SetString(PyExc_ImportError,
+			                "memoryview has no release method");
+			return -1;
+		}
+	}
 #endif
 
-	/* Add some symbolic constants to the module */
-	d = PyModule_GetDict(m);
-	Py_FuseError = PyErr_NewException("fuse.FuseError", NULL, NULL);
-	PyDict_SetItemString(d, "FuseError", Py_FuseError);
-	/* compat */
-	PyDict_SetItemString(d, "error", Py_FuseError);
+	Py_INCREF(st->stat_type);
+	Stat_Type = (PyTypeObject *)st->stat_type;
+	Py_INCREF(st->filemethod_type);
+	FileMethod_Type = (PyTypeObject *)st->filemethod_type;
 
-	return m;
+	return 0;
 }
 
-#if PY_MAJOR_VERSION == 2
-DL_EXPORT(void)
-init_fuse(void)
+static int
+fuse_exec(PyObject *m)
 {
-     PyInit__fuse();
+	fuse_state *st = FUSE_STATE(m);
+	PyObject *d = PyModule_GetDict(m);
+
+	/* Add some symbolic constants to the module */
+	if (!(st->error = PyErr_NewException("fuse.FuseError", NULL, NULL)) ||
+	    PyDict_SetItemString(d, "FuseError", st->error) < 0 ||
+	    /* compat */
+	    PyDict_SetItemString(d, "error", st->error) < 0)
+		return -1;
+
+#if FUSE_VERSION >= 26
+	PyModule_AddIntConstant(m, "FUSE_SET_ATTR_MODE", FUSE_SET_ATTR_MODE);
+	PyModule_AddIntConstant(m, "FUSE_SET_ATTR_UID", FUSE_SET_ATTR_UID);
+	PyModule_AddIntConstant(m, "FUSE_SET_ATTR_GID", FUSE_SET_ATTR_GID);
+	PyModule_AddIntConstant(m, "FUSE_SET_ATTR_SIZE", FUSE_SET_ATTR_SIZE);
+	PyModule_AddIntConstant(m, "FUSE_SET_ATTR_ATIME", FUSE_SET_ATTR_ATIME);
+	PyModule_AddIntConstant(m, "FUSE_SET_ATTR_MTIME", FUSE_SET_ATTR_MTIME);
+	PyModule_AddIntConstant(m, "FUSE_SET_ATTR_ATIME_NOW",
+	                        FUSE_SET_ATTR_ATIME_NOW);
+	PyModule_AddIntConstant(m, "FUSE_SET_ATTR_MTIME_NOW",
+	                        FUSE_SET_ATTR_MTIME_NOW);
+#endif
+
+	if (!(st->stat_type = PyType_FromSpec(&Stat_spec)) ||
+	    PyDict_SetItemString(d, "Stat", st->stat_type) < 0 ||
+	    !(st->filemethod_type = PyType_FromSpec(&FileMethod_spec)) ||
+	    PyDict_SetItemString(d, "FileMethod", st->filemethod_type) < 0)
+		return -1;
+
+	if (PyThreadState_Get()->interp == PyInterpreterState_Main() &&
+	    !Stat_Type && init_globals(st) < 0)
+		return -1;
+
+	return 0;
 }
+
+static PyModuleDef_Slot fuse_slots[] = {
+	{Py_mod_exec, fuse_exec},
+#if PY_VERSION_HEX >= 0x030C0000
+	{Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED},
 #endif
+#ifdef Py_GIL_DISABLED
+	/* don't have the GIL enabled on import in free-threaded builds */
+	{Py_mod_gil, Py_MOD_GIL_NOT_USED},
+#endif
+	{0, NULL}
+};
+
+static struct PyModuleDef fuse_module = {
+	PyModuleDef_HEAD_INIT,
+	.m_name = "_fuse",
+	.m_doc = "FUSE module",
+	.m_size = sizeof(fuse_state),
+	.m_methods = Fuse_methods,
+	.m_slots = fuse_slots,
+	.m_traverse = fuse_traverse,
+	.m_clear = fuse_clear,
+	.m_free = fuse_free,
+};
+
+PyMODINIT_FUNC
+PyInit__fuse(void)
+{
+	return PyModuleDef_Init(&fuse_module);
+}
\ No newline at end of file
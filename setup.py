@@ -36,19 +36,51 @@ classifiers = [ "Development Status :: 5 - Production/Stable",
 #  os.environ['PKG_CONFIG_PATH'] = '/usr/local/lib/pkgconfig'
 
 libs = cflags = ''
+macros = []
+
+# Build against libfuse 2 if it's there, libfuse 3 otherwise, unless
+# FUSE_PYTHON_LIBFUSE (2 or 3) says which one
+libfuse = os.environ.get('FUSE_PYTHON_LIBFUSE')
+if libfuse not in (None, '2', '3'):
+    print("FUSE_PYTHON_LIBFUSE must be 2 or 3, not %r" % libfuse)
+    sys.exit(1)
+if libfuse is None:
+    libfuse = '2'
+    if os.system('pkg-config --exists fuse 2> /dev/null') != 0 and \
+       os.system('pkg-config --exists fuse3 2> /dev/null') == 0:
+        libfuse = '3'
+
+if libfuse == '3':
+    pkg = 'fuse3'
+    # the API of 3.2, which has the loop settings
+    check = 'pkg-config --atleast-version=3.2 fuse3 2> /dev/null'
+    macros.append(('FUSE_USE_VERSION', '32'))
+    # fuse.pc has this in the cflags, fuse3.pc doesn't
+    macros.append(('_FILE_OFFSET_BITS', '64'))
+else:
+    pkg = 'fuse'
+    check = 'pkg-config --exists fuse 2> /dev/null'
+    # FUSE_VERSION doesn't tell 2.9.0 from 2.9.1, which added fallocate
+    if os.system('pkg-config --atleast-version=2.9.1 fuse 2> /dev/null') == 0:
+        macros.append(('FUSE_HAS_FALLOCATE', '1'))
 
 # Find fuse compiler/linker flag via pkgconfig
-if os.system('pkg-config --exists fuse 2> /dev/null') == 0:
-    pkgcfg = os.popen('pkg-config --cflags fuse')
+if os.system(check) == 0:
+    pkgcfg = os.popen('pkg-config --cflags ' + pkg)
     cflags = pkgcfg.readline().strip()
     pkgcfg.close()
-    pkgcfg = os.popen('pkg-config --libs fuse')
+    pkgcfg = os.popen('pkg-config --libs ' + pkg)
     libs = pkgcfg.readline().strip()
     pkgcfg.close()
 
 else:
     if os.system('pkg-config --help 2>&1 >/dev/null') == 0:
-        print("""pkg-config could not find fuse:
+        if pkg == 'fuse3':
+            print("""pkg-config could not find fuse3:
+you might need to adjust PKG_CONFIG_PATH or your
+FUSE installation is older than 3.2""")
+        else:
+            print("""pkg-config could not find fuse:
 you might need to adjust PKG_CONFIG_PATH or your
 FUSE installation is very old (older than 2.1-pre1)""")
 
@@ -76,6 +108,7 @@ except ImportError:
 # extra_objects, extra_compile_args, extra_link_args
 fusemodule = Extension('fuseparts._fuse', sources = ['fuseparts/_fusemodule.c'],
                   include_dirs = iflags,
+                  define_macros = macros,
                   extra_compile_args = extra_cflags,
                   library_dirs = libdirs,
                   libraries = libsonly)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# A filesystem whose read_buf gives what it shouldn't, for the tests:
+# /none gets None, /count a byte count, /negoff a range at a negative
+# offset, and /ok the data proper.
+
+import os, stat, errno
+import fuse
+from fuse import Fuse
+
+fuse.fuse_python_api = (0, 2)
+
+data = b'Hello World!\n'
+
+class ReadBufFS(Fuse):
+
+    def getattr(self, path):
+        st = fuse.Stat()
+        if path == '/':
+            st.st_mode = stat.S_IFDIR | 0o755
+            st.st_nlink = 2
+        elif path in ('/none', '/count', '/negoff', '/ok'):
+            st.st_mode = stat.S_IFREG | 0o444
+            st.st_nlink = 1
+            st.st_size = len(data)
+        else:
+            return -errno.ENOENT
+        return st
+
+    def readdir(self, path, offset):
+        for r in '.', '..', 'none', 'count', 'negoff', 'ok':
+            yield fuse.Direntry(r)
+
+    def read_buf(self, path, size, offset):
+        if path == '/none':
+            return None
+        if path == '/count':
+            return 5
+        if path == '/negoff':
+            return (0, -1, size)
+        return data[offset:offset + size]
+
+def main():
+    server = ReadBufFS(version="%prog " + fuse.__version__,
+                       usage=Fuse.fusage, dash_s_do='setsingle')
+    server.parse(errex=1)
+    server.main()
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 import os
+import errno
+import json
+import random
 import time
 import sys
 import struct
@@ -7,16 +10,24 @@ import pathlib
 import tempfile
 import pytest
 import fcntl
+import threading
+import importlib.util
+
+import fuse
 
 topdir = pathlib.Path(__file__).parent.parent
 
 @pytest.fixture
 def filesystem(request):
-    fstype = request.node.get_closest_marker("fstype").args[0]
+    fstype, *args = request.node.get_closest_marker("fstype").args
+    # the examples, or the filesystems here which only make sense as tests
+    script = topdir / "tests" / f"{fstype}.py"
+    if not script.exists():
+        script = topdir / "example" / f"{fstype}.py"
 
     with tempfile.TemporaryDirectory() as tmpdir:
         st_dev = os.stat(tmpdir).st_dev
-        proc = subprocess.Popen([sys.executable, "-d", topdir / "example" / f"{fstype}.py", tmpdir], stdin=subprocess.DEVNULL)
+        proc = subprocess.Popen([sys.executable, "-d", script, tmpdir, *args], stdin=subprocess.DEVNULL)
 
         deadline = time.time() + 1
         while time.time() < deadline:
@@ -64,3 +75,489 @@ def test_fioc(filesystem):
 @pytest.mark.fstype("xattr")
 def test_xattr(filesystem):
     assert os.getxattr(filesystem / "utf8_attr", "user.xdg.comment").decode("utf-8") == 'ああ、メッセージは切り取られていない'
+
+@pytest.mark.fstype("xmp")
+def test_xmp_read(filesystem, tmp_path):
+    data = os.urandom(300000)
+    src = tmp_path / "data"
+    src.write_bytes(data)
+    assert (filesystem / src.relative_to("/")).read_bytes() == data
+
+@pytest.mark.fstype("xmp")
+def test_xmp_write(filesystem, tmp_path):
+    data = os.urandom(300000)
+    dst = tmp_path / "data"
+    (filesystem / dst.relative_to("/")).write_bytes(data)
+    assert dst.read_bytes() == data
+
+def load_example(name):
+    spec = importlib.util.spec_from_file_location(name, topdir / "example" / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.mark.parametrize("buf_io", [None, "fd", "bytes"])
+def test_xmp_buf_io_handlers(buf_io, tmp_path, monkeypatch):
+    xmp = load_example("xmp")
+    server = xmp.Xmp()
+    server.buf_io = buf_io
+    handlers = {}
+    monkeypatch.setattr(fuse, "main", lambda **d: handlers.update(d))
+    server.main(["xmp"])
+
+    (tmp_path / "file").write_bytes(b"0123456789")
+    monkeypatch.chdir(tmp_path)
+    fh = server.file_class("/file", os.O_RDWR)
+    try:
+        if buf_io is None:
+            assert "read_buf" not in handlers and "write_buf" not in handlers
+            buf = bytearray(4)
+            assert handlers["readinto"]("/file", buf, 2, fh) == 4
+            assert buf == b"2345"
+            assert handlers["write_memoryview"] == 1
+        elif buf_io == "fd":
+            assert handlers["read_buf"]("/file", 4, 2, fh) == (fh.fd, 2, 4)
+            assert handlers["write_buf"]("/file", 4, 2, fh) == (fh.fd, 2)
+        else:
+            assert handlers["read_buf"]("/file", 4, 2, fh) == b"2345"
+            assert handlers["write_buf"]("/file", 4, 2, fh) == (fh.fd, 2)
+    finally:
+        fh.release(0)
+
+def check_read_write(mnt, src):
+    data = os.urandom(300000)
+    src.write_bytes(data)
+    assert mnt.read_bytes() == data
+    data = os.urandom(300000)
+    mnt.write_bytes(data)
+    assert src.read_bytes() == data
+
+@pytest.mark.fstype("xmp", "-o", "direct_io,buf_io=fd")
+def test_xmp_buf_io_fd(filesystem, tmp_path):
+    src = tmp_path / "data"
+    check_read_write(filesystem / src.relative_to("/"), src)
+
+@pytest.mark.fstype("xmp", "-o", "direct_io,buf_io=bytes")
+def test_xmp_buf_io_bytes(filesystem, tmp_path):
+    src = tmp_path / "data"
+    check_read_write(filesystem / src.relative_to("/"), src)
+
+@pytest.mark.fstype("read_buf_fs")
+def test_read_buf_bad_result(filesystem):
+    assert (filesystem / "ok").read_bytes() == b"Hello World!\n"
+    # neither None nor a count are data, nor is there any at offset -1
+    for name in "none", "count", "negoff":
+        with pytest.raises(OSError) as e:
+            (filesystem / name).read_bytes()
+        assert e.value.errno == errno.EINVAL
+    assert (filesystem / "ok").read_bytes() == b"Hello World!\n"
+
+@pytest.mark.fstype("worker_fs", "-o", "attr_timeout=0,entry_timeout=0")
+def test_worker_init(filesystem):
+    counts = {}
+    for i in range(20):
+        st = os.stat(filesystem / "counter")
+        counts.setdefault(int(st.st_mtime), []).append(st.st_size)
+    # each thread's count goes on from request to request
+    for sizes in counts.values():
+        assert sizes == sorted(set(sizes))
+    assert max(len(sizes) for sizes in counts.values()) > 1
+    st = os.stat(filesystem / "inits")
+    assert st.st_size == 1
+    assert st.st_nlink >= len(counts)
+
+@pytest.mark.skipif(not hasattr(os, "copy_file_range"), reason="needs os.copy_file_range")
+@pytest.mark.fstype("xmp")
+def test_xmp_copy_file_range(filesystem, tmp_path):
+    # served by copy_file_range with libfuse 3.4+, else by read and write
+    data = os.urandom(300000)
+    (tmp_path / "src").write_bytes(data)
+    (tmp_path / "dst").write_bytes(b"x" * 1000)
+    mnt = filesystem / tmp_path.relative_to("/")
+    with (mnt / "src").open("rb") as src, (mnt / "dst").open("r+b") as dst:
+        n = 0
+        while n < 200000:
+            n += os.copy_file_range(src.fileno(), dst.fileno(), 200000 - n,
+                                    100000 + n, 500 + n)
+    assert (tmp_path / "dst").read_bytes() == b"x" * 500 + data[100000:]
+
+class MemFile(object):
+    def __init__(self, files, path):
+        self.data = files[path]
+
+    def read(self, size, offset):
+        return bytes(self.data[offset:offset + size])
+
+def mem_handlers(files):
+    def write(path, buf, offset, fh):
+        files[path][offset:offset + len(buf)] = buf
+        return len(buf)
+    def copy_file_range(path_in, offset_in, path_out, fh_out, offset_out,
+                        length, flags, fh_in):
+        return write(path_out, files[path_in][offset_in:offset_in + length],
+                     offset_out, fh_out)
+    return {"write": write, "copy_file_range": copy_file_range}
+
+def test_block_cache_copy_file_range():
+    files = {"/src": bytearray(b"01234567"), "/dst": bytearray(b"x" * 8)}
+    src, dst = MemFile(files, "/src"), MemFile(files, "/dst")
+    cache = fuse.BlockCache(1 << 20, block_size=4, readahead=0)
+    d = mem_handlers(files)
+    cache.install(d)
+    assert d["read"]("/dst", 8, 0, dst) == b"x" * 8
+    assert d["copy_file_range"]("/src", 2, "/dst", dst, 0, 4, 0, src) == 4
+    # the blocks read before are gone
+    assert d["read"]("/dst", 8, 0, dst) == b"2345xxxx"
+    cache.close()
+
+def test_write_buffer_copy_file_range():
+    files = {"/src": bytearray(b"01234567"), "/dst": bytearray(b"x" * 8)}
+    src, dst = MemFile(files, "/src"), MemFile(files, "/dst")
+    buffer = fuse.WriteBuffer(1 << 10)
+    d = mem_handlers(files)
+    buffer.install(d)
+    assert d["write"]("/src", b"ab", 2, src) == 2
+    assert d["write"]("/dst", b"zz", 0, dst) == 2
+    assert files == {"/src": b"01234567", "/dst": b"x" * 8}
+    # both ranges are written out before the copy
+    assert d["copy_file_range"]("/src", 0, "/dst", dst, 1, 4, 0, src) == 4
+    assert files == {"/src": b"01ab4567", "/dst": b"z01abxxx"}
+    buffer.close()
+
+@pytest.mark.fstype("xmp", "-o", "direct_io")
+def test_xmp_fallocate(filesystem, tmp_path):
+    src = tmp_path / "file"
+    src.write_bytes(b"x" * 65536)
+    mnt = filesystem / src.relative_to("/")
+    with mnt.open("r+b") as f:
+        os.posix_fallocate(f.fileno(), 0, 1 << 20)
+    assert src.stat().st_size == 1 << 20
+    assert src.read_bytes()[:65536] == b"x" * 65536
+    # punch a hole, which can't be emulated by writes
+    subprocess.check_call(["fallocate", "-p", "-o", "4096", "-l", "8192", mnt])
+    data = src.read_bytes()
+    assert data[:4096] == b"x" * 4096
+    assert data[4096:12288] == bytes(8192)
+    assert data[12288:65536] == b"x" * (65536 - 12288)
+    assert len(data) == 1 << 20
+
+@pytest.mark.skipif(fuse.APIVersion() < fuse.feature_needs("has_lseek"), reason="needs libfuse 3.8")
+@pytest.mark.fstype("xmp")
+def test_xmp_lseek(filesystem, tmp_path):
+    src = tmp_path / "sparse"
+    with src.open("wb") as f:
+        f.seek(1 << 20)
+        f.write(b"x" * 4096)
+    with src.open("rb") as f:
+        if os.lseek(f.fileno(), 0, os.SEEK_DATA) == 0:
+            pytest.skip("the underlying filesystem doesn't keep holes")
+    with (filesystem / src.relative_to("/")).open("rb") as f:
+        assert os.lseek(f.fileno(), 0, os.SEEK_DATA) == 1 << 20
+        assert os.lseek(f.fileno(), 0, os.SEEK_HOLE) == 0
+        with pytest.raises(OSError) as e:
+            os.lseek(f.fileno(), (1 << 20) + 4096, os.SEEK_DATA)
+        assert e.value.errno == errno.ENXIO
+
+@pytest.mark.fstype("xmp")
+def test_xmp_readdir(filesystem, tmp_path):
+    names = {"file%d" % i for i in range(1000)} | {"ünïcode", "dir"}
+    for name in names:
+        (tmp_path / name).touch()
+    assert set(os.listdir(filesystem / tmp_path.relative_to("/"))) == names
+
+@pytest.mark.fstype("xmp", "-o", "path_cache_size=4")
+def test_xmp_path_cache(filesystem, tmp_path):
+    # more paths than cache slots, visited repeatedly
+    for rnd in range(3):
+        for i in range(10):
+            name = "file%d" % i
+            (tmp_path / name).write_text("%d %d" % (rnd, i))
+            assert (filesystem / tmp_path.relative_to("/") / name).read_text() == "%d %d" % (rnd, i)
+    os.rename(filesystem / tmp_path.relative_to("/") / "file0",
+              filesystem / tmp_path.relative_to("/") / "renamed")
+    assert (tmp_path / "renamed").read_text() == "2 0"
+    assert not (filesystem / tmp_path.relative_to("/") / "file0").exists()
+
+@pytest.mark.fstype("hello_ll")
+def test_hello_ll(filesystem):
+    assert sorted(os.listdir(filesystem)) == ["hello"]
+    assert (filesystem / "hello").stat().st_ino == 2
+    content = (filesystem / "hello").read_text(encoding="utf-8")
+    assert content == "Hello World!\n"
+    assert not (filesystem / "nonexistent").exists()
+
+@pytest.mark.fstype("hello_async", "-s", "-o", "delay=0.2")
+def test_hello_async(filesystem):
+    content = (filesystem / "hello").read_text(encoding="utf-8")
+    assert content == "Hello World!\n"
+    assert not (filesystem / "nonexistent").exists()
+
+    # a single-threaded fs, yet the requests are served concurrently
+    fd = os.open(filesystem / "hello", os.O_RDONLY)
+    try:
+        start = time.time()
+        threads = [threading.Thread(target=os.fstat, args=(fd,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert time.time() - start < 20 * 0.2 / 2
+    finally:
+        os.close(fd)
+
+@pytest.mark.fstype("xmp", "-o", "attr_timeout=0,attr_cache_ttl=60")
+def test_xmp_attr_cache(filesystem, tmp_path):
+    src = tmp_path / "file"
+    mnt = filesystem / src.relative_to("/")
+    src.write_bytes(b"abc")
+    assert mnt.stat().st_size == 3
+
+    # changes behind our back are not seen while cached...
+    src.write_bytes(b"abcdef")
+    assert mnt.stat().st_size == 3
+    # ...but the ones made through the fs are
+    mnt.write_bytes(b"abcdefgh")
+    assert mnt.stat().st_size == 8
+    mnt.chmod(0o600)
+    assert mnt.stat().st_mode & 0o777 == 0o600
+    os.truncate(mnt, 2)
+    assert mnt.stat().st_size == 2
+
+    nlink = mnt.parent.stat().st_nlink
+    (mnt.parent / "dir").mkdir()
+    assert mnt.parent.stat().st_nlink == nlink + 1
+    (mnt.parent / "dir" / "f").write_bytes(b"x")
+    assert (mnt.parent / "dir" / "f").stat().st_size == 1
+    os.rename(mnt.parent / "dir", mnt.parent / "dir2")
+    assert not (mnt.parent / "dir" / "f").exists()
+    assert (mnt.parent / "dir2" / "f").stat().st_size == 1
+    mnt.unlink()
+    assert not mnt.exists()
+
+@pytest.mark.fstype("xmp", "-o", "direct_io,block_cache_memory=1048576")
+def test_xmp_block_cache(filesystem, tmp_path):
+    src = tmp_path / "file"
+    mnt = filesystem / src.relative_to("/")
+    data = os.urandom(3 << 20)
+    src.write_bytes(data)
+
+    # sequential, with read-ahead, more than fits in the cache
+    assert mnt.read_bytes() == data
+    rnd = random.Random(0)
+    with open(mnt, "rb", buffering=0) as f:
+        for i in range(200):
+            off = rnd.randrange(len(data) + 1000)
+            size = rnd.randrange(1, 300000)
+            assert os.pread(f.fileno(), size, off) == data[off:off + size]
+
+        # writes through the fs are seen by the open file
+        with open(mnt, "r+b", buffering=0) as g:
+            g.seek(1000)
+            g.write(b"x" * 10)
+        assert os.pread(f.fileno(), 20, 995) == data[995:1000] + b"x" * 10 + data[1010:1015]
+        os.truncate(mnt, 100)
+        assert os.pread(f.fileno(), 200, 0) == data[:100]
+
+def unmount_and_load(filesystem, path):
+    """Unmount and load the JSON the fs writes to path when unmounted."""
+    subprocess.call(["fusermount", "-u", "-q", "-z", filesystem])
+    deadline = time.time() + 1
+    try:
+        while True:
+            # may still be being written
+            try:
+                return json.loads(path.read_text())
+            except (OSError, ValueError):
+                if time.time() > deadline:
+                    raise
+            time.sleep(.01)
+    finally:
+        path.unlink(missing_ok=True)
+
+stats_path = pathlib.Path(tempfile.gettempdir()) / "fuse-test-stats.json"
+
+@pytest.mark.fstype("xmp", "-o", f"direct_io,stats_file={stats_path}")
+def test_xmp_stats(filesystem, tmp_path):
+    src = tmp_path / "file"
+    mnt = filesystem / src.relative_to("/")
+    mnt.write_bytes(b"x" * 10000)
+    assert mnt.read_bytes() == b"x" * 10000
+    assert not (mnt.parent / "nonexistent").exists()
+
+    stats = unmount_and_load(filesystem, stats_path)
+
+    assert stats["write"]["bytes"] == 10000
+    assert stats["read"]["bytes"] >= 10000
+    assert stats["getattr"]["errors"][str(errno.ENOENT)] >= 1
+    for op in stats.values():
+        assert op["in_flight"] == 0
+        assert sum(op["latency"]) == op["calls"]
+        assert op["time_ns"] >= op["gil_wait_ns"]
+
+trace_path = pathlib.Path(tempfile.gettempdir()) / "fuse-test-trace.json"
+
+@pytest.mark.fstype("xmp", "-o", f"trace_size=10,trace_file={trace_path}")
+def test_xmp_trace(filesystem, tmp_path):
+    src = tmp_path / "file"
+    mnt = filesystem / src.relative_to("/")
+    src.write_bytes(b"abc")
+    for i in range(20):
+        assert not (mnt.parent / "nonexistent").exists()
+    assert mnt.read_bytes() == b"abc"
+
+    events = unmount_and_load(filesystem, trace_path)["traceEvents"]
+    requests = [e for e in events if e["cat"] == "fuse"]
+    # only the last ones are kept
+    assert len(requests) == 10
+    assert all(e["ph"] == "X" and e["pid"] != e["args"]["pid"] for e in requests)
+    reads = [e for e in requests if e["name"] == "read"]
+    assert reads and reads[0]["args"]["path"] == str(src)
+    assert reads[0]["args"]["fh"]
+    assert reads[0]["args"]["pid"] == os.getpid()
+    assert reads[0]["args"]["uid"] == os.getuid()
+    assert {e["ts"] for e in events if e["cat"] == "gil"} <= {e["ts"] for e in requests}
+
+@pytest.mark.fstype("xmp", "-o", f"trace_size=100,trace_file={trace_path}")
+def test_xmp_trace_symlink(filesystem, tmp_path):
+    link = tmp_path / "link"
+    (filesystem / link.relative_to("/")).symlink_to("target")
+    assert link.readlink() == pathlib.Path("target")
+
+    events = unmount_and_load(filesystem, trace_path)["traceEvents"]
+    symlinks = [e for e in events if e["name"] == "symlink"]
+    assert symlinks and symlinks[0]["args"]["path"] == str(link)
+
+@pytest.mark.skipif(fuse.APIVersion() < fuse.feature_needs("has_lseek"), reason="needs libfuse 3.8")
+@pytest.mark.fstype("xmp", "-o", f"trace_size=100,trace_file={trace_path}")
+def test_xmp_trace_lseek(filesystem, tmp_path):
+    # an offset past what an int holds
+    src = tmp_path / "sparse"
+    with src.open("wb") as f:
+        f.seek(3 << 30)
+        f.write(b"x")
+    with src.open("rb") as f:
+        if os.lseek(f.fileno(), 0, os.SEEK_DATA) == 0:
+            pytest.skip("the underlying filesystem doesn't keep holes")
+    with (filesystem / src.relative_to("/")).open("rb") as f:
+        assert os.lseek(f.fileno(), 0, os.SEEK_DATA) == 3 << 30
+
+    events = unmount_and_load(filesystem, trace_path)["traceEvents"]
+    seeks = [e for e in events if e["name"] == "lseek"]
+    assert seeks and seeks[0]["args"]["result"] == 3 << 30
+
+@pytest.mark.fstype("xmp", "-o", "direct_io,write_buffer_size=65536,write_buffer_age=0")
+def test_xmp_write_buffer(filesystem, tmp_path):
+    src = tmp_path / "file"
+    mnt = filesystem / src.relative_to("/")
+    data = os.urandom(100000)
+    with open(mnt, "w+b", buffering=0) as f:
+        for i in range(0, 20000, 1000):
+            f.write(data[i:i + 1000])
+        # held back...
+        assert src.stat().st_size == 0
+        # ...but read and stat flush it
+        assert os.pread(f.fileno(), 100, 500) == data[500:600]
+        assert src.stat().st_size == 20000
+        for i in range(20000, 30000, 1000):
+            f.write(data[i:i + 1000])
+        assert mnt.stat().st_size == 30000
+        # overlapping and large writes
+        for i in range(30000, 40000, 1000):
+            f.write(data[i:i + 1000])
+        f.seek(35000)
+        f.write(data[35000:100000])
+        os.fsync(f.fileno())
+        assert src.read_bytes() == data
+        f.write(b"x")
+    assert src.read_bytes() == data + b"x"
+
+@pytest.mark.fstype("memfs", "-o", "direct_io")
+def test_memfs(filesystem):
+    (filesystem / "dir").mkdir()
+    f = filesystem / "dir" / "file"
+    data = os.urandom(200000)
+    f.write_bytes(data)
+    assert f.read_bytes() == data
+    with open(f, "r+b", buffering=0) as g:
+        g.seek(300000)
+        g.write(b"x")
+    assert f.stat().st_size == 300001
+    assert f.read_bytes() == data + bytes(100000) + b"x"
+    os.truncate(f, 10)
+    assert f.read_bytes() == data[:10]
+
+    (filesystem / "link").symlink_to("dir/file")
+    assert (filesystem / "link").read_bytes() == data[:10]
+    f.rename(filesystem / "file")
+    assert sorted(os.listdir(filesystem)) == ["dir", "file", "link"]
+    with pytest.raises(OSError) as e:
+        (filesystem / "dir" / "file").stat()
+    assert e.value.errno == errno.ENOENT
+    (filesystem / "file").chmod(0o600)
+    assert (filesystem / "file").stat().st_mode & 0o777 == 0o600
+    with pytest.raises(OSError) as e:
+        (filesystem / "dir" / "sub").rmdir()
+    assert e.value.errno == errno.ENOENT
+    (filesystem / "file").unlink()
+    (filesystem / "dir").rmdir()
+    assert sorted(os.listdir(filesystem)) == ["link"]
+
+def fs_threads(mountpoint):
+    for p in pathlib.Path("/proc").glob("[0-9]*"):
+        try:
+            if str(mountpoint).encode() in (p / "cmdline").read_bytes().split(b"\0"):
+                return len(os.listdir(p / "task"))
+        except OSError:
+            pass
+
+@pytest.mark.fstype("memfs", "-o", "direct_io,max_threads=2,max_idle_threads=1,gil_aware")
+def test_memfs_max_threads(filesystem):
+    data = [os.urandom(100000) for i in range(8)]
+
+    def client(i):
+        f = filesystem / f"file{i}"
+        for _ in range(20):
+            f.write_bytes(data[i])
+            assert f.read_bytes() == data[i]
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    counts = []
+    while any(t.is_alive() for t in threads):
+        counts.append(fs_threads(filesystem))
+        time.sleep(.005)
+    for t in threads:
+        t.join()
+    # the workers and the main thread
+    assert 1 < max(counts) <= 3
+    assert [(filesystem / f"file{i}").read_bytes() for i in range(8)] == data
+
+def check_wcfs(filesystem, tmp_path):
+    mnt = filesystem / tmp_path.relative_to("/")
+    (tmp_path / "text").write_bytes(b"one two\nthree\n" * 1000)
+    (tmp_path / "dir").mkdir()
+    assert sorted(os.listdir(mnt)) == ["dir", "text", "text.wc"]
+    assert (mnt / "text.wc").read_bytes() == b"2000 3000 14000\n"
+    results = []
+    threads = [threading.Thread(target=lambda: results.append((mnt / "text.wc").read_bytes()))
+               for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [b"2000 3000 14000\n"] * 8
+    assert not (mnt / "dir.wc").exists()
+
+@pytest.mark.fstype("wcfs")
+def test_wcfs(filesystem, tmp_path):
+    check_wcfs(filesystem, tmp_path)
+
+@pytest.mark.skipif(sys.version_info < (3, 12), reason="needs a per-interpreter GIL")
+@pytest.mark.fstype("wcfs", "-o", "interpreters=2")
+def test_wcfs_interpreters(filesystem, tmp_path):
+    check_wcfs(filesystem, tmp_path)
+
+@pytest.mark.fstype("wcfs", "-o", "processes=2")
+def test_wcfs_processes(filesystem, tmp_path):
+    check_wcfs(filesystem, tmp_path)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# A filesystem keeping thread local data set up by worker_init, for the
+# tests. Each getattr of /counter counts in the serving thread, and gives
+# the count as st_size and the thread's id as st_mtime; /inits gives the
+# number of threads worker_init was called in as st_nlink, and the most
+# times it was called in one of them as st_size.
+
+import os, stat, errno, threading
+import fuse
+from fuse import Fuse
+
+fuse.fuse_python_api = (0, 2)
+
+class WorkerFS(Fuse):
+
+    def __init__(self, *args, **kw):
+        Fuse.__init__(self, *args, **kw)
+        self.local = threading.local()
+        self.inits = {}
+        self.lock = threading.Lock()
+
+    def worker_init(self):
+        self.local.counter = 0
+        with self.lock:
+            tid = threading.get_native_id()
+            self.inits[tid] = self.inits.get(tid, 0) + 1
+
+    def getattr(self, path):
+        st = fuse.Stat()
+        if path == '/':
+            st.st_mode = stat.S_IFDIR | 0o755
+            st.st_nlink = 2
+        elif path == '/counter':
+            self.local.counter += 1
+            st.st_mode = stat.S_IFREG | 0o444
+            st.st_nlink = 1
+            st.st_size = self.local.counter
+            st.st_mtime = threading.get_native_id()
+        elif path == '/inits':
+            with self.lock:
+                counts = list(self.inits.values())
+            st.st_mode = stat.S_IFREG | 0o444
+            st.st_nlink = len(counts)
+            st.st_size = max(counts)
+        else:
+            return -errno.ENOENT
+        return st
+
+    def readdir(self, path, offset):
+        for r in '.', '..', 'counter', 'inits':
+            yield fuse.Direntry(r)
+
+def main():
+    server = WorkerFS(version="%prog " + fuse.__version__,
+                      usage=Fuse.fusage)
+    server.parse(errex=1)
+    server.main()
+
+if __name__ == '__main__':
+    main()